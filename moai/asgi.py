@@ -0,0 +1,180 @@
+"""
+moai.asgi
+=========
+
+ASGI application for a MOAI feed, an alternative for
+:class:`moai.wsgi.MOAIWSGIApp`.
+
+The feed is still served by the synchronous :class:`moai.server.Server`,
+the database queries and the rendering of every chunk of a response run
+in a pool of worker threads. The threads are only used while a chunk is
+produced, sending it to the harvester happens on the event loop, so slow
+harvesters do not hold a thread for the whole response.
+
+All chunks of a response are produced by the same worker thread, the
+database cursor of a streamed response can only be used in the thread
+that opened it (for instance with SQLite). A response is assigned to
+the worker with the least open responses.
+
+The database is read with the synchronous SQLAlchemy engine in the
+worker threads, there are no async database methods: the SQLAlchemy
+version this is built on has no async engines.
+
+Run it with an ASGI server, for instance::
+
+  MOAI_CONFIG=settings.ini MOAI_FEED=moai_example \
+    uvicorn --factory moai.asgi:create_app
+
+"""
+import os
+import sys
+import time
+import asyncio
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from webob import Request
+
+from moai.wsgi import WSGIRequest, server_factory
+
+def build_environ(scope, body):
+    """Returns a WSGI environ for an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False}
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_%s' % name
+        if key in environ:
+            value = '%s,%s' % (environ[key], value)
+        environ[key] = value
+    return environ
+
+
+class MOAIASGIApp(object):
+    # the asgi app, calls the IServer with the IServerRequest in one
+    # of the worker threads
+    def __init__(self, server, workers=None):
+        self.server = server
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        # one thread per executor, a response stays on one thread
+        self.executors = [ThreadPoolExecutor(1) for num in range(workers)]
+        self._responses = [0] * workers
+
+    def handle(self, environ):
+        """Handle a request, returns the status, headers and the body
+        iterator of the response"""
+        started = time.perf_counter()
+        request = WSGIRequest(Request(environ))
+        response = self.server.handle_request(request)
+        start = []
+        def start_response(status, headers, exc_info=None):
+            start[:] = [status, headers]
+        body = self.server.meter(request,
+                                 response(environ, start_response),
+                                 started)
+        status, headers = start
+        return int(status.split()[0]), headers, body
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope: %s' % scope['type'])
+
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        # only changed on the event loop, so no lock is needed
+        worker = self._responses.index(min(self._responses))
+        self._responses[worker] += 1
+        try:
+            await self.respond(loop, self.executors[worker],
+                               build_environ(scope, b''.join(body)), send)
+        finally:
+            self._responses[worker] -= 1
+
+    async def respond(self, loop, executor, environ, send):
+        status, headers, chunks = await loop.run_in_executor(
+            executor, self.handle, environ)
+        try:
+            await send({'type': 'http.response.start',
+                        'status': status,
+                        'headers': [(name.lower().encode('latin1'),
+                                     value.encode('latin1'))
+                                    for name, value in headers]})
+            iterator = iter(chunks)
+            while True:
+                # every chunk is produced in the worker of the response
+                chunk = await loop.run_in_executor(executor,
+                                                   next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk,
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                await loop.run_in_executor(executor, chunks.close)
+
+    def shutdown(self, wait=True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+def app_factory(global_config, **kwargs):
+    # ASGI APP Factory, takes the same configuration as
+    # moai.wsgi.app_factory
+    workers = kwargs.pop('asgi_workers', None)
+    return MOAIASGIApp(server_factory(global_config, **kwargs),
+                       workers=workers and int(workers) or None)
+
+def create_app(config=None, name=None):
+    """Create the ASGI app from the feed configuration in a paste
+    deploy ini file, by default the file and app section in the
+    MOAI_CONFIG and MOAI_FEED environment variables"""
+    from paste.deploy import appconfig
+    config = config or os.environ['MOAI_CONFIG']
+    name = name or os.environ.get('MOAI_FEED', 'main')
+    settings = appconfig('config:%s' % os.path.abspath(config), name=name)
+    return app_factory(settings.global_conf, **settings.local_conf)
@@ -0,0 +1,273 @@
+"""
+moai.benchmark
+==============
+
+Small timing harness for the hot paths of a MOAI feed. It builds an
+in-memory database with generated records and times the different
+stages of serving a request. Run it with::
+
+  python -m moai.benchmark [benchmark name ...]
+
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import tracemalloc
+
+import oaipmh.server
+import oaipmh.common
+
+from lxml import etree
+
+from webob import Request
+
+from moai.database import SQLDatabase
+from moai.server import Server, FeedConfig
+from moai.wsgi import MOAIWSGIApp
+from moai.oai import OAIServerFactory, get_writer
+from moai.metadata.edm import EDM
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def create_database(count=100):
+    db = SQLDatabase()
+    start = datetime.datetime(2010, 1, 1)
+    for num in range(count):
+        db.update_record('oai:bench-%s' % num,
+                         start + datetime.timedelta(minutes=num),
+                         False,
+                         {},
+                         {'title': ['Benchmark record %s' % num],
+                          'author': ['Author %s' % num],
+                          'description': ['Lorem ipsum ' * 20],
+                          'language': ['en'],
+                          'date': ['2010-01-01']})
+    db.flush()
+    return db
+
+def create_config(**kwargs):
+    kwargs.setdefault('metadata_prefixes', ['oai_dc', 'mods', 'nl_mods',
+                                            'didl', 'nl_didl'])
+    return FeedConfig('Benchmark Feed', 'http://bench', **kwargs)
+
+def timeit(func, repeat=100):
+    """Returns the mean duration of a call to func in seconds"""
+    func()
+    starttime = time.time()
+    for num in range(repeat):
+        func()
+    return (time.time() - starttime) / repeat
+
+def report(name, duration, unit='request'):
+    print('%-50s %10.3f ms/%s' % (name, duration * 1000, unit))
+
+@benchmark
+def request_setup(repeat=200):
+    """Time spent building the OAI server for a request, with and
+    without reusing it between requests"""
+    db = create_database(10)
+    config = create_config()
+    server = Server('http://bench', db, config)
+    report('request setup: OAIServerFactory per request',
+           timeit(lambda: OAIServerFactory(db, config), repeat))
+    report('request setup: shared server (get_oai_server)',
+           timeit(server.get_oai_server, repeat))
+    app = MOAIWSGIApp(server)
+    report('request: Identify',
+           timeit(lambda: Request.blank(
+               'http://bench?verb=Identify').get_response(app), repeat))
+
+@benchmark
+def list_records(count=500, prefix='mods'):
+    """Time to first byte, total time and peak memory of a ListRecords
+    page, streamed and rendered as a single pyoai tree"""
+    db = create_database(count)
+    config = create_config(batch_size=count)
+    oai_server = Server('http://bench', db, config).get_oai_server()
+    tree_server = oaipmh.server.BatchingServer(
+        oai_server._server,
+        metadata_registry=oai_server._tree_server._metadata_registry,
+        resumption_batch_size=count)
+    query = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+
+    def consume(server):
+        """Returns time to first chunk and total time"""
+        starttime = time.time()
+        response = server.handleRequest(query)
+        if isinstance(response, bytes):
+            response = [response]
+        first_byte = None
+        for chunk in response:
+            if first_byte is None:
+                first_byte = time.time() - starttime
+        return first_byte, time.time() - starttime
+
+    for name, server in [('tree', tree_server), ('streaming', oai_server)]:
+        consume(server)
+        first_byte, duration = consume(server)
+        # memory is measured separately, tracing slows down rendering
+        tracemalloc.start()
+        consume(server)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report('ListRecords %s (%s records): first byte' % (name, count),
+               first_byte)
+        report('ListRecords %s (%s records): total' % (name, count),
+               duration)
+        print('%-50s %10.1f KB peak' % (
+            'ListRecords %s (%s records): memory' % (name, count),
+            peak / 1024.0))
+
+@benchmark
+def response_cache(count=100, repeat=20):
+    """Time of a repeated ListRecords request, with and without the
+    response cache"""
+    db = create_database(count)
+    for size in [0, 16 * 1024 * 1024]:
+        config = create_config(batch_size=count,
+                               extra_args={'response_cache_size': size})
+        app = MOAIWSGIApp(Server('http://bench', db, config))
+        report('ListRecords (%s records): %s' % (
+            count, size and 'cached' or 'uncached'),
+               timeit(lambda: Request.blank(
+                   'http://bench?verb=ListRecords&metadataPrefix=mods'
+                   ).get_response(app).body, repeat))
+
+@benchmark
+def render_pool(count=500, prefix='mods', repeat=3):
+    """Time of a ListRecords page rendered serially and by a pool of
+    threads or processes (only useful on a multi-core host)"""
+    db = create_database(count)
+    for kind in [None, 'thread', 'process']:
+        config = create_config(batch_size=count,
+                               extra_args={'render_pool': kind,
+                                           'response_cache_size': 0})
+        oai_server = Server('http://bench', db, config).get_oai_server()
+        query = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+        report('ListRecords %s (%s records): %s' % (
+            prefix, count, kind or 'serial'),
+               timeit(lambda: b''.join(oai_server.handleRequest(query)),
+                      repeat))
+
+@benchmark
+def export(count=1000, repeat=5):
+    """Time to fetch all records of a feed with the json export and
+    with oai_dc ListRecords"""
+    db = create_database(count)
+    config = create_config(batch_size=count,
+                           extra_args={'export': 'true',
+                                       'export_batch_size': count,
+                                       'response_cache_size': 0})
+    app = MOAIWSGIApp(Server('http://bench', db, config))
+    report('export ndjson (%s records)' % count,
+           timeit(lambda: Request.blank('http://bench/export').get_response(
+               app).body, repeat))
+    report('ListRecords oai_dc (%s records)' % count,
+           timeit(lambda: Request.blank(
+               'http://bench?verb=ListRecords&metadataPrefix=oai_dc'
+               ).get_response(app).body, repeat))
+
+@benchmark
+def edm_writer(repeat=500):
+    """Time to write the metadata of an EDM record, built directly with
+    lxml and with the xmltodict unparse and parse round trip"""
+    with open(os.path.join(os.path.dirname(__file__),
+                           'edm-example.json')) as stream:
+        record = json.load(stream)
+    writer = EDM('edm', None, None)
+    report('EDM writer: lxml', timeit(lambda: writer.build(record), repeat),
+           'record')
+    report('EDM writer: xmltodict',
+           timeit(lambda: writer.unparse(record), repeat), 'record')
+
+WRITER_RECORD = {
+    'id': 'oai:bench-writer',
+    'modified': datetime.datetime(2010, 1, 1, 12, 30),
+    'metadata': {
+        'title': ['A benchmark record'],
+        'creator': ['Spammer, J.', 'Hammer, K.'],
+        'author': ['Spammer, J.', 'Hammer, K.'],
+        'editor': ['Eggs, L.'],
+        'subject': ['spam', 'ham', 'eggs'],
+        'description': ['Lorem ipsum ' * 20],
+        'publisher': ['Spam Press'],
+        'type': ['article'],
+        'dare_type': ['info:eu-repo/semantics/article'],
+        'format': ['application/pdf'],
+        'identifier': ['http://bench/record'],
+        'url': ['http://bench/record'],
+        'language': ['en'],
+        'date': ['2010-01-01'],
+        'rights': ['Open access'],
+        'journal_title': ['Journal of Spam'],
+        'journal_issn': ['1234-5678'],
+        'journal_volume': ['3'],
+        'journal_start_page': ['10'],
+        'journal_end_page': ['20'],
+        'classification': ['ddc#025'],
+        'dare_id': ['urn:nbn:nl:ui:bench'],
+        'asset': [{'url': '/asset/oai:bench-writer/spam.pdf',
+                   'absolute_uri': 'http://bench/asset/spam.pdf',
+                   'mimetype': 'application/pdf',
+                   'access': 'open',
+                   'bytes': 123456,
+                   'modified': ['2010-01-01']}]}}
+
+@benchmark
+def format_writers(repeat=2000):
+    """Time to write the metadata of a record, for every built-in
+    metadata format"""
+    config = create_config()
+    metadata = oaipmh.common.Metadata(None, WRITER_RECORD['metadata'])
+    metadata.record = WRITER_RECORD
+    for prefix in config.metadata_prefixes:
+        writer = get_writer(prefix, config, None)
+        duration = timeit(lambda: writer(etree.Element('metadata'), metadata),
+                          repeat)
+        report('writer %s' % prefix, duration, 'record')
+        print('%-50s %10.0f records/s' % ('writer %s' % prefix,
+                                          1.0 / duration))
+
+@benchmark
+def edm_passthrough(count=200, repeat=5):
+    """Time of an EDM ListRecords page written by the EDM writer and
+    with the stored metadata XML copied into the response"""
+    with open(os.path.join(os.path.dirname(__file__),
+                           'edm-example.json')) as stream:
+        record = json.load(stream)
+    payload = etree.tostring(EDM('edm', None, None).build(record),
+                             encoding='UTF-8')
+    db = SQLDatabase()
+    start = datetime.datetime(2010, 1, 1)
+    for num in range(count):
+        db.update_record('oai:bench-%s' % num,
+                         start + datetime.timedelta(minutes=num),
+                         False, {}, record, payloads={'edm': payload})
+    db.flush()
+    for passthrough in ['', 'edm']:
+        config = create_config(batch_size=count,
+                               metadata_prefixes=['edm'],
+                               extra_args={'passthrough': passthrough,
+                                           'response_cache_size': 0})
+        oai_server = Server('http://bench', db, config).get_oai_server()
+        query = {'verb': 'ListRecords', 'metadataPrefix': 'edm'}
+        report('ListRecords edm (%s records): %s' % (
+            count, passthrough and 'passthrough' or 'writer'),
+               timeit(lambda: b''.join(oai_server.handleRequest(query)),
+                      repeat))
+
+def main(names=None):
+    names = names or sys.argv[1:]
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        func()
+
+if __name__ == '__main__':
+    main()
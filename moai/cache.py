@@ -0,0 +1,177 @@
+"""
+moai.cache
+==========
+
+Cache of rendered OAI responses.
+
+Responses are stored under a key that identifies the request and the
+state of the feed (see :meth:`moai.server.Server.get_validators`), so
+a flush of the database or a change of the feed configuration results
+in new keys, and old responses are never served. Outdated entries are
+evicted when the cache is full or when their time to live has passed.
+
+The cache keeps the responses in memory, and optionally in a directory
+that can be shared by several worker processes on the same machine.
+
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from moai.compression import EncodedBody
+
+class ResponseCache(object):
+    """A cache of rendered responses (stored as EncodedBody objects),
+    bounded by the number of bytes kept in memory
+    """
+    # the number of writes between removals of expired files
+    prune_interval = 100
+
+    def __init__(self, max_size, ttl=300, directory=None):
+        self.max_size = max_size
+        # larger responses are not cached
+        self.max_entry_size = max_size // 4
+        self.ttl = ttl
+        self.directory = directory
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """Returns the EncodedBody stored under key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, body, size = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return body
+                self._remove(key)
+        if self.directory:
+            body = self._read(key, now)
+            if body is not None:
+                self._store(key, body, now + self.ttl)
+                return body
+        return None
+
+    def set(self, key, data):
+        """Store a response (a string or an EncodedBody) under key,
+        returns the EncodedBody"""
+        if not isinstance(data, EncodedBody):
+            data = EncodedBody(data)
+        if len(data.data) > self.max_entry_size:
+            return data
+        self._store(key, data, time.time() + self.ttl)
+        if self.directory:
+            self._write(key, data.data)
+        return data
+
+    def tee(self, key, data):
+        """Returns the response data, and stores it under key. A
+        streamed response (an iterator of strings) is stored once it is
+        completely sent, and only if it is not too large."""
+        if isinstance(data, (bytes, EncodedBody)):
+            return self.set(key, data)
+        return self._tee(key, data)
+
+    def _tee(self, key, chunks):
+        collected = []
+        size = 0
+        for chunk in chunks:
+            if collected is not None:
+                size += len(chunk)
+                if size > self.max_entry_size:
+                    collected = None
+                else:
+                    collected.append(chunk)
+            yield chunk
+        if collected is not None:
+            self.set(key, b''.join(collected))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _store(self, key, body, expires):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            # compressed versions that are added later are counted
+            # when they are created
+            body.on_encoded = lambda added: self._grow(key, body, added)
+            size = body.size()
+            self._entries[key] = (expires, body, size)
+            self.size += size
+            self._evict()
+
+    def _grow(self, key, body, added):
+        # a compressed version was added to the body stored under key
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] is not body:
+                return
+            self._entries[key] = (entry[0], body, entry[2] + added)
+            self.size += added
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        expires, body, size = self._entries.pop(key)
+        self.size -= size
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, '%s.xml' % name)
+
+    def _read(self, key, now):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as stream:
+                return EncodedBody(stream.read())
+        except OSError:
+            return None
+
+    def _write(self, key, data):
+        # write to a temporary file first, so other processes never
+        # read a partially written response
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(data)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_interval == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Remove the expired files from the cache directory"""
+        if not self.directory:
+            return
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) + self.ttl <= now:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,108 @@
+"""
+moai.compression
+================
+
+Content-Encoding negotiation and (streaming) gzip/deflate compression
+of responses.
+
+"""
+import zlib
+
+ENCODINGS = ('gzip', 'deflate')
+
+# zlib window bits for the gzip container and the zlib container that
+# is used for the http "deflate" encoding
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS,
+          'deflate': zlib.MAX_WBITS}
+
+def negotiate(accept_encoding, encodings=ENCODINGS):
+    """Returns the encoding from encodings that is preferred by the
+    client according to the Accept-Encoding header, or None if the
+    response should not be compressed.
+    """
+    if not accept_encoding or not encodings:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name] = quality
+    best = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compressor(encoding, level=6):
+    return zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+
+def compress(data, encoding, level=6):
+    compressobj = compressor(encoding, level)
+    return compressobj.compress(data) + compressobj.flush()
+
+def compress_iter(chunks, encoding, level=6):
+    """Compress an iterator of chunks while it is consumed, the first
+    chunk is flushed right away to keep the time to first byte low"""
+    compressobj = compressor(encoding, level)
+    first = True
+    for chunk in chunks:
+        data = compressobj.compress(chunk)
+        if first:
+            data += compressobj.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+class EncodedBody(object):
+    """A rendered response body that is kept around (for instance in
+    a cache), the compressed versions are created on first use and
+    stored with it, so they are not compressed again for every request.
+    """
+    def __init__(self, data):
+        self.data = data
+        self._encoded = {}
+        # called with the size of every compressed version that is
+        # added, so a cache can count it
+        self.on_encoded = None
+
+    def encode(self, encoding=None, level=6):
+        if encoding is None:
+            return self.data
+        key = (encoding, level)
+        data = self._encoded.get(key)
+        if data is None:
+            compressed = compress(self.data, encoding, level)
+            # another thread may have added the same version meanwhile
+            data = self._encoded.setdefault(key, compressed)
+            on_encoded = self.on_encoded
+            if data is compressed and on_encoded is not None:
+                on_encoded(len(data))
+        return data
+
+    def size(self):
+        return len(self.data) + sum(
+            [len(data) for data in self._encoded.values()])
+
+def encode(data, encoding=None, level=6):
+    """Encode a response body: a string, an iterator of strings or
+    an EncodedBody"""
+    if isinstance(data, EncodedBody):
+        return data.encode(encoding, level)
+    if encoding is None:
+        return data
+    if isinstance(data, bytes):
+        return compress(data, encoding, level)
+    return compress_iter(data, encoding, level)
@@ -12,12 +12,16 @@ class EdmContent(object):
         self.deleted = None
         self.sets = None
         self.metadata = None
+        self.payloads = {}
 
     def update(self, edm):
         self.id = edm["header"]["identifier"]
         self.modified= dateparser.parse(edm["header"]["datestamp"])
         self.deleted = False  # TODO: support deletions
         self.metadata = edm.get("metadata", dict())
+        # the original XML of the metadata, see moai.passthrough
+        if edm.get("payload") is not None:
+            self.payloads = {"edm": edm["payload"]}
 
         set = self.provider.get_set()
         self.sets = {set: {"name": bytes(set, 'utf-8'),
@@ -1,21 +1,64 @@
+import os
+import time
 import datetime
 import json
-from pkg_resources import iter_entry_points
+import logging
+import threading
 
 import sqlalchemy as sql
+from sqlalchemy.pool import StaticPool
 
 from moai.utils import check_type
+from moai.plugins import get_plugin
+from moai.metrics import QUERY_SECONDS, QUERY_ROWS
+from moai.querylog import QueryLog
+from moai.passthrough import (get_compression, encode_payload,
+                              decode_payload)
+
+log = logging.getLogger(__name__)
 
 def get_database(uri, config=None):
     prefix = uri.split(':')[0]
-    for entry_point in iter_entry_points(group='moai.database', name=prefix):
-        dbclass = entry_point.load()
+    dbclass = get_plugin('moai.database', prefix)
+    if dbclass is None:
+        raise ValueError('No such database registered: %s' % prefix)
+    try:
+        return dbclass(uri, config)
+    except TypeError:
+        # ugly backwards compatibility hack
+        return dbclass(uri)
+
+
+# the tables of every database uri, shared by all SQLDatabase objects of
+# a process (for instance all the feeds of a paste urlmap), so there is
+# one engine and connection pool per database
+_shared_tables = {}
+_shared_lock = threading.Lock()
+
+
+class SharedTables(object):
+    # the bound metadata of a database, its set catalogue and query log,
+    # the catalogue is reloaded when the database generation changes
+    def __init__(self, db):
+        self.db = db
+        self.catalogue = None
+        self.query_log = QueryLog()
+
+def _normalize_uri(dburi):
+    if dburi is None or dburi in ('sqlite://', 'sqlite:///:memory:'):
+        return None
+    if dburi.startswith('sqlite:///'):
+        return 'sqlite:///%s' % os.path.abspath(dburi[len('sqlite:///'):])
+    return dburi
+
+def _parse_date(value):
+    # parses the iso dates found in asset metadata, returns None for
+    # dates that are not understood
+    for format, length in (('%Y-%m-%dT%H:%M:%S', 19), ('%Y-%m-%d', 10)):
         try:
-            return dbclass(uri, config)
-        except TypeError:
-            # ugly backwards compatibility hack
-            return dbclass(uri)
-    raise ValueError('No such database registered: %s' % prefix)
+            return datetime.datetime.strptime(value[:length], format)
+        except ValueError:
+            pass
 
 
 class SQLDatabase(object):
@@ -24,20 +67,53 @@ class SQLDatabase(object):
     more documentation.
     """
 
-    def __init__(self, dburi=None):
+    # seconds a set catalogue is used before the generation of the
+    # database is checked again
+    catalogue_interval = 1
+
+    def __init__(self, dburi=None, config=None):
         self._uri = dburi
-        self._db = self._connect()
+        self._shared = self._get_shared()
+        # statements are timed when the feed sets a slow_query_threshold
+        self._shared.query_log.update(QueryLog.from_config(config))
+        self._shared.query_log.listen(self._shared.db.bind)
+        self._db = self._shared.db
         self._records = self._db.tables['records']
         self._sets = self._db.tables['sets']
         self._setrefs = self._db.tables['setrefs']
+        self._generations = self._db.tables['generations']
+        self._assets = self._db.tables['assets']
+        self._payloads = self._db.tables['payloads']
+        # compression of the stored metadata XML (see moai.passthrough)
+        self.payload_compression = get_compression(config)
         self._reset_cache()
         
+    def _get_shared(self):
+        # in memory databases can not be shared, every SQLDatabase
+        # object has its own database
+        key = _normalize_uri(self._uri)
+        if key is None:
+            return SharedTables(self._connect())
+        with _shared_lock:
+            shared = _shared_tables.get(key)
+            if shared is None:
+                shared = _shared_tables[key] = SharedTables(self._connect())
+            return shared
+
     def _connect(self):
         dburi = self._uri
         if dburi is None:
             dburi = 'sqlite:///:memory:'
-            
-        engine = sql.create_engine(dburi)
+
+        if dburi in ('sqlite://', 'sqlite:///:memory:'):
+            # every connection to an in memory database is a new
+            # database, so share one connection between threads
+            engine = sql.create_engine(
+                dburi,
+                connect_args={'check_same_thread': False},
+                poolclass=StaticPool)
+        else:
+            engine = sql.create_engine(dburi)
         db = sql.MetaData(engine)
         
         sql.Table('records', db,
@@ -59,6 +135,31 @@ class SQLDatabase(object):
                   sql.Column('set_id', sql.Integer,
                              sql.ForeignKey('sets.set_id'),
                              index=True, primary_key=True))
+
+        sql.Table('assets', db,
+                  sql.Column('record_id', sql.Unicode,
+                             sql.ForeignKey('records.record_id'),
+                             primary_key=True),
+                  sql.Column('filename', sql.Unicode, primary_key=True),
+                  sql.Column('md5', sql.Unicode, index=True),
+                  sql.Column('path', sql.Unicode),
+                  sql.Column('url', sql.Unicode),
+                  sql.Column('mimetype', sql.Unicode),
+                  sql.Column('size', sql.Integer),
+                  sql.Column('mtime', sql.DateTime))
+
+        sql.Table('payloads', db,
+                  sql.Column('record_id', sql.Unicode,
+                             sql.ForeignKey('records.record_id'),
+                             primary_key=True),
+                  sql.Column('prefix', sql.Unicode, primary_key=True),
+                  sql.Column('compression', sql.Unicode),
+                  sql.Column('data', sql.LargeBinary))
+
+        sql.Table('generations', db,
+                  sql.Column('generation_id', sql.Integer, primary_key=True),
+                  sql.Column('generation', sql.Integer),
+                  sql.Column('modified', sql.DateTime))
         
         db.create_all()
         return db
@@ -73,10 +174,14 @@ class SQLDatabase(object):
         deleted_records = []
         deleted_sets = []
         deleted_setrefs = []
+        deleted_assets = []
+        deleted_payloads = []
 
         inserted_records = []
         inserted_sets = []
         inserted_setrefs = []
+        inserted_assets = []
+        inserted_payloads = []
 
         
         for oai_id, item in list(self._cache['records'].items()):
@@ -99,6 +204,14 @@ class SQLDatabase(object):
                 inserted_setrefs.append(
                     {'record_id':record_id, 'set_id': set_id})
 
+        for record_id, assets in list(self._cache['assets'].items()):
+            deleted_assets.append(record_id)
+            inserted_assets.extend(assets)
+
+        for record_id, payloads in list(self._cache['payloads'].items()):
+            deleted_payloads.append(record_id)
+            inserted_payloads.extend(payloads)
+
         # delete all processed records before inserting
         if deleted_records:
             self._records.delete(
@@ -115,6 +228,16 @@ class SQLDatabase(object):
                 self._setrefs.c.record_id == sql.bindparam('record_id')
                 ).execute(
                 [{'record_id': rid} for rid in deleted_setrefs])
+        if deleted_assets:
+            self._assets.delete(
+                self._assets.c.record_id == sql.bindparam('record_id')
+                ).execute(
+                [{'record_id': rid} for rid in deleted_assets])
+        if deleted_payloads:
+            self._payloads.delete(
+                self._payloads.c.record_id == sql.bindparam('record_id')
+                ).execute(
+                [{'record_id': rid} for rid in deleted_payloads])
 
         # batch inserts
         if inserted_records:
@@ -123,15 +246,63 @@ class SQLDatabase(object):
             self._sets.insert().execute(inserted_sets)
         if inserted_setrefs:
             self._setrefs.insert().execute(inserted_setrefs)
+        if inserted_assets:
+            self._assets.insert().execute(inserted_assets)
+        if inserted_payloads:
+            self._payloads.insert().execute(inserted_payloads)
 
         self._reset_cache()
+        self._bump_generation()
+
+    def generation(self):
+        """Returns a number that is incremented every time the content
+        of the database changes, so cached responses can be invalidated
+        (also by other processes updating the database)"""
+        row = sql.select([self._generations.c.generation]).where(
+            self._generations.c.generation_id == 1).execute().fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def last_modified(self):
+        """Returns the (utc) time of the last change to the database
+        contents, or None if it was never changed"""
+        row = sql.select([self._generations.c.modified]).where(
+            self._generations.c.generation_id == 1).execute().fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _bump_generation(self):
+        self._shared.catalogue = None
+        now = datetime.datetime.utcnow()
+        # the Last-Modified header has a resolution of one second, every
+        # generation gets a time in a later second than the previous one
+        # so If-Modified-Since can tell them apart
+        previous = self.last_modified()
+        if previous is not None:
+            previous = previous.replace(microsecond=0)
+            if now.replace(microsecond=0) <= previous:
+                now = previous + datetime.timedelta(seconds=1)
+        result = self._generations.update(
+            self._generations.c.generation_id == 1).values(
+            generation=self._generations.c.generation + 1,
+            modified=now).execute()
+        if not result.rowcount:
+            self._generations.insert().execute(
+                generation_id=1, generation=1, modified=now)
 
     def _reset_cache(self):
-        self._cache = {'records': {}, 'sets': {}, 'setrefs': {}}
+        self._cache = {'records': {}, 'sets': {}, 'setrefs': {}, 'assets': {},
+                       'payloads': {}}
         
             
-    def update_record(self, oai_id, modified, deleted, sets, metadata):
+    def update_record(self, oai_id, modified, deleted, sets, metadata,
+                      assets=None, payloads=None):
         # adds a record, call flush to actually store in db
+        # the assets default to the 'asset' list in the metadata,
+        # payloads is a dictionary with the original metadata XML
+        # (bytes) by metadata prefix
 
         check_type(oai_id,
                    str,
@@ -162,6 +333,8 @@ class SQLDatabase(object):
             else:
                 raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
 
+        if assets is None:
+            assets = metadata.get('asset', [])
         metadata = json.dumps(metadata, default=date_handler)
         self._cache['records'][oai_id] = (dict(modified=modified,
                                                deleted=deleted,
@@ -173,6 +346,99 @@ class SQLDatabase(object):
                 description = sets[set_id].get('description'),
                 hidden = sets[set_id].get('hidden', False))
             self._cache['setrefs'][oai_id].append(set_id)
+
+        rows = {}
+        for asset in assets:
+            row = self._asset_row(oai_id, asset)
+            if row is not None:
+                rows[row['filename']] = row
+        self._cache['assets'][oai_id] = list(rows.values())
+
+        self._cache['payloads'][oai_id] = [
+            {'record_id': oai_id,
+             'prefix': prefix,
+             'compression': self.payload_compression,
+             'data': encode_payload(data, self.payload_compression)}
+            for prefix, data in sorted((payloads or {}).items())
+            if data is not None]
+
+    def _asset_row(self, oai_id, asset):
+        # returns the assets table row for an asset dictionary (as
+        # described in IContentObject.get_assets), size and
+        # modification time are taken from the file if they are missing
+        # or invalid. Returns None for an asset that can not be stored,
+        # the record itself is still stored
+        if not isinstance(asset, dict):
+            log.warning('Skipping asset of record %s, it is not a '
+                        'dictionary: %r', oai_id, asset)
+            return None
+        path = asset.get('path')
+        uri = asset.get('absolute_uri') or ''
+        if not path and uri.startswith('file://'):
+            path = uri[len('file://'):]
+        url = asset.get('url')
+        filename = asset.get('filename')
+        if not filename:
+            filename = os.path.basename(path or url or '')
+        if not filename:
+            log.warning('Skipping asset of record %s, it has no filename, '
+                        'path or url: %r', oai_id, asset)
+            return None
+        size = asset.get('size', asset.get('bytes'))
+        if size is not None:
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                log.warning('Invalid size of asset %s of record %s: %r',
+                            filename, oai_id, size)
+                size = None
+        mtime = asset.get('mtime')
+        if isinstance(mtime, str):
+            mtime = _parse_date(mtime)
+        if mtime is not None and not isinstance(mtime, datetime.datetime):
+            log.warning('Invalid mtime of asset %s of record %s: %r',
+                        filename, oai_id, mtime)
+            mtime = None
+        if path and os.path.isfile(path) and (size is None or mtime is None):
+            stat = os.stat(path)
+            if size is None:
+                size = stat.st_size
+            if mtime is None:
+                mtime = datetime.datetime.utcfromtimestamp(stat.st_mtime)
+        return {'record_id': oai_id,
+                'filename': filename,
+                'md5': asset.get('md5', asset.get('md5sum')),
+                'path': path,
+                'url': url,
+                'mimetype': asset.get('mimetype'),
+                'size': size,
+                'mtime': mtime}
+
+    def get_assets(self, oai_id):
+        return [self._asset_dict(row) for row in self._assets.select(
+            self._assets.c.record_id == oai_id,
+            order_by=[self._assets.c.filename]).execute()]
+
+    def get_asset(self, oai_id, name):
+        """Returns the asset of a record with this filename or md5
+        checksum, or None"""
+        assets = self._assets
+        row = assets.select(sql.and_(
+            assets.c.record_id == oai_id,
+            sql.or_(assets.c.filename == name,
+                    assets.c.md5 == name))).limit(1).execute().fetchone()
+        if row is None:
+            return
+        return self._asset_dict(row)
+
+    def _asset_dict(self, row):
+        return {'filename': row.filename,
+                'md5': row.md5,
+                'path': row.path,
+                'url': row.url,
+                'mimetype': row.mimetype,
+                'size': row.size,
+                'mtime': row.mtime}
             
     def get_record(self, oai_id):
         row = self._records.select(
@@ -186,29 +452,110 @@ class SQLDatabase(object):
                   'sets': self.get_setrefs(oai_id)}
         return record
 
+    def get_metadata(self, oai_id):
+        """Returns the metadata dictionary of a record, or None"""
+        return self.get_metadata_many([oai_id]).get(oai_id)
+
+    def get_metadata_many(self, oai_ids):
+        """Returns a dictionary with the metadata of a list of records
+        (for instance the related records of a page), fetched with one
+        query per 500 records. Missing records are left out."""
+        metadata = {}
+        oai_ids = list(oai_ids)
+        started = time.perf_counter()
+        for start in range(0, len(oai_ids), 500):
+            query = sql.select([self._records.c.record_id,
+                                self._records.c.metadata])
+            query.append_whereclause(self._records.c.record_id.in_(
+                oai_ids[start:start + 500]))
+            for row in query.execute():
+                metadata[row.record_id] = json.loads(row.metadata)
+        QUERY_SECONDS.observe(('metadata',), time.perf_counter() - started)
+        QUERY_ROWS.inc(('metadata',), len(metadata))
+        return metadata
+
+    def set_catalogue(self):
+        """Returns a dictionary with all sets by id, in database order.
+        The catalogue is shared by all feeds of the database in this
+        process and is reloaded when the database generation changes"""
+        shared = self._shared
+        catalogue = shared.catalogue
+        now = time.time()
+        if catalogue is not None and now - catalogue[1] < self.catalogue_interval:
+            return catalogue[2]
+        generation = self.generation()
+        if catalogue is not None and catalogue[0] == generation:
+            shared.catalogue = (generation, now, catalogue[2])
+            return catalogue[2]
+        sets = {}
+        for row in self._sets.select().execute():
+            sets[row.set_id] = {'id': row.set_id,
+                                'name': row.name,
+                                'description': row.description,
+                                'hidden': row.hidden}
+        shared.catalogue = (generation, now, sets)
+        return sets
+
+    def _visible_set_ids(self, set_ids, include_hidden_sets):
+        if include_hidden_sets:
+            return sorted(set_ids)
+        catalogue = self.set_catalogue()
+        return sorted(set_id for set_id in set_ids
+                      if set_id in catalogue and
+                      not catalogue[set_id]['hidden'])
+
     def get_set(self, oai_id):
-        row = self._sets.select(
-            self._sets.c.set_id == oai_id).execute().fetchone()
-        if row is None:
+        oai_set = self.set_catalogue().get(oai_id)
+        if oai_set is None:
             return
-        return {'id': row.set_id,
-                'name': row.name,
-                'description': row.description,
-                'hidden': row.hidden}
+        return dict(oai_set)
+
+    def get_setrefs_many(self, oai_ids, include_hidden_sets=False):
+        """Returns a dictionary with the sorted set ids of a list of
+        records, fetched with one query per 500 records"""
+        setrefs = {}
+        oai_ids = list(oai_ids)
+        for start in range(0, len(oai_ids), 500):
+            query = sql.select([self._setrefs.c.record_id,
+                                self._setrefs.c.set_id])
+            query.append_whereclause(self._setrefs.c.record_id.in_(
+                oai_ids[start:start + 500]))
+            for row in query.execute():
+                setrefs.setdefault(row[0], []).append(row[1])
+        for oai_id, set_ids in list(setrefs.items()):
+            set_ids = self._visible_set_ids(set_ids, include_hidden_sets)
+            if set_ids:
+                setrefs[oai_id] = set_ids
+            else:
+                del setrefs[oai_id]
+        return setrefs
+
+    def get_payloads(self, oai_ids, prefix):
+        """Returns a dictionary with the stored metadata XML (bytes) in
+        the metadata format prefix of a list of records, records without
+        it are left out"""
+        payloads = {}
+        oai_ids = list(oai_ids)
+        started = time.perf_counter()
+        for start in range(0, len(oai_ids), 500):
+            query = sql.select([self._payloads.c.record_id,
+                                self._payloads.c.compression,
+                                self._payloads.c.data])
+            query.append_whereclause(self._payloads.c.record_id.in_(
+                oai_ids[start:start + 500]))
+            query.append_whereclause(self._payloads.c.prefix == prefix)
+            for row in query.execute():
+                payloads[row.record_id] = decode_payload(row.data,
+                                                         row.compression)
+        QUERY_SECONDS.observe(('payloads',), time.perf_counter() - started)
+        QUERY_ROWS.inc(('payloads',), len(payloads))
+        return payloads
 
     def get_setrefs(self, oai_id, include_hidden_sets=False):
-        set_ids = []
         query = sql.select([self._setrefs.c.set_id])
         query.append_whereclause(self._setrefs.c.record_id == oai_id)
-        if include_hidden_sets == False:
-            query.append_whereclause(
-                sql.and_(self._sets.c.set_id == self._setrefs.c.set_id,
-                         self._sets.c.hidden == include_hidden_sets))
-        
-        for row in query.execute():
-            set_ids.append(row[0])
-        set_ids.sort()
-        return set_ids
+        return self._visible_set_ids([row[0] for row in query.execute()],
+                                     include_hidden_sets)
 
     def record_count(self):
         return sql.select([sql.func.count('*')],
@@ -221,22 +568,28 @@ class SQLDatabase(object):
     def remove_record(self, oai_id):
         self._records.delete(
             self._records.c.record_id == oai_id).execute()
+        self._assets.delete(
+            self._assets.c.record_id == oai_id).execute()
+        self._payloads.delete(
+            self._payloads.c.record_id == oai_id).execute()
         self._setrefs.delete(
             self._setrefs.c.record_id == oai_id).execute()
+        self._bump_generation()
 
     def remove_set(self, oai_id):
         self._sets.delete(
             self._sets.c.set_id == oai_id).execute()
         self._setrefs.delete(
             self._setrefs.c.set_id == oai_id).execute()
+        self._bump_generation()
 
     def oai_sets(self, offset=0, batch_size=20):
-        for row in self._sets.select(
-              self._sets.c.hidden == False
-            ).offset(offset).limit(batch_size).execute():
-            yield {'id': row.set_id,
-                   'name': row.name,
-                   'description': row.description}
+        sets = [oai_set for oai_set in self.set_catalogue().values()
+                if not oai_set['hidden']]
+        for oai_set in sets[offset:offset + batch_size]:
+            yield {'id': oai_set['id'],
+                   'name': oai_set['name'],
+                   'description': oai_set['description']}
 
     def oai_earliest_datestamp(self):
         row = sql.select([self._records.c.modified],
@@ -246,6 +599,18 @@ class SQLDatabase(object):
             return row[0]
         return datetime.datetime(1970, 1, 1)
     
+    def oai_latest_datestamp(self, until_date):
+        """Returns the latest modification date that is not after
+        until_date, or None"""
+        return sql.select([sql.func.max(self._records.c.modified)]).where(
+            self._records.c.modified <= until_date).execute().scalar()
+
+    def oai_next_datestamp(self, after_date):
+        """Returns the first modification date after after_date (for
+        instance an embargo date), or None"""
+        return sql.select([sql.func.min(self._records.c.modified)]).where(
+            self._records.c.modified > after_date).execute().scalar()
+
     def oai_query(self,
                   offset=0,
                   batch_size=20,
@@ -279,8 +644,26 @@ class SQLDatabase(object):
         if not from_date is None:
             query.append_whereclause(self._records.c.modified >= from_date)
 
-        # filter sets
+        self._filter_sets(query, needed_sets, allowed_sets, disallowed_sets)
 
+        started = time.perf_counter()
+        rows = query.distinct().offset(offset).limit(batch_size).execute()
+        QUERY_SECONDS.observe(('oai_query',), time.perf_counter() - started)
+        count = 0
+        try:
+            for row in rows:
+                count += 1
+                yield {'id': row.record_id,
+                       'deleted': row.deleted,
+                       'modified': row.modified,
+                       'metadata': json.loads(row.metadata),
+                       'sets': self.get_setrefs(row.record_id)
+                       }
+        finally:
+            QUERY_ROWS.inc(('oai_query',), count)
+
+    def _filter_sets(self, query, needed_sets, allowed_sets, disallowed_sets):
+        # add the where clauses for the set filters to a records query
         setclauses = []
         for set_id in needed_sets:
             alias = self._setrefs.alias()
@@ -314,12 +697,74 @@ class SQLDatabase(object):
             
         if disallowed_setclauses:
             query.append_whereclause(sql.not_(sql.or_(*disallowed_setclauses)))
-            
-        for row in query.distinct().offset(offset).limit(batch_size).execute():
-            yield {'id': row.record_id,
-                   'deleted': row.deleted,
-                   'modified': row.modified,
-                   'metadata': json.loads(row.metadata),
-                   'sets': self.get_setrefs(row.record_id)
-                   }
+
+    def oai_visible(self,
+                    oai_id,
+                    needed_sets=None,
+                    disallowed_sets=None,
+                    allowed_sets=None,
+                    deleted_sets=None,
+                    until_date=None):
+        if until_date is None or until_date > datetime.datetime.utcnow():
+            until_date = datetime.datetime.utcnow()
+        records = self._records
+        query = sql.select([records.c.record_id])
+        query.append_whereclause(records.c.record_id == oai_id)
+        query.append_whereclause(records.c.deleted == False)
+        query.append_whereclause(records.c.modified <= until_date)
+        # records in a deleted set are shown as deleted
+        self._filter_sets(query,
+                          needed_sets or [],
+                          allowed_sets or [],
+                          list(disallowed_sets or []) +
+                          list(deleted_sets or []))
+        return query.limit(1).execute().fetchone() is not None
+
+    def oai_export(self,
+                   after=None,
+                   batch_size=1000,
+                   needed_sets=None,
+                   disallowed_sets=None,
+                   allowed_sets=None,
+                   from_date=None,
+                   until_date=None):
+        """Returns a list of records in (modified, id) order, starting
+        after the (modified, id) key in after. The metadata is returned
+        as the stored json string under the `metadata_json` key, so it
+        can be passed on without decoding it.
+        """
+        if until_date is None or until_date > datetime.datetime.utcnow():
+            until_date = datetime.datetime.utcnow()
+
+        records = self._records
+        query = records.select(
+            order_by=[sql.asc(records.c.modified),
+                      sql.asc(records.c.record_id)])
+        query.append_whereclause(records.c.modified <= until_date)
+        if from_date is not None:
+            query.append_whereclause(records.c.modified >= from_date)
+        if after is not None:
+            modified, record_id = after
+            query.append_whereclause(sql.or_(
+                records.c.modified > modified,
+                sql.and_(records.c.modified == modified,
+                         records.c.record_id > record_id)))
+        self._filter_sets(query,
+                          needed_sets or [],
+                          allowed_sets or [],
+                          disallowed_sets or [])
+
+        result = []
+        started = time.perf_counter()
+        for row in query.distinct().limit(batch_size).execute():
+            result.append({'id': row.record_id,
+                           'deleted': row.deleted,
+                           'modified': row.modified,
+                           'metadata_json': row.metadata})
+        QUERY_SECONDS.observe(('oai_export',), time.perf_counter() - started)
+        QUERY_ROWS.inc(('oai_export',), len(result))
+        setrefs = self.get_setrefs_many([record['id'] for record in result])
+        for record in result:
+            record['sets'] = setrefs.get(record['id'], [])
+        return result
 
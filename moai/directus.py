@@ -5,6 +5,8 @@ import re
 from sqlalchemy.engine import make_url
 
 from jhn.directus.client import Directus
+
+from moai.querylog import QueryLog
 DIRECTUS_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DIRECTUS_API_PATTERN = '(directus://)((https?://)?(.*))'
 
@@ -22,7 +24,8 @@ class DirectusProvider:
                 f'{dburi}: Invalid Directus API URL given, should be of pattern {DIRECTUS_API_PATTERN}')
 
         self.sql_url = make_url(match.group(3))
-        self.directus = Directus(config['directus_url'], access_token=config['directus_access_token'])
+        self.directus = QueryLog.from_config(config).timed_client(
+            Directus(config['directus_url'], access_token=config['directus_access_token']))
 
     def get_record(self, oai_id):
         recs = self.directus.get_items("items", item_id=oai_id)
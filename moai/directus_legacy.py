@@ -13,6 +13,7 @@ from urllib3.util import parse_url
 from urllib3.util.retry import Retry
 
 from moai.utils import check_type, ProgressBar
+from moai.querylog import QueryLog
 
 DIRECTUS_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 DIRECTUS_API_PATTERN = '(directus://)((https?://)?(.*))'
@@ -31,6 +32,7 @@ class Directus:
                 f'{dburi}: Invalid Directus API URL given, should be of pattern {DIRECTUS_API_PATTERN}')
 
         self._reset_cache()
+        self._query_log = QueryLog.from_config(config)
 
         self.direct_db = match.group(3) is None
         self.url = match.group(2)
@@ -51,6 +53,7 @@ class Directus:
             )
             self.session.mount(
                 f'{parse_url(self.url).scheme}://', HTTPAdapter(max_retries=retry))
+            self.session.hooks['response'].append(self._query_log.response_hook)
             self._is_first_flush = True
 
             self.staticToken = False
@@ -64,6 +67,7 @@ class Directus:
 
     def _db(self):
         engine = sql.create_engine(self.url)
+        self._query_log.listen(engine)
         db = sql.MetaData(engine)
 
         sql.Table('records', db,
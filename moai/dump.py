@@ -0,0 +1,176 @@
+"""
+moai.dump
+=========
+
+Writes all visible records of a feed in one metadata format to a
+directory, as gzip compressed OAI-PMH ListRecords documents of a fixed
+number of records each, and a `manifest-<prefix>.json` that lists the
+files. Dumps of several metadata formats can share a directory.
+
+The records are read from the database in batches (in modified, id
+order) and rendered by a pool of processes (see :mod:`moai.render`),
+so the memory use does not depend on the size of the feed. The files
+can be served as static files by any web server.
+
+A dump can replace an earlier dump in the same directory while it is
+being downloaded. The file names contain the id of the dump (the time
+it was started), so the files of the earlier dump are not overwritten,
+and the manifest is replaced last. The files of the earlier dump are
+kept until the next dump (consumers may still be downloading them),
+older files of the format are removed.
+
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+import datetime
+
+from oaipmh.datestamp import datetime_to_datestamp
+
+from moai.oai import OAIServerFactory
+from moai.render import RenderPool
+
+# the name of the manifest of the dump of a metadata format
+MANIFEST = 'manifest-%s.json'
+
+def iter_records(db, config, until_date, batch_size=1000,
+                 oai_server=None, prefix=None):
+    """Yields all visible records of a feed in (modified, id) order,
+    reading batch_size records at a time. With an oai_server the stored
+    metadata XML of a passthrough format is added to the records, and
+    the writer of the format prefetches its related data per batch."""
+    after = None
+    while True:
+        records = db.oai_export(after=after,
+                                batch_size=batch_size,
+                                needed_sets=config.sets_needed,
+                                disallowed_sets=config.sets_disallowed,
+                                allowed_sets=config.sets_allowed,
+                                until_date=until_date)
+        for record in records:
+            record['metadata'] = json.loads(record.pop('metadata_json'))
+        if oai_server is not None:
+            records = list(oai_server._prepareRecords(records, prefix))
+        for record in records:
+            yield record
+        if len(records) < batch_size:
+            break
+        after = (records[-1]['modified'], records[-1]['id'])
+
+def dump_feed(db, config, prefix, directory, records_per_file=10000,
+              jobs=None, compresslevel=6, batch_size=1000):
+    """Dump the records of a feed, returns the manifest. The records
+    are rendered by jobs processes (by default one per cpu), with
+    jobs=1 they are rendered in this process."""
+    if prefix not in config.metadata_prefixes:
+        raise ValueError('Metadata format %s is not available in feed %s' % (
+            prefix, config.name))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # the dump is a snapshot of the feed at the time it is started
+    until_date = datetime.datetime.utcnow().replace(microsecond=0)
+    if config.delay:
+        until_date -= datetime.timedelta(seconds=float(config.delay))
+
+    dump_id = _dump_id(directory, prefix, until_date)
+
+    streaming_server = OAIServerFactory(db, config)
+    oai_server = streaming_server._server
+    kw = {'metadataPrefix': prefix}
+    results = (oai_server._createHeaderAndMetadata(record) + (None,)
+               for record in iter_records(db, config, until_date, batch_size,
+                                          oai_server, prefix))
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        fragments = (streaming_server._render('ListRecords', kw, result)
+                     for result in results)
+    else:
+        pool = RenderPool('process', jobs, threshold=0, db=db, config=config)
+        fragments = pool.render(streaming_server._render, 'ListRecords', kw,
+                                results)
+
+    manifest = {'name': config.name,
+                'url': config.url,
+                'metadataPrefix': prefix,
+                'until': datetime_to_datestamp(until_date),
+                'dump': dump_id,
+                'records': 0,
+                'files': []}
+    head, tail = streaming_server._envelope('ListRecords', kw)
+    stream = None
+    for fragment in fragments:
+        if stream is None:
+            filename = '%s-%s-%05d.xml.gz' % (prefix, dump_id,
+                                              len(manifest['files']) + 1)
+            stream = gzip.open(os.path.join(directory, filename + '.tmp'),
+                               'wb', compresslevel)
+            stream.write(head)
+            count = 0
+        stream.write(fragment)
+        count += 1
+        if count == records_per_file:
+            _close_file(stream, tail, directory, filename, count, manifest)
+            stream = None
+    if stream is not None:
+        _close_file(stream, tail, directory, filename, count, manifest)
+
+    # the files have new names and the manifest is replaced last, so
+    # consumers see either the earlier dump or this one
+    path = os.path.join(directory, MANIFEST % prefix)
+    previous = _read_manifest(path)
+    with open(path + '.tmp', 'w') as stream:
+        json.dump(manifest, stream, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    keep = set([entry['name'] for entry in manifest['files']])
+    if previous is not None:
+        keep.update([entry['name'] for entry in previous.get('files', [])])
+    _remove_files(directory, prefix, keep)
+    return manifest
+
+def _dump_id(directory, prefix, until_date):
+    # the time the dump is started, with a number added when the
+    # directory already has files of a dump started in the same second
+    dump_id = until_date.strftime('%Y%m%d%H%M%S')
+    names = os.listdir(directory)
+    num = 1
+    while [name for name in names
+           if name.startswith('%s-%s-' % (prefix, dump_id))]:
+        num += 1
+        dump_id = '%s.%d' % (until_date.strftime('%Y%m%d%H%M%S'), num)
+    return dump_id
+
+def _read_manifest(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except ValueError:
+        return None
+
+def _remove_files(directory, prefix, keep):
+    # removes the dump files of a format that are not in keep, and
+    # temporary files of dumps that did not finish
+    pattern = re.compile(r'^%s-([0-9.]+-)?\d+\.xml\.gz(\.tmp)?$' %
+                         re.escape(prefix))
+    for name in os.listdir(directory):
+        if pattern.match(name) and name not in keep:
+            os.remove(os.path.join(directory, name))
+
+def _close_file(stream, tail, directory, filename, count, manifest):
+    stream.write(tail)
+    stream.close()
+    path = os.path.join(directory, filename)
+    os.replace(path + '.tmp', path)
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(65536), b''):
+            checksum.update(block)
+    manifest['files'].append({'name': filename,
+                              'records': count,
+                              'size': os.path.getsize(path),
+                              'sha256': checksum.hexdigest()})
+    manifest['records'] += count
@@ -0,0 +1,80 @@
+"""
+moai.export
+===========
+
+Bulk export of the stored records as newline delimited json (NDJSON)
+or as a json array, for trusted consumers that need the metadata in
+the MOAI json format and not as OAI-PMH XML.
+
+The stored metadata is passed on as it is stored, without decoding it
+or rendering any XML. Records are returned in (modified, id) order, a
+response contains at most `limit` records and the opaque cursor of the
+next page is returned in the `X-Next-Cursor` header.
+
+"""
+import json
+import base64
+import binascii
+import datetime
+
+from oaipmh.datestamp import datestamp_to_datetime, datetime_to_datestamp
+
+FORMATS = {'ndjson': 'application/x-ndjson',
+           'json': 'application/json'}
+
+def encode_cursor(record):
+    """Returns the cursor that continues after a record"""
+    key = json.dumps([record['modified'].isoformat(), record['id']])
+    return base64.urlsafe_b64encode(key.encode('utf8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Returns the (modified, id) key of a cursor, raises ValueError
+    for an invalid cursor"""
+    try:
+        modified, record_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+        return datetime.datetime.fromisoformat(modified), record_id
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor: %s' % cursor)
+
+def parse_date(value, inclusive=False):
+    """Returns the datetime of a datestamp argument, raises ValueError
+    for invalid dates. With inclusive a day is extended to its end, as
+    for the until argument of OAI-PMH"""
+    if not value:
+        return None
+    try:
+        return datestamp_to_datetime(value, inclusive)
+    except Exception:
+        raise ValueError('Invalid date: %s' % value)
+
+def record_line(record, sets_deleted=()):
+    """Returns the json of a record as bytes, the stored metadata
+    json is inserted as it is"""
+    deleted = bool(record['deleted'])
+    for setspec in record['sets']:
+        if setspec in sets_deleted:
+            deleted = True
+            break
+    header = json.dumps({'id': record['id'],
+                         'modified': datetime_to_datestamp(record['modified']),
+                         'deleted': deleted,
+                         'sets': record['sets']}, sort_keys=True)
+    metadata = 'null'
+    if not deleted:
+        metadata = record['metadata_json']
+    return ('%s, "metadata": %s}' % (header[:-1], metadata)).encode('utf8')
+
+def export_body(records, format='ndjson', sets_deleted=()):
+    """Returns an iterator with the response body for a list of
+    records"""
+    if format == 'json':
+        yield b'['
+        for num, record in enumerate(records):
+            if num:
+                yield b',\n'
+            yield record_line(record, sets_deleted)
+        yield b']\n'
+    else:
+        for record in records:
+            yield record_line(record, sets_deleted) + b'\n'
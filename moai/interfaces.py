@@ -179,6 +179,17 @@ class IReadOnlyDatabase(Interface):
         ]
         """
 
+    def oai_visible(id,
+                    needed_sets=[],
+                    disallowed_sets=[],
+                    allowed_sets=[],
+                    deleted_sets=[],
+                    until_date=None):
+        """Returns True if the record with this id exists, is not
+        deleted (or in one of the deleted_sets) and passes the same set
+        and date filters as oai_query. This should be a single cheap
+        query, it is used to check asset downloads.
+        """
         
     def get_record(id):
         """Returns a dictionary of data that is available from the
@@ -202,6 +213,12 @@ class IReadOnlyDatabase(Interface):
         If the id does not exist, None is returned
         """
 
+    def get_metadata_many(ids):
+        """Optional, returns a dictionary with the get_metadata output
+        of the records with these ids, by id, fetched at once. Ids that
+        do not exist are left out.
+        """
+
     def get_sets(id):
         """Returns a list of set ids for a specific id,
         """
@@ -228,6 +245,17 @@ class IReadOnlyDatabase(Interface):
         Where metadata is a dictionary with additional lists of string values
         """
 
+    def get_asset(id, name):
+        """Returns the dictionary describing the asset of a record with
+        the filename or md5 checksum name (see get_assets), or None.
+        """
+
+    def get_payloads(ids, prefix):
+        """Optional, returns a dictionary with the stored metadata XML
+        (bytes) of the records with these ids in the metadata format
+        prefix, by id. Records without stored XML are left out.
+        """
+
 class IDatabase(IReadOnlyDatabase):
 
     def flush_update():
@@ -317,12 +345,19 @@ class IServerRequest(Interface):
         """Return the current url
         """
 
+    def header(name, default=None):
+        """Return the value of a request header
+        """
+
     def redirect(url):
         """Redirect to this url
         """
 
-    def send_file(path):
-        """Send the file located at 'path' back to the user
+    def send_file(path, mimetype, ranges=False, size=None, mtime=None):
+        """Send the file located at 'path' back to the user, without
+        reading it into memory. Byte range requests are answered when
+        ranges is True. The stored size and (utc datetime) modification
+        time of the file can be given, so it is not checked again.
         """
 
     def query_dict():
@@ -330,12 +365,15 @@ class IServerRequest(Interface):
         request
         """
 
-    def write(data, mimetype):
-        """Write data back to the client
+    def write(data, mimetype, headers=None):
+        """Write data back to the client, data can also be an
+        iterator of strings that is streamed to the client.
+        headers is a dictionary with additional response headers
         """
 
-    def send_status(code, msg='', mimetype='text/plain'):
-        """Return a status code to the user
+    def send_status(code, msg='', mimetype='text/plain', headers=None):
+        """Return a status code to the user, optionally with a
+        dictionary of extra response headers
         """
 
 class IServer(Interface):
@@ -359,13 +397,24 @@ class IServer(Interface):
     def is_asset_url(url, config):
         """Is this url pointing to an asset (returns bool)
         """
+
+    def get_oai_server():
+        """Return the oai server for this feed, it is created by the
+        OAIServerFactory once and reused until the feed config changes
+        """
             
+    def meter(req, body, started, size=None):
+        """Return the body of the response to req, the request is added
+        to the metrics (see moai.metrics) when the body is sent, or right
+        away when the size of the body is known
+        """
+
     def handle_request(req):
         """Serve this request this method goes through the following steps:
         1. check if url is valid
         2. try to get ServerConfig for this url
         3. test if this is an asset url, if so check if download is allowed,
            and download asset
-        4. if not asset url, get the oai server through the OAIServerFactory
+        4. if not asset url, get the (shared) oai server with get_oai_server
         5. call the handleRequest method on the oai server, and return the result
         """
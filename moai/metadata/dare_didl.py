@@ -1,7 +1,8 @@
 
-from lxml.builder import ElementMaker
+from lxml import etree
 
 from moai.metadata.didl import DIDL, XSI_NS
+from moai.metadata.mods import sub
         
 class DareDIDL(DIDL):
     """A metadata prefix implementing the DARE DIDL metadata format
@@ -18,15 +19,11 @@ class DareDIDL(DIDL):
         super(DareDIDL, self).__call__(element, metadata)
         data = metadata.record
 
-        DIDL = ElementMaker(namespace=self.ns['didl'], nsmap=self.ns)
-        DII = ElementMaker(namespace=self.ns['dii'])
-        DIP = ElementMaker(namespace=self.ns['dip'])
-        
-        didl_item = element.getchildren()[0].getchildren()[0]
+        didl_item = element[0][0]
 
-        didl_item.insert(0, 
-           DIDL.Descriptor(
-            DIDL.Statement(
-            DII.Identifier(data['metadata'].get('dare_id', [''])[0]),
-            mimeType="application/xml")
-            ))
+        descriptor = etree.Element(self._didl.Descriptor)
+        statement = sub(descriptor, self._didl.Statement,
+                        mimeType="application/xml")
+        sub(statement, self._dii.Identifier,
+            data['metadata'].get('dare_id', [''])[0])
+        didl_item.insert(0, descriptor)
@@ -1,7 +1,12 @@
 
-from lxml.builder import ElementMaker
+from lxml import etree
 
-from moai.metadata.mods import NL_MODS, XSI_NS
+from moai.metadata.mods import NL_MODS, XSI_NS, Tags, sub
+
+ACCESS_RIGHTS = {
+    'open': 'http://purl.org/eprint/accessRights/OpenAccess',
+    'restricted': 'http://purl.org/eprint/accessRights/RestrictedAccess',
+    'closed': 'http://purl.org/eprint/accessRights/ClosedAccess'}
 
         
 class DIDL(object):
@@ -28,6 +33,27 @@ class DIDL(object):
         self.schemas = {'didl':'http://standards.iso.org/ittf/PubliclyAvailableStandards/MPEG-21_schema_files/did/didl.xsd',
                         'dii': 'http://standards.iso.org/ittf/PubliclyAvailableStandards/MPEG-21_schema_files/dii/dii.xsd',
                         'dip': 'http://standards.iso.org/ittf/PubliclyAvailableStandards/MPEG-21_schema_files/dip/dip.xsd'}
+
+        # the tags, attributes and the mods writer are the same for
+        # every record
+        self._didl = Tags(self.ns['didl'])
+        self._dii = Tags(self.ns['dii'])
+        self._rdf = Tags(self.ns['rdf'])
+        self._dcterms = Tags(self.ns['dcterms'])
+        self._semantics = dict(
+            (name, {'{%s}resource' % self.ns['rdf']:
+                    'info:eu-repo/semantics/%s' % name})
+            for name in ['descriptiveMetadata', 'objectFile',
+                         'humanStartPage'])
+        self._schema_location = (
+            '{%s}schemaLocation' % XSI_NS,
+            '%s %s %s %s %s %s' % (self.ns['didl'],
+                                   self.schemas['didl'],
+                                   self.ns['dii'],
+                                   self.schemas['dii'],
+                                   self.ns['dip'],
+                                   self.schemas['dip']))
+        self._mods = NL_MODS('mods', config, db)
         
     def get_namespace(self):
         return self.ns[self.prefix]
@@ -35,15 +61,18 @@ class DIDL(object):
     def get_schema_location(self):
         return self.schemas[self.prefix]
 
+    def prefetch(self, records):
+        # the related records are only used by the mods of the record
+        self._mods.prefetch(records)
+
         
     def __call__(self, element, metadata):
         data = metadata.record
-        
-        DIDL = ElementMaker(namespace=self.ns['didl'], nsmap=self.ns)
-        DII = ElementMaker(namespace=self.ns['dii'])
-        DIP = ElementMaker(namespace=self.ns['dip'])
-        RDF = ElementMaker(namespace=self.ns['rdf'])
-        DCTERMS = ElementMaker(namespace=self.ns['dcterms'])
+
+        DIDL = self._didl
+        RDF = self._rdf
+        DCTERMS = self._dcterms
+        xml = {'mimeType': 'application/xml'}
 
         oai_url = (self.config.url+'?verb=GetRecord&'
                    'metadataPrefix=%s&identifier=%s' % (
@@ -52,102 +81,52 @@ class DIDL(object):
 
         id_url = data['metadata'].get('url', [None])[0]        
 
+        didl = etree.Element(DIDL.DIDL, nsmap=self.ns)
+        root_item = sub(didl, DIDL.Item)
+        statement = sub(sub(root_item, DIDL.Descriptor), DIDL.Statement,
+                        **xml)
+        sub(statement, DCTERMS.modified,
+            data['modified'].isoformat().split('.')[0])
+        sub(sub(root_item, DIDL.Component), DIDL.Resource,
+            ref=id_url or oai_url, **xml)
+        item = sub(root_item, DIDL.Item)
+        statement = sub(sub(item, DIDL.Descriptor), DIDL.Statement, **xml)
+        sub(statement, RDF.type, **self._semantics['descriptiveMetadata'])
+        component = sub(item, DIDL.Component)
+        sub(sub(component, DIDL.Descriptor), DIDL.Statement, "mods",
+            mimeType="text/plain")
+
         # generate mods for this feed
-        mods_data = DIDL.Resource(mimeType="application/xml")
-        NL_MODS('mods', self.config, self.db)(mods_data, metadata)
+        mods_data = sub(component, DIDL.Resource, **xml)
+        self._mods(mods_data, metadata)
 
-        asset_data = []
+        # the objectFile type element is moved to the last asset item
+        object_file = etree.Element(RDF.type,
+                                    **self._semantics['objectFile'])
+        for asset in data['metadata'].get('asset', []):
+            url = asset['url']
+            if not url.startswith('http://'):
+                url = self.config.url.rstrip('/') + '/' + url.lstrip('/')
+            item = sub(root_item, DIDL.Item)
+            sub(sub(item, DIDL.Descriptor), DIDL.Statement,
+                **xml).append(object_file)
+            access = ACCESS_RIGHTS.get(asset.get('access'),
+                                       asset.get('access'))
+            if access:
+                sub(sub(sub(item, DIDL.Descriptor), DIDL.Statement, **xml),
+                    DCTERMS.accessRights, access)
+            for modified in asset.get('modified', []):
+                sub(sub(sub(item, DIDL.Descriptor), DIDL.Statement, **xml),
+                    DCTERMS.modified, modified)
+            sub(sub(item, DIDL.Component), DIDL.Resource,
+                mimeType=asset['mimetype'], ref=url)
 
-        descriptive_metadata = RDF.type()
-        descriptive_metadata.attrib['{%s}resource' % self.ns['rdf']] = (
-            'info:eu-repo/semantics/descriptiveMetadata')
-        
-        didl = DIDL.DIDL(
-            DIDL.Item(
-             DIDL.Descriptor(
-              DIDL.Statement(
-               DCTERMS.modified(data['modified'].isoformat().split('.')[0]),
-               mimeType="application/xml"
-               )
-              ),
-             DIDL.Component(
-              DIDL.Resource(ref=id_url or oai_url,mimeType="application/xml")
-              ),
-             DIDL.Item(
-              DIDL.Descriptor(
-               DIDL.Statement(descriptive_metadata, mimeType="application/xml")
-               ),
-              DIDL.Component(
-                DIDL.Descriptor(
-                   DIDL.Statement("mods", mimeType="text/plain")),
-                mods_data)
-              ),
-             )
-            )
-
-        object_file = RDF.type()
-        object_file.attrib['{%s}resource' % self.ns['rdf']] = (
-            'info:eu-repo/semantics/objectFile')
-        for root_item in didl:
-            for asset in data['metadata'].get('asset', []):
-                url = asset['url']
-                if not url.startswith('http://'):
-                    url = self.config.url.rstrip('/') + '/' + url.lstrip('/')
-                item = DIDL.Item(
-                    DIDL.Descriptor(
-                     DIDL.Statement(object_file, mimeType="application/xml")
-                     )
-                    )
-                access = asset.get('access')
-                if access == 'open':
-                    access = (
-                        'http://purl.org/eprint/accessRights/OpenAccess')
-                elif access == 'restricted':
-                    access = (
-                        'http://purl.org/eprint/accessRights/RestrictedAccess')
-                elif access == 'closed':
-                    access = (
-                        'http://purl.org/eprint/accessRights/ClosedAccess')
-                if access:
-                    item.append(
-                        DIDL.Descriptor(
-                        DIDL.Statement(DCTERMS.accessRights(access),
-                                       mimeType="application/xml")))
-                for modified in asset.get('modified', []):
-                    item.append(
-                        DIDL.Descriptor(
-                                DIDL.Statement(DCTERMS.modified(modified),
-                                               mimeType="application/xml")))
-                    
-                item.append(
-                    DIDL.Component(
-                     DIDL.Resource(mimeType=asset['mimetype'],
-                                   ref=url)
-                     )
-                    )
-
-                root_item.append(item)
-            break
-        
-        human_start_page = RDF.type()
-        human_start_page.attrib['{%s}resource' % self.ns['rdf']] = (
-            'info:eu-repo/semantics/humanStartPage')
         if data['metadata'].get('url'):
-             item = DIDL.Item(
-                 DIDL.Descriptor(
-                  DIDL.Statement(human_start_page, mimeType="application/xml")
-                  ),
-                 DIDL.Component(
-                  DIDL.Resource(mimeType="text/html", ref=data['metadata']['url'][0])
-                 )
-                )
-             root_item.append(item)
-        
-        didl.attrib['{%s}schemaLocation' % XSI_NS] = (
-            '%s %s %s %s %s %s' % (self.ns['didl'],
-                                   self.schemas['didl'],
-                                   self.ns['dii'],
-                                   self.schemas['dii'],
-                                   self.ns['dip'],
-                                   self.schemas['dip']))
+            item = sub(root_item, DIDL.Item)
+            sub(sub(sub(item, DIDL.Descriptor), DIDL.Statement, **xml),
+                RDF.type, **self._semantics['humanStartPage'])
+            sub(sub(item, DIDL.Component), DIDL.Resource,
+                mimeType="text/html", ref=data['metadata']['url'][0])
+
+        didl.attrib[self._schema_location[0]] = self._schema_location[1]
         element.append(didl)
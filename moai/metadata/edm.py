@@ -6,12 +6,194 @@ from collections import OrderedDict
 
 
 XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
-  
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+# the order of the properties of the EDM classes, properties that are
+# not listed keep their order and come first
+EDM_PROVIDER_CHO_ORDER = [
+    "dc:contributor",
+    "dc:coverage",
+    "dc:creator",
+    "dc:date",
+    "dc:description",
+    "dc:format",
+    "dc:identifier",
+    "dc:language",
+    "dc:publisher",
+    "dc:relation",
+    "dc:rights",
+    "dc:source",
+    "dc:subject",
+    "dc:title",
+    "dc:type",
+    "dcterms:alternative",
+    "dcterms:conformsTo",
+    "dcterms:created",
+    "dcterms:extent",
+    "dcterms:hasFormat",
+    "dcterms:hasPart",
+    "dcterms:hasVersion",
+    "dcterms:isFormatOf",
+    "dcterms:isPartOf",
+    "dcterms:isReferencedBy",
+    "dcterms:isReplacedBy",
+    "dcterms:isRequiredBy",
+    "dcterms:issued",
+    "dcterms:isVersionOf",
+    "dcterms:medium",
+    "dcterms:provenance",
+    "dcterms:references",
+    "dcterms:replaces",
+    "dcterms:requires",
+    "dcterms:spatial",
+    "dcterms:tableOfContents",
+    "dcterms:temporal",
+    "edm:currentLocation",
+    "edm:hasMet",
+    "edm:hasType",
+    "edm:incorporates",
+    "edm:isDerivativeOf",
+    "edm:isNextInSequence",
+    "edm:isRelatedTo",
+    "edm:isRepresentationOf",
+    "edm:isSimilarTo",
+    "edm:isSuccessorOf",
+    "edm:realizes",
+    "edm:type",
+    "owl:sameAs",
+]
+WEB_RESOURCE_ORDER = [
+    "dc:creator",
+    "dc:description",
+    "dc:format",
+    "dc:rights",
+    "dc:source",
+    "dc:type",
+    "dcterms:confromsTo",
+    "dcterms:created",
+    "dcterms:extent",
+    "dcterms:hasPart",
+    "dcterms:isFormatOf",
+    "dcterms:isPartOf",
+    "dcterms:isReferencedBy",
+    "dcterms:issued",
+    "edm:isNextInSequence",
+    "edm:rights",
+    "owl:sameAs",
+    "svcs:has_service",
+]
+ORE_AGG_ORDER = [
+    "edm:aggregatedCHO",
+    "edm:dataProvider",
+    "edm:hasView",
+    "edm:isShownAt",
+    "edm:isShownBy",
+    "edm:object",
+    "edm:provider",
+    "dc:rights",
+    "edm:rights",
+    "edm:ugc",
+]
+EDM_AGENT_ORDER = [
+    "skos:prefLabel",
+    "skos:altLabel",
+    "skos:note",
+    "dc:date",
+    "dc:identifier",
+    "dcterms:hasPart",
+    "dcterms:isPartOf",
+    "edm:begin",
+    "edm:end",
+    "edm:hasMet",
+    "edm:isRelatedTo",
+    "foaf:name",
+    "rdaGr2:biographicalInformation",
+    "rdaGr2:dateOfBirth",
+    "rdaGr2:dateOfDeath",
+    "rdaGr2:dateOfEstablishment",
+    "rdaGr2:dateOfTermincation",
+    "rdaGr2:gender",
+    "rdaGr2:placeOfBirth",
+    "rdaGr2:placeOfDeath",
+    "rdaGr2:professionOrOccupation",
+    "owl:sameAs",
+]
+EDM_PLACE_ORDER = [
+    "wgs84_pos:lat",
+    "wgs84_pos:long",
+    "wgs84_pos:alt",
+    "skos:prefLabel",
+    "skos:altLabel",
+    "skos:note",
+    "dcterms:hasPart",
+    "dcterms:isPartOf",
+    "edm:isNextInSequence",
+    "owl:sameAs",
+]
+EDM_TIMESPAN_ORDER = [
+    "skos:prefLabel",
+    "skos:altLabel",
+    "skos:note",
+    "dcterms:hasPart",
+    "dcterms:isPartOf",
+    "edm:begin",
+    "edm:end",
+    "edm:isNextInSequence",
+    "owl:sameAs",
+]
+SKOS_CONCEPT_ORDER = [
+    "skos:prefLael",
+    "skos:altLabel",
+    "skos:broader",
+    "skos:narrower",
+    "skos:related",
+    "skos:broadMatch",
+    "skos:narrowMatch",
+    "skos:relatedMatch",
+    "skos:exactMatch",
+    "skos:closeMatch",
+    "skos:note",
+    "skos:notation",
+    "skos:inScheme",
+]
+CC_LICENSE_ORDER = ["odrl:inheritFrom", "cc:depreceatedOn"]
+SVCS_SERVICE_ORDER = ["dcterms:conformsTo", "doap:implements"]
+
+RDF_KEY_ORDER_MAPPING = {
+    "edm:ProvidedCHO": EDM_PROVIDER_CHO_ORDER,
+    "edm:WebResource": WEB_RESOURCE_ORDER,
+    "ore:Aggregation": ORE_AGG_ORDER,
+    "edm:Agent": EDM_AGENT_ORDER,
+    "edm:Place": EDM_PLACE_ORDER,
+    "edm:TimeSpan": EDM_TIMESPAN_ORDER,
+    "skos:Concept": SKOS_CONCEPT_ORDER,
+    "cc:License": CC_LICENSE_ORDER,
+    "svcs:Service": SVCS_SERVICE_ORDER,
+}
+
+# {class: {property: position}}, a property that is listed twice is
+# put at its last position
+ORDER_RANKS = dict(
+    (rdf_key, dict((key, rank) for rank, key in enumerate(order)))
+    for rdf_key, order in RDF_KEY_ORDER_MAPPING.items())
+
+
+class _Unsupported(Exception):
+    # raised for metadata that the direct writer can not write exactly
+    # like xmltodict would, the record is written with xmltodict instead
+    pass
+
 class EDM(object):
     """The standard EDM metadata format.
     
 
-    It is registered under the name 'oai_dc'
+    It is registered under the name 'edm'
+
+    The stored metadata is the xmltodict representation of an rdf:RDF
+    document. It is written directly as an lxml tree, the output is the
+    same as unparsing it with xmltodict and parsing the result (which is
+    still done for metadata the direct writer does not support, like
+    nested namespace declarations).
     """
     
     def __init__(self, prefix, config, db):
@@ -37,6 +219,9 @@ class EDM(object):
                    }
         self.schemas = {
             'edm': 'http://www.europeana.eu/schemas/edm/EDM-EXTERNAL-MAIN.xsd'}
+        self._ns_attributes = [('@xmlns:%s' % prefix, ns)
+                               for prefix, ns in self.ns.items()]
+        self._qnames = {}
         
     def get_namespace(self):
         return self.ns[self.prefix]
@@ -45,170 +230,9 @@ class EDM(object):
         return self.schemas[self.prefix]
       
     def fix_ordering_of_edm_elements(self, rdf):
-        edm_provider_cho_order = [
-            "dc:contributor",
-            "dc:coverage",
-            "dc:creator",
-            "dc:date",
-            "dc:description",
-            "dc:format",
-            "dc:identifier",
-            "dc:language",
-            "dc:publisher",
-            "dc:relation",
-            "dc:rights",
-            "dc:source",
-            "dc:subject",
-            "dc:title",
-            "dc:type",
-            "dcterms:alternative",
-            "dcterms:conformsTo",
-            "dcterms:created",
-            "dcterms:extent",
-            "dcterms:hasFormat",
-            "dcterms:hasPart",
-            "dcterms:hasVersion",
-            "dcterms:isFormatOf",
-            "dcterms:isPartOf",
-            "dcterms:isReferencedBy",
-            "dcterms:isReplacedBy",
-            "dcterms:isRequiredBy",
-            "dcterms:issued",
-            "dcterms:isVersionOf",
-            "dcterms:medium",
-            "dcterms:provenance",
-            "dcterms:references",
-            "dcterms:replaces",
-            "dcterms:requires",
-            "dcterms:spatial",
-            "dcterms:tableOfContents",
-            "dcterms:temporal",
-            "edm:currentLocation",
-            "edm:hasMet",
-            "edm:hasType",
-            "edm:incorporates",
-            "edm:isDerivativeOf",
-            "edm:isNextInSequence",
-            "edm:isRelatedTo",
-            "edm:isRepresentationOf",
-            "edm:isSimilarTo",
-            "edm:isSuccessorOf",
-            "edm:realizes",
-            "edm:type",
-            "owl:sameAs",
-        ]
-        web_resource_order = [
-            "dc:creator",
-            "dc:description",
-            "dc:format",
-            "dc:rights",
-            "dc:source",
-            "dc:type",
-            "dcterms:confromsTo",
-            "dcterms:created",
-            "dcterms:extent",
-            "dcterms:hasPart",
-            "dcterms:isFormatOf",
-            "dcterms:isPartOf",
-            "dcterms:isReferencedBy",
-            "dcterms:issued",
-            "edm:isNextInSequence",
-            "edm:rights",
-            "owl:sameAs",
-            "svcs:has_service",
-        ]
-        ore_agg_order = [
-            "edm:aggregatedCHO",
-            "edm:dataProvider",
-            "edm:hasView",
-            "edm:isShownAt",
-            "edm:isShownBy",
-            "edm:object",
-            "edm:provider",
-            "dc:rights",
-            "edm:rights",
-            "edm:ugc",
-        ]
-        edm_agent_order = [
-            "skos:prefLabel",
-            "skos:altLabel",
-            "skos:note",
-            "dc:date",
-            "dc:identifier",
-            "dcterms:hasPart",
-            "dcterms:isPartOf",
-            "edm:begin",
-            "edm:end",
-            "edm:hasMet",
-            "edm:isRelatedTo",
-            "foaf:name",
-            "rdaGr2:biographicalInformation",
-            "rdaGr2:dateOfBirth",
-            "rdaGr2:dateOfDeath",
-            "rdaGr2:dateOfEstablishment",
-            "rdaGr2:dateOfTermincation",
-            "rdaGr2:gender",
-            "rdaGr2:placeOfBirth",
-            "rdaGr2:placeOfDeath",
-            "rdaGr2:professionOrOccupation",
-            "owl:sameAs",
-        ]
-        edm_place_order = [
-            "wgs84_pos:lat",
-            "wgs84_pos:long",
-            "wgs84_pos:alt",
-            "skos:prefLabel",
-            "skos:altLabel",
-            "skos:note",
-            "dcterms:hasPart",
-            "dcterms:isPartOf",
-            "edm:isNextInSequence",
-            "owl:sameAs",
-        ]
-        edm_timespan_order = [
-            "skos:prefLabel",
-            "skos:altLabel",
-            "skos:note",
-            "dcterms:hasPart",
-            "dcterms:isPartOf",
-            "edm:begin",
-            "edm:end",
-            "edm:isNextInSequence",
-            "owl:sameAs",
-        ]
-        skos_concept_order = [
-            "skos:prefLael",
-            "skos:altLabel",
-            "skos:broader",
-            "skos:narrower",
-            "skos:related",
-            "skos:broadMatch",
-            "skos:narrowMatch",
-            "skos:relatedMatch",
-            "skos:exactMatch",
-            "skos:closeMatch",
-            "skos:note",
-            "skos:notation",
-            "skos:inScheme",
-        ]
-        cc_license_order = ["odrl:inheritFrom", "cc:depreceatedOn"]
-        svcs_service_order = ["dcterms:conformsTo", "doap:implements"]
-
-        rdf_key_order_mapping = {
-            "edm:ProvidedCHO": edm_provider_cho_order,
-            "edm:WebResource": web_resource_order,
-            "ore:Aggregation": ore_agg_order,
-            "edm:Agent": edm_agent_order,
-            "edm:Place": edm_place_order,
-            "edm:TimeSpan": edm_timespan_order,
-            "skos:Concept": skos_concept_order,
-            "cc:License": cc_license_order,
-            "svcs:Service": svcs_service_order,
-        }
-
         for rdf_key in rdf.keys():
-            if rdf_key in rdf_key_order_mapping.keys():
-                for key in rdf_key_order_mapping[rdf_key]:
+            if rdf_key in RDF_KEY_ORDER_MAPPING.keys():
+                for key in RDF_KEY_ORDER_MAPPING[rdf_key]:
                     if isinstance(rdf[rdf_key], list):
                         for n, contextual_class in enumerate(rdf[rdf_key]):
                             if key in contextual_class.keys():
@@ -220,12 +244,156 @@ class EDM(object):
     def __call__(self, element, metadata):
         data = metadata.record
         if not data['metadata']: return
-        for prefix, ns in self.ns.items():
-            data['metadata']['rdf:RDF']['@xmlns:{}'.format(prefix)] = ns
-
-        data['metadata']['rdf:RDF'] = json.loads(json.dumps(data['metadata']['rdf:RDF']),object_pairs_hook=OrderedDict)
-        self.fix_ordering_of_edm_elements(data['metadata']['rdf:RDF'])
-        
-        metadata_unparsed = xmltodict.unparse(data['metadata'], full_document=False)
-        e = etree.fromstring(metadata_unparsed)
+        try:
+            e = self.build(data['metadata'])
+        except _Unsupported:
+            e = self.unparse(data['metadata'])
         element.append(e)
+
+    def unparse(self, metadata):
+        """Returns the rdf:RDF element of the metadata, written with
+        xmltodict"""
+        rdf = json.loads(json.dumps(metadata['rdf:RDF']),
+                         object_pairs_hook=OrderedDict)
+        for name, ns in self._ns_attributes:
+            rdf[name] = ns
+        self.fix_ordering_of_edm_elements(rdf)
+        metadata = OrderedDict(metadata)
+        metadata['rdf:RDF'] = rdf
+        metadata_unparsed = xmltodict.unparse(metadata, full_document=False)
+        return etree.fromstring(metadata_unparsed)
+
+    def build(self, metadata):
+        """Returns the rdf:RDF element of the metadata, built directly
+        with lxml"""
+        if len(metadata) != 1 or not isinstance(metadata.get('rdf:RDF'), dict):
+            raise _Unsupported()
+        rdf = dict(metadata['rdf:RDF'])
+        for name, ns in self._ns_attributes:
+            rdf[name] = ns
+        # the namespaces declared on rdf:RDF, an element in a namespace
+        # gets the first prefix that is declared for it
+        nsmap = {}
+        preferred = {}
+        for key, value in rdf.items():
+            if key.startswith('@xmlns:'):
+                if not isinstance(value, str) or not value:
+                    raise _Unsupported()
+                nsmap[key[7:]] = value
+                preferred.setdefault(value, key[7:])
+            elif key == '@xmlns':
+                raise _Unsupported()
+        # the tags of the names are kept for each list of declared
+        # namespaces, usually all records declare the same namespaces
+        key = tuple(nsmap.items())
+        names = self._qnames.get(key)
+        if names is None:
+            if len(self._qnames) >= 16:
+                self._qnames.clear()
+            names = self._qnames[key] = {}
+        def qname(name):
+            # the lxml tag of an element or attribute name
+            tag = names.get(name)
+            if tag is None:
+                prefix, colon, local = name.partition(':')
+                if not colon:
+                    tag = name
+                elif prefix == 'xml':
+                    tag = '{%s}%s' % (XML_NS, local)
+                else:
+                    ns = nsmap.get(prefix)
+                    if ns is None or preferred[ns] != prefix or ':' in local:
+                        raise _Unsupported()
+                    tag = '{%s}%s' % (ns, local)
+                names[name] = tag
+            return tag
+        try:
+            root = etree.Element(qname('rdf:RDF'), nsmap=nsmap)
+            self._fill(root, rdf, qname, True)
+        except ValueError:
+            # names or text that lxml does not accept
+            raise _Unsupported()
+        return root
+
+    def _fill(self, e, value, qname, is_rdf=False):
+        # add the attributes, children and text of a dict to an element,
+        # in the same way as xmltodict.unparse
+        text = None
+        children = []
+        for key, child in value.items():
+            if key == '#text':
+                text = child
+            elif key[:1] == '@':
+                if key.startswith('@xmlns') and not is_rdf:
+                    raise _Unsupported()
+                if key.startswith('@xmlns'):
+                    continue
+                e.set(qname(key[1:]), _string(child, ''))
+            elif key == '#comment':
+                raise _Unsupported()
+            elif isinstance(child, list) and not child:
+                continue
+            else:
+                children.append((key, child))
+        if is_rdf:
+            children = [(key, self._ordered(key, child))
+                        for key, child in children]
+        last = None
+        for key, child in children:
+            tag = qname(key)
+            if not isinstance(child, (list, tuple)):
+                child = [child]
+            for item in child:
+                last = etree.SubElement(e, tag)
+                if item.__class__ is str:
+                    if item:
+                        last.text = _text(item)
+                elif isinstance(item, dict):
+                    self._fill(last, item, qname)
+                elif item is not None:
+                    last.text = _text(_string(item))
+        if text is not None:
+            text = _text(_string(text))
+            if last is None:
+                e.text = text
+            else:
+                last.tail = text
+
+    def _ordered(self, rdf_key, value):
+        # the properties of an EDM class in the order of the schema
+        ranks = ORDER_RANKS.get(rdf_key)
+        if ranks is None:
+            return value
+        if isinstance(value, dict):
+            return _reorder(value, ranks)
+        if isinstance(value, list):
+            for item in value:
+                if not isinstance(item, dict):
+                    raise _Unsupported()
+            return [_reorder(item, ranks) for item in value]
+        raise _Unsupported()
+
+def _reorder(value, ranks):
+    return OrderedDict(sorted(value.items(),
+                              key=lambda item: ranks.get(item[0], -1)))
+
+def _string(value, default=None):
+    # the text of a value, like xmltodict converts it
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, (dict, list, tuple)):
+        raise _Unsupported()
+    return str(value)
+
+def _text(value):
+    # the text as it is after parsing: an xml parser normalizes line
+    # ends and an empty text is no text
+    if not value:
+        return None
+    if '\r' in value:
+        value = value.replace('\r\n', '\n').replace('\r', '\n')
+    return value
@@ -1,7 +1,12 @@
 
-from lxml.builder import ElementMaker
+from lxml import etree
 
 XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+DC_FIELDS = ['title', 'creator', 'subject', 'description',
+             'publisher', 'contributor', 'type', 'format',
+             'identifier', 'source', 'language', 'date',
+             'relation', 'coverage', 'rights']
   
 class OAIDC(object):
     """The standard OAI Dublin Core metadata format.
@@ -20,6 +25,14 @@ class OAIDC(object):
                    'dc':'http://purl.org/dc/elements/1.1/'}
         self.schemas = {
             'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc.xsd'}
+
+        # the tags and attributes are the same for every record
+        self._dc_tag = '{%s}dc' % self.ns['oai_dc']
+        self._dc_attrib = {'{%s}schemaLocation' % XSI_NS: '%s %s' % (
+            self.ns['oai_dc'],
+            self.schemas['oai_dc'])}
+        self._field_tags = [(field, '{%s}%s' % (self.ns['dc'], field))
+                            for field in DC_FIELDS]
         
     def get_namespace(self):
         return self.ns[self.prefix]
@@ -30,24 +43,13 @@ class OAIDC(object):
     def __call__(self, element, metadata):
 
         data = metadata.record
-        
-        OAI_DC =  ElementMaker(namespace=self.ns['oai_dc'],
-                               nsmap =self.ns)
-        DC = ElementMaker(namespace=self.ns['dc'])
-
-        oai_dc = OAI_DC.dc()
-        oai_dc.attrib['{%s}schemaLocation' % XSI_NS] = '%s %s' % (
-            self.ns['oai_dc'],
-            self.schemas['oai_dc'])
+        url = data['metadata'].get('url')
 
-        for field in ['title', 'creator', 'subject', 'description',
-                      'publisher', 'contributor', 'type', 'format',
-                      'identifier', 'source', 'language', 'date',
-                      'relation', 'coverage', 'rights']:
-            el = getattr(DC, field)
+        oai_dc = etree.Element(self._dc_tag, self._dc_attrib, nsmap=self.ns)
+        for field, tag in self._field_tags:
             for value in data['metadata'].get(field, []):
-                if field == 'identifier' and data['metadata'].get('url'):
-                    value = data['metadata']['url'][0]
-                oai_dc.append(el(value))
+                if field == 'identifier' and url:
+                    value = url[0]
+                etree.SubElement(oai_dc, tag).text = value
         
         element.append(oai_dc)
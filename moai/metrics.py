@@ -0,0 +1,252 @@
+"""
+moai.metrics
+============
+
+Counters and latency histograms of the feeds served by a process,
+exposed in the Prometheus text exposition format.
+
+The metrics are kept in a process wide :class:`Registry`, so the
+metrics page of a feed (enabled with the `metrics` option) shows the
+metrics of all feeds in the process, labelled with the feed name.
+Updating a metric takes a lock and a few dictionary operations, the
+times are measured with :func:`time.perf_counter`.
+
+Records that are rendered by a process render pool are not counted in
+the writer metrics, these are only kept in the server processes.
+
+"""
+import time
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# the verbs that are used as label, other requests are counted as 'other'
+VERBS = ('Identify', 'ListMetadataFormats', 'ListSets', 'ListIdentifiers',
+         'ListRecords', 'GetRecord', 'asset', 'export')
+
+# upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter(object):
+    """A counter with a value per combination of label values"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    """A histogram of observed values (usually durations in seconds)
+    per combination of label values"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # {labels: [count per bucket (and +Inf), sum]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (
+                    len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self._values.get(labels)
+        if counts is None:
+            return 0
+        return sum(counts[:-1])
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts))
+                            for labels, counts in self._values.items())
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield ('%s_bucket' % self.name,
+                       _format_labels(self.labelnames, labels,
+                                      ('le', _format_value(float(bound)))),
+                       total)
+            yield ('%s_sum' % self.name,
+                   _format_labels(self.labelnames, labels),
+                   counts[-1])
+            yield ('%s_count' % self.name,
+                   _format_labels(self.labelnames, labels),
+                   total)
+
+
+class Registry(object):
+    """A collection of metrics that is rendered as one page"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format, as bytes"""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return ('\n'.join(lines) + '\n').encode('utf8')
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'moai_requests_total',
+    'Requests handled, by feed and verb.',
+    ('feed', 'verb'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'moai_request_seconds',
+    'Time until the response of a request is completely sent.',
+    ('feed', 'verb'))
+RESPONSE_BYTES = REGISTRY.counter(
+    'moai_response_bytes_total',
+    'Bytes sent in response bodies (after compression).',
+    ('feed', 'verb'))
+CACHE_REQUESTS = REGISTRY.counter(
+    'moai_cache_requests_total',
+    'Lookups in the caches of a feed, by cache and result (hit or miss).',
+    ('feed', 'cache', 'result'))
+QUERY_SECONDS = REGISTRY.histogram(
+    'moai_query_seconds',
+    'Time to execute a database query for records.',
+    ('query',))
+QUERY_ROWS = REGISTRY.counter(
+    'moai_query_rows_total',
+    'Records fetched from the database.',
+    ('query',))
+WRITER_SECONDS = REGISTRY.histogram(
+    'moai_writer_seconds',
+    'Time to write the metadata of a record, by metadata format.',
+    ('format',))
+
+
+def request_verb(url, args):
+    """Returns the verb label of a request, url is the path relative to
+    the feed"""
+    if url.startswith('asset/'):
+        return 'asset'
+    if url.split('?')[0] == 'export':
+        return 'export'
+    verb = args.get('verb')
+    if verb in VERBS:
+        return verb
+    return 'other'
+
+def cache_lookup(feed, cache, hit):
+    CACHE_REQUESTS.inc((feed, cache, hit and 'hit' or 'miss'))
+
+
+class MeteredBody(object):
+    """Wraps a response body (an iterator of strings), counts the bytes
+    that are sent and observes the duration of the request when the
+    body is exhausted or closed"""
+
+    def __init__(self, data, labels, started):
+        self._data = data
+        self._labels = labels
+        self._started = started
+        self._size = 0
+        self._done = False
+
+    def __iter__(self):
+        for chunk in self._data:
+            self._size += len(chunk)
+            yield chunk
+        self.close()
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        if hasattr(self._data, 'close'):
+            self._data.close()
+        observe_request(self._labels, self._started, self._size)
+
+def observe_request(labels, started, size):
+    REQUESTS.inc(labels)
+    REQUEST_SECONDS.observe(labels, time.perf_counter() - started)
+    RESPONSE_BYTES.inc(labels, size)
+
+
+class TimedWriter(object):
+    """Wraps the metadata writer of a format, the time of every call is
+    observed"""
+
+    def __init__(self, prefix, writer):
+        self.prefix = prefix
+        self.writer = writer
+        self._labels = (prefix,)
+
+    def __call__(self, element, metadata):
+        started = time.perf_counter()
+        try:
+            return self.writer(element, metadata)
+        finally:
+            WRITER_SECONDS.observe(self._labels,
+                                   time.perf_counter() - started)
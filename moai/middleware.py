@@ -0,0 +1,470 @@
+"""
+moai.middleware
+===============
+
+WSGI middleware that protects the feeds served by a process from
+overload.
+
+:class:`AdmissionControl` limits the number of requests that are handled
+at the same time, and the number of requests of a single client. Requests
+over these limits wait in a bounded queue, when the queue is full (or
+the wait takes too long) they are rejected right away with a
+`503 Service Unavailable` response and a `Retry-After` header, so
+harvesters back off and the waiting time of admitted requests stays
+bounded.
+
+A request holds its slot until its response is completely sent, which
+matters for the streamed ListRecords responses.
+
+It can be added to a paste configuration as a filter::
+
+  [filter:admission]
+  use = egg:moai#admission
+  max_active = 8
+  max_queue = 32
+  max_per_client = 2
+
+:class:`Profiler` profiles a sample of the requests of a feed under real
+load: one in every `sample_rate` requests is profiled with cProfile, and
+the stacks of requests that take longer than `slow_threshold` seconds
+are sampled by a watchdog thread. The profiles are written to a
+directory, named after the feed, verb and metadata format of the request,
+and only the newest `max_files` profiles are kept::
+
+  [filter:profiler]
+  use = egg:moai#profiler
+  directory = /var/tmp/moai-profiles
+  sample_rate = 1000
+  slow_threshold = 5
+
+"""
+import os
+import re
+import sys
+import time
+import cProfile
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import parse_qs
+
+class AdmissionControl(object):
+    """Admission control and per client concurrency limits around a
+    WSGI application
+    """
+    def __init__(self,
+                 app,
+                 max_active=8,
+                 max_queue=32,
+                 max_per_client=2,
+                 queue_timeout=10,
+                 retry_after=30,
+                 trust_forwarded=False,
+                 stats_path=None):
+        self.app = app
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.trust_forwarded = trust_forwarded
+        self.stats_path = stats_path
+        self._condition = threading.Condition()
+        self._clients = {}
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def client(self, environ):
+        """Returns the address of the client of a request"""
+        if self.trust_forwarded:
+            forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+            if forwarded:
+                return forwarded.split(',')[0].strip()
+        return environ.get('REMOTE_ADDR', '')
+
+    def stats(self):
+        """Returns a dictionary with the current queue depth, the number
+        of active requests and the wait times in seconds"""
+        with self._condition:
+            return {'active': self.active,
+                    'waiting': self.waiting,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'wait_time_total': self.wait_time,
+                    'wait_time_max': self.max_wait_time}
+
+    def admit(self, client):
+        """Wait for a slot for a request of client, returns False if the
+        request should be rejected"""
+        starttime = time.time()
+        with self._condition:
+            if self._clients.get(client, 0) >= self.max_per_client:
+                self.rejected += 1
+                return False
+            if self.active >= self.max_active:
+                if self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                # the client counts as busy while it waits
+                self._clients[client] = self._clients.get(client, 0) + 1
+                self.waiting += 1
+                deadline = starttime + self.queue_timeout
+                try:
+                    while self.active >= self.max_active:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            break
+                        self._condition.wait(timeout)
+                finally:
+                    self.waiting -= 1
+                    self._clients[client] -= 1
+                if self.active >= self.max_active:
+                    self._forget(client)
+                    self.rejected += 1
+                    return False
+            waited = time.time() - starttime
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self._clients[client] = self._clients.get(client, 0) + 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self, client):
+        with self._condition:
+            self.active -= 1
+            self._clients[client] -= 1
+            self._forget(client)
+            self._condition.notify()
+
+    def _forget(self, client):
+        if not self._clients.get(client):
+            self._clients.pop(client, None)
+
+    def reject(self, start_response):
+        start_response('503 Service Unavailable',
+                       [('Content-Type', 'text/plain'),
+                        ('Retry-After', str(self.retry_after))])
+        return [b'The server is busy, please retry later']
+
+    def send_stats(self, start_response):
+        body = ''.join(['%s %s\n' % (name, value) for name, value in
+                        sorted(self.stats().items())]).encode('ascii')
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
+
+    def __call__(self, environ, start_response):
+        if self.stats_path and environ.get('PATH_INFO') == self.stats_path:
+            return self.send_stats(start_response)
+        client = self.client(environ)
+        if not self.admit(client):
+            return self.reject(start_response)
+        try:
+            result = self.app(environ, start_response)
+        except:
+            self.release(client)
+            raise
+        release = lambda: self.release(client)
+        if hasattr(result, 'filelike'):
+            # a wsgi.file_wrapper, the server only sends the file itself
+            # when it gets the wrapper back
+            try:
+                return release_on_close(result, release)
+            except AttributeError:
+                pass
+        return ReleasingIterable(result, release)
+
+
+class ReleasingIterable(object):
+    # wraps a response body, the slot of the request is released when
+    # the server closes it
+    def __init__(self, result, release):
+        self.result = result
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+def release_on_close(result, release):
+    """Returns the response body itself, release is called once when
+    the server closes it"""
+    close = getattr(result, 'close', None)
+    released = []
+    def releasing_close():
+        try:
+            if close is not None:
+                close()
+        finally:
+            if not released:
+                released.append(True)
+                release()
+    result.close = releasing_close
+    return result
+
+def filter_app_factory(app, global_config, **kwargs):
+    # Paste filter factory
+    return AdmissionControl(
+        app,
+        max_active=int(kwargs.get('max_active', 8)),
+        max_queue=int(kwargs.get('max_queue', 32)),
+        max_per_client=int(kwargs.get('max_per_client', 2)),
+        queue_timeout=float(kwargs.get('queue_timeout', 10)),
+        retry_after=int(kwargs.get('retry_after', 30)),
+        trust_forwarded=kwargs.get('trust_forwarded', 'false').lower() in (
+            'true', 'yes', 'on', '1'),
+        stats_path=kwargs.get('stats_path') or None)
+
+
+class Profiler(object):
+    """Profiles a sample of the requests to a WSGI application, and the
+    requests that are slow
+    """
+    def __init__(self,
+                 app,
+                 directory,
+                 sample_rate=1000,
+                 slow_threshold=None,
+                 sample_interval=0.01,
+                 max_files=100,
+                 name=None):
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.sample_interval = sample_interval
+        self.max_files = max_files
+        self.name = name
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._counter = itertools.count(1)
+        # only one request is profiled with cProfile at a time
+        self._profile_lock = threading.Lock()
+        # {request number: ProfiledRequest} of the watched requests
+        self._active = {}
+        self._active_lock = threading.Lock()
+        self._watchdog = None
+        self._wakeup = threading.Event()
+
+    def feed_name(self, environ):
+        """Returns the name of the feed that handles a request"""
+        if self.name:
+            return self.name
+        server = getattr(self.app, 'server', None)
+        config = getattr(server, '_config', None)
+        if config is not None:
+            return config.name
+        return environ.get('SCRIPT_NAME', '').strip('/') or 'moai'
+
+    def tags(self, environ):
+        """Returns the feed, verb and metadata format of a request"""
+        args = parse_qs(environ.get('QUERY_STRING', ''))
+        verb = args.get('verb', ['none'])[0]
+        prefix = args.get('metadataPrefix', [None])[0]
+        if prefix is None and 'resumptionToken' in args:
+            from moai.stream import decode_resumption_token
+            try:
+                kw, cursor = decode_resumption_token(
+                    args['resumptionToken'][0])
+                prefix = kw.get('metadataPrefix')
+            except Exception:
+                pass
+        return self.feed_name(environ), verb, prefix or 'none'
+
+    def __call__(self, environ, start_response):
+        number = next(self._counter)
+        profile = None
+        if self.sample_rate and number % self.sample_rate == 0:
+            if self._profile_lock.acquire(False):
+                profile = cProfile.Profile()
+        if profile is None and not self.slow_threshold:
+            return self.app(environ, start_response)
+        request = ProfiledRequest(self, number, environ, profile)
+        if profile is None:
+            self.watch(request)
+        try:
+            result = request.run(self.app, environ, start_response)
+        except:
+            request.finish()
+            raise
+        if hasattr(result, 'filelike'):
+            # a wsgi.file_wrapper, the server sends the file itself
+            if profile is None:
+                request.finish()
+                return result
+            # a profile is written when the server closes it
+            try:
+                return release_on_close(result, request.finish)
+            except AttributeError:
+                pass
+        return ProfiledIterable(result, request)
+
+    def watch(self, request):
+        with self._active_lock:
+            self._active[request.number] = request
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch,
+                                                  name='moai-profiler')
+                self._watchdog.daemon = True
+                self._watchdog.start()
+        self._wakeup.set()
+
+    def unwatch(self, request):
+        with self._active_lock:
+            self._active.pop(request.number, None)
+
+    def _watch(self):
+        # samples the stacks of the requests that are slower than the
+        # threshold, sleeps while no requests are active
+        while True:
+            with self._active_lock:
+                requests = list(self._active.values())
+                if not requests:
+                    self._wakeup.clear()
+            if not requests:
+                self._wakeup.wait()
+                continue
+            now = time.time()
+            frames = sys._current_frames()
+            for request in requests:
+                if now - request.started < self.slow_threshold:
+                    continue
+                frame = frames.get(request.thread)
+                if frame is not None:
+                    request.stacks[_folded_stack(frame)] += 1
+            del frames
+            time.sleep(self.sample_interval)
+
+    def save(self, request, duration):
+        """Write the profile of a request, and remove the oldest
+        profiles"""
+        feed, verb, prefix = self.tags(request.environ)
+        name = '%s-%06d-%s-%s-%s-%dms' % (
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime(request.started)),
+            request.number % 1000000,
+            _safe_name(feed), _safe_name(verb), _safe_name(prefix),
+            duration * 1000)
+        if request.profile is not None:
+            path = os.path.join(self.directory, name + '.prof')
+            request.profile.dump_stats(path + '.tmp')
+        else:
+            path = os.path.join(self.directory, name + '.folded')
+            with open(path + '.tmp', 'w') as stream:
+                for stack, count in sorted(request.stacks.items()):
+                    stream.write('%s %d\n' % (stack, count))
+        os.replace(path + '.tmp', path)
+        self.rotate()
+
+    def rotate(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(('.prof', '.folded')))
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class ProfiledRequest(object):
+    # a request that is profiled with cProfile, or watched by the stack
+    # sampler of the profiler
+    def __init__(self, profiler, number, environ, profile=None):
+        self.profiler = profiler
+        self.number = number
+        self.environ = environ
+        self.profile = profile
+        self.started = time.time()
+        self.thread = threading.get_ident()
+        self.stacks = Counter()
+        self._finished = False
+
+    def run(self, function, *args):
+        # the request can be handled by more than one thread, when its
+        # body is sent by another thread than the one that called the
+        # application
+        self.thread = threading.get_ident()
+        if self.profile is None:
+            return function(*args)
+        self.profile.enable()
+        try:
+            return function(*args)
+        finally:
+            self.profile.disable()
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        duration = time.time() - self.started
+        profiler = self.profiler
+        if self.profile is not None:
+            try:
+                profiler.save(self, duration)
+            finally:
+                profiler._profile_lock.release()
+        else:
+            profiler.unwatch(self)
+            if self.stacks:
+                profiler.save(self, duration)
+
+
+class ProfiledIterable(object):
+    # wraps the body of a profiled request, the profile is finished
+    # when the server closes it
+    def __init__(self, result, request):
+        self.result = result
+        self.request = request
+
+    def __iter__(self):
+        iterator = iter(self.result)
+        while True:
+            chunk = self.request.run(next, iterator, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.request.finish()
+
+def _folded_stack(frame):
+    # the stack of a frame in the folded format of flame graph tools
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _safe_name(value):
+    return re.sub(r'[^A-Za-z0-9_.]+', '_', str(value))[:40]
+
+def profiler_filter_app_factory(app, global_config, **kwargs):
+    # Paste filter factory
+    slow_threshold = kwargs.get('slow_threshold')
+    return Profiler(
+        app,
+        kwargs['directory'],
+        sample_rate=int(kwargs.get('sample_rate', 1000)),
+        slow_threshold=slow_threshold and float(slow_threshold) or None,
+        sample_interval=float(kwargs.get('sample_interval', 0.01)),
+        max_files=int(kwargs.get('max_files', 100)),
+        name=kwargs.get('name') or None)
@@ -1,8 +1,6 @@
-from pkg_resources import iter_entry_points
-
 from datetime import datetime
-import pkg_resources
 import time
+import itertools
 
 import oaipmh
 import oaipmh.metadata
@@ -10,11 +8,46 @@ import oaipmh.server
 import oaipmh.error
 from oaipmh.common import Header, Metadata
 
+from moai.plugins import get_plugin, get_version
+from moai.stream import StreamingServer
+from moai.render import RenderPool
+from moai.metrics import TimedWriter
+from moai.passthrough import PassthroughWriter
+
 def get_writer(prefix, config, db):
-    for writer in iter_entry_points(group='moai.format', name=prefix):
-        return writer.load()(prefix, config, db)
-    else:
+    writer = get_plugin('moai.format', prefix)
+    if writer is None:
         raise ValueError('No such metadata format registered: %s' % prefix)
+    return writer(prefix, config, db)
+
+
+_toolkit_description = None
+
+def toolkit_description():
+    """Returns the toolkit description XML used in the Identify
+    response, it only depends on the installed versions so it is
+    built once"""
+    global _toolkit_description
+    if _toolkit_description is None:
+        version = ''
+        pyoai_version = get_version('pyoai')
+        moai_version = get_version('MOAI')
+        
+        if moai_version and pyoai_version:
+            version = '<version>%s (using pyoai%s)</version>' % (
+                moai_version,
+                pyoai_version)
+        _toolkit_description = (
+            '<toolkit xsi:schemaLocation='
+            '"http://oai.dlib.vt.edu/OAI/metadata/toolkit '
+            'http://oai.dlib.vt.edu/OAI/metadata/toolkit.xsd" '
+            'xmlns="http://oai.dlib.vt.edu/OAI/metadata/toolkit" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            '<title>MOAI</title>'
+            '%s'
+            '<URL>http://moai.infrae.com</URL>'
+            '</toolkit>' % version)
+    return _toolkit_description
 
 
 class OAIServer(object):
@@ -23,9 +56,21 @@ class OAIServer(object):
     Underlying code is based on pyoai's oaipmh.server'
     """
     
-    def __init__(self, db, config):
+    # the maximum number of records that are prepared at once
+    prepare_size = 50
+
+    def __init__(self, db, config, writers=None):
         self.db = db
         self.config = config
+        self.writers = writers or {}
+
+    def get_writer(self, prefix):
+        writer = self.writers.get(prefix)
+        if writer is None:
+            writer = self.writers[prefix] = get_writer(prefix,
+                                                       self.config,
+                                                       self.db)
+        return writer
 
     def identify(self):
         result = oaipmh.common.Identify(
@@ -36,36 +81,17 @@ class OAIServer(object):
             earliestDatestamp=self.db.oai_earliest_datestamp(),
             deletedRecord='transient',
             granularity='YYYY-MM-DDThh:mm:ssZ',
-            compression=['identity'],
+            compression=self.config.compression or ['identity'],
             toolkit_description=False)
 
-        version = ''
-        pyoai_egg = pkg_resources.working_set.find(
-            pkg_resources.Requirement.parse('pyoai'))
-        moai_egg = pkg_resources.working_set.find(
-            pkg_resources.Requirement.parse('MOAI'))
-        
-        if moai_egg and pyoai_egg:
-            version = '<version>%s (using pyoai%s)</version>' % (
-                moai_egg.version,
-                pyoai_egg.version)
-        result.add_description(
-            '<toolkit xsi:schemaLocation='
-            '"http://oai.dlib.vt.edu/OAI/metadata/toolkit '
-            'http://oai.dlib.vt.edu/OAI/metadata/toolkit.xsd" '
-            'xmlns="http://oai.dlib.vt.edu/OAI/metadata/toolkit" '
-            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
-            '<title>MOAI</title>'
-            '%s'
-            '<URL>http://moai.infrae.com</URL>'
-            '</toolkit>' % version)
+        result.add_description(toolkit_description())
             
         return result
 
     def listMetadataFormats(self, identifier=None):
         result = []
         for prefix in self.config.metadata_prefixes:
-            writer = get_writer(prefix, self.config, self.db)
+            writer = self.get_writer(prefix)
             ns = writer.get_namespace()
             schema = writer.get_schema_location()
             result.append((prefix, schema, ns))
@@ -79,7 +105,8 @@ class OAIServer(object):
                     cursor=0, batch_size=10):
         
         self._checkMetadataPrefix(metadataPrefix)
-        for record in self._listQuery(set, from_, until, cursor, batch_size):
+        records = self._listQuery(set, from_, until, cursor, batch_size)
+        for record in self._prepareRecords(records, metadataPrefix):
             header, metadata = self._createHeaderAndMetadata(record)
             yield header, metadata, None
 
@@ -94,7 +121,8 @@ class OAIServer(object):
         self._checkMetadataPrefix(metadataPrefix)
         header = None
         metadata = None
-        for record in self._listQuery(identifier=identifier):
+        records = self._listQuery(identifier=identifier)
+        for record in self._prepareRecords(records, metadataPrefix):
             header, metadata = self._createHeaderAndMetadata(record)
         if header is None:
             raise oaipmh.error.IdDoesNotExistError(identifier)
@@ -104,6 +132,48 @@ class OAIServer(object):
         if metadataPrefix not in self.config.metadata_prefixes:
             raise oaipmh.error.CannotDisseminateFormatError
 
+    def _prepareRecords(self, records, metadataPrefix):
+        # adds the stored metadata XML of a passthrough format, and lets
+        # the writer prefetch what it needs for the records. This is done
+        # for a chunk of records at a time, so a streamed page is not read
+        # completely before its first record is sent
+        prefetch = getattr(self.get_writer(metadataPrefix), 'prefetch', None)
+        if prefetch is None and metadataPrefix not in self.config.passthrough:
+            return records
+        return self._prepareChunks(records, metadataPrefix, prefetch)
+
+    def _prepareChunks(self, records, metadataPrefix, prefetch):
+        # the first chunk has one record, the size doubles up to
+        # prepare_size, so the first record is sent right away
+        records = iter(records)
+        size = 1
+        while True:
+            chunk = list(itertools.islice(records, size))
+            if not chunk:
+                break
+            size = min(size * 2, self.prepare_size)
+            chunk = self._addPayloads(chunk, metadataPrefix)
+            if prefetch is not None:
+                prefetch([record for record in chunk
+                          if not record['deleted'] and
+                          record.get('payload') is None])
+            for record in chunk:
+                yield record
+
+    def _addPayloads(self, records, metadataPrefix):
+        # the stored metadata XML of the records, for a passthrough
+        # format it is used instead of the metadata writer
+        get_payloads = getattr(self.db, 'get_payloads', None)
+        if (metadataPrefix not in self.config.passthrough or
+            get_payloads is None):
+            return records
+        records = list(records)
+        payloads = get_payloads([record['id'] for record in records
+                                 if not record['deleted']], metadataPrefix)
+        for record in records:
+            record['payload'] = payloads.get(record['id'])
+        return records
+
     def _createHeader(self, record):
         deleted = record['deleted']
         for setspec in record['sets']:
@@ -120,6 +190,7 @@ class OAIServer(object):
         header = self._createHeader(record)
         metadata = oaipmh.common.Metadata(record, record['metadata'])
         metadata.record = record
+        metadata.payload = record.get('payload')
         return header, metadata
     
     def _listQuery(self, set=None, from_=None, until=None, 
@@ -156,15 +227,31 @@ class OAIServer(object):
 
 def OAIServerFactory(db, config):
     """Create a new OAI batching OAI Server given a config and
-    a database"""
+    a database. ListRecords and ListIdentifiers responses are
+    returned as an iterator of chunks (see :mod:`moai.stream`)"""
     
     metadata_registry = oaipmh.metadata.MetadataRegistry()
+    writers = {}
     for prefix in config.metadata_prefixes:
+        writers[prefix] = writer = get_writer(prefix, config, db)
+        if prefix in config.passthrough:
+            writer = PassthroughWriter(writer)
         metadata_registry.registerWriter(prefix,
-                                         get_writer(prefix, config, db))
+                                         TimedWriter(prefix, writer))
+
+    render_pool = None
+    if config.render_pool:
+        render_pool = RenderPool(config.render_pool,
+                                 config.render_workers,
+                                 config.render_threshold,
+                                 db,
+                                 config)
             
-    return oaipmh.server.BatchingServer(
-        OAIServer(db, config),
+    return StreamingServer(
+        OAIServer(db, config, writers),
+        config.url,
         metadata_registry=metadata_registry,
-        resumption_batch_size=config.batch_size
+        resumption_batch_size=config.batch_size,
+        render_pool=render_pool,
+        page_budgets=config.page_budgets
         )
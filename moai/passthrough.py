@@ -0,0 +1,88 @@
+"""
+moai.passthrough
+================
+
+Storing and serving the original metadata XML of harvested records.
+
+A provider that reads OAI-PMH metadata (for instance the EDM provider)
+can keep the XML of the `<metadata>` element of a record as it was
+harvested. For the metadata formats in the `passthrough` option of a
+feed, this XML is stored with the record (compressed with zlib when
+`passthrough_compression` is set) and copied into the responses as it
+is, without decoding the json metadata or running the metadata writer.
+Records that have no stored XML are written by the metadata writer.
+
+The namespaces of the XML are fixed once, when it is stored: all
+namespaces that are declared on the ancestors of the element are
+declared on the element itself, so it can be copied into any response.
+
+"""
+import zlib
+
+from lxml import etree
+
+COMPRESSIONS = ('zlib',)
+
+def get_formats(config):
+    """Returns the set of passthrough metadata prefixes of a feed,
+    config is a dictionary with the paste options or a FeedConfig"""
+    if config is None:
+        return set()
+    if isinstance(config, dict):
+        return set(str(config.get('passthrough', '')).split())
+    return set(getattr(config, 'passthrough', ()))
+
+def get_compression(config):
+    """Returns the compression of the stored XML of a feed, or None"""
+    if config is None:
+        return None
+    if isinstance(config, dict):
+        compression = config.get('passthrough_compression')
+    else:
+        compression = getattr(config, 'passthrough_compression', None)
+    compression = (compression or '').lower()
+    if compression in ('', 'none', 'identity'):
+        return None
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unsupported passthrough compression: %s' %
+                         compression)
+    return compression
+
+def metadata_payload(element):
+    """Returns the XML of an element (the child of an OAI-PMH metadata
+    element) as UTF-8 bytes, with the namespaces it uses declared"""
+    # serializing an element declares all namespaces that are in
+    # scope, the default namespace is removed when it is not used
+    # (usually it is the OAI-PMH namespace of the harvested document)
+    element = etree.fromstring(etree.tostring(element))
+    etree.cleanup_namespaces(
+        element,
+        keep_ns_prefixes=[prefix for prefix in element.nsmap if prefix])
+    return etree.tostring(element, encoding='UTF-8', xml_declaration=False)
+
+def encode_payload(data, compression=None):
+    if compression == 'zlib':
+        return zlib.compress(data)
+    return data
+
+def decode_payload(data, compression=None):
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+class PassthroughWriter(object):
+    """Wraps the metadata writer of a format, the stored XML of a
+    record is parsed and added as it is. This is only used when a
+    record is rendered as a tree (GetRecord), the streaming server
+    copies the XML into the response without parsing it.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __call__(self, element, metadata):
+        data = getattr(metadata, 'payload', None)
+        if data is None:
+            return self.writer(element, metadata)
+        element.append(etree.fromstring(data))
@@ -0,0 +1,83 @@
+"""
+moai.plugins
+============
+
+Registry of the plugins (metadata formats, databases, providers and
+content classes) that are registered through entry points.
+
+Entry points are discovered once per group with :mod:`importlib.metadata`
+and cached, plugin classes are only imported the first time they are
+requested.
+
+"""
+import threading
+
+try:
+    from importlib import metadata
+except ImportError:
+    # python < 3.8
+    import importlib_metadata as metadata
+
+_lock = threading.Lock()
+_entry_points = {}
+_plugins = {}
+_versions = {}
+
+def _select(group):
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=group)
+    # python < 3.10 returns a dict of groups
+    return entry_points.get(group, [])
+
+def get_entry_points(group):
+    """Returns a dictionary mapping names to the (unloaded) entry points
+    registered in a group, if a name is registered more than once the
+    first one wins.
+    """
+    points = _entry_points.get(group)
+    if points is None:
+        with _lock:
+            points = _entry_points.get(group)
+            if points is None:
+                points = {}
+                for point in _select(group):
+                    points.setdefault(point.name, point)
+                _entry_points[group] = points
+    return points
+
+def get_plugin(group, name):
+    """Returns the object registered under name in an entry point group,
+    or None if there is no such plugin. The object is imported on first
+    use and cached afterwards.
+    """
+    key = (group, name)
+    plugin = _plugins.get(key)
+    if plugin is None:
+        point = get_entry_points(group).get(name)
+        if point is None:
+            return None
+        plugin = _plugins[key] = point.load()
+    return plugin
+
+def get_names(group):
+    """Returns a sorted list of the plugin names registered in a group"""
+    return sorted(get_entry_points(group))
+
+def get_version(distribution):
+    """Returns the version of an installed distribution, or None if it
+    is not installed"""
+    if distribution not in _versions:
+        try:
+            _versions[distribution] = metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            _versions[distribution] = None
+    return _versions[distribution]
+
+def reset():
+    """Forget all discovered entry points and loaded plugins, this is
+    needed when packages are installed while running"""
+    with _lock:
+        _entry_points.clear()
+        _plugins.clear()
+        _versions.clear()
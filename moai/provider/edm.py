@@ -6,6 +6,9 @@ import xmltodict
 
 from moai.interfaces import IContentProvider
 from moai.provider.file import FileBasedContentProvider
+from moai.passthrough import metadata_payload
+
+NS_OAIPMH = 'http://www.openarchives.org/OAI/2.0/'
 
 @implementer(IContentProvider)
 class EdmBasedContentProvider(FileBasedContentProvider):
@@ -16,10 +19,31 @@ class EdmBasedContentProvider(FileBasedContentProvider):
 
     def __init__(self, uri, content_filter="*"):
         super(EdmBasedContentProvider, self).__init__(uri.replace("edm://", "file://"), content_filter)
+        self._passthrough = False
 
     def set_logger(self, log):
         self._log = log
 
+    def set_passthrough(self, passthrough):
+        """Keep the XML of the metadata of the records, it is added to
+        the records as 'payload'"""
+        self._passthrough = passthrough
+
+    def _payloads(self, data):
+        # the XML of the child of the metadata element of every record,
+        # by identifier
+        payloads = {}
+        root = etree.fromstring(data)
+        for record in root.iterfind('{%s}ListRecords/{%s}record' % (
+                NS_OAIPMH, NS_OAIPMH)):
+            identifier = record.findtext('{%s}header/{%s}identifier' % (
+                NS_OAIPMH, NS_OAIPMH))
+            metadata = record.find('{%s}metadata' % NS_OAIPMH)
+            if identifier is None or metadata is None or not len(metadata):
+                continue
+            payloads[identifier.strip()] = metadata_payload(metadata[0])
+        return payloads
+
     def update(self, from_date=None):
         self._log.info('Loading EDM files from: %s' % self._path)
 
@@ -29,7 +53,11 @@ class EdmBasedContentProvider(FileBasedContentProvider):
         for edm_file in edm_files:
             with open(os.path.join(self._path, edm_file), 'rb') as ef:
                 print(ef)
-                root = xmltodict.parse(ef.read(), process_namespaces=False)
+                data = ef.read()
+                root = xmltodict.parse(data, process_namespaces=False)
+                payloads = {}
+                if self._passthrough:
+                    payloads = self._payloads(data)
                 
                 try:
                     records = root["OAI-PMH"]["ListRecords"]["record"]
@@ -46,6 +74,8 @@ class EdmBasedContentProvider(FileBasedContentProvider):
                         continue
 
                     self._content[cho["header"]["identifier"]] = cho
+                    if cho["header"]["identifier"] in payloads:
+                        cho["payload"] = payloads[cho["header"]["identifier"]]
                     if self._set:
                         if not cho["header"]: cho["header"] = dict()
                         cho["header"]["setSpec"] = self._set
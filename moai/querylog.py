@@ -0,0 +1,163 @@
+"""
+moai.querylog
+=============
+
+Logging of slow database queries.
+
+A :class:`QueryLog` times the statements of an SQLAlchemy engine (with
+the cursor execute events) and the HTTP calls of the Directus backends.
+Queries that take longer than the `slow_query_threshold` (in seconds)
+are logged as warnings to the `moai.querylog` logger, with their
+parameters and elapsed time. With `slow_query_explain` the query plan
+of slow SELECT statements is logged as well.
+
+No events are registered when there is no threshold, so the queries are
+not timed at all.
+
+"""
+import time
+import logging
+import functools
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+def _true(value):
+    return str(value).lower() in ('true', 'yes', 'on', '1')
+
+
+class QueryLog(object):
+    """Logs the queries that are slower than threshold seconds
+    """
+    def __init__(self, threshold=None, explain=False):
+        self.threshold = threshold
+        self.explain = explain
+        self._engines = set()
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns the query log for the slow_query_threshold and
+        slow_query_explain options of a feed, config is a dictionary
+        with the paste options or a FeedConfig"""
+        if config is None:
+            return cls()
+        if isinstance(config, dict):
+            threshold = config.get('slow_query_threshold')
+            explain = config.get('slow_query_explain', '')
+        else:
+            threshold = getattr(config, 'slow_query_threshold', None)
+            explain = getattr(config, 'slow_query_explain', False)
+        if threshold in (None, ''):
+            threshold = None
+        else:
+            threshold = float(threshold)
+        return cls(threshold, _true(explain))
+
+    def update(self, other):
+        """Add the settings of another query log, the lowest threshold
+        is used (for an engine that is shared by several feeds)"""
+        if other.threshold is not None and (
+            self.threshold is None or other.threshold < self.threshold):
+            self.threshold = other.threshold
+        self.explain = self.explain or other.explain
+
+    def listen(self, engine):
+        """Time the statements of an SQLAlchemy engine"""
+        if self.threshold is None or id(engine) in self._engines:
+            return
+        self._engines.add(id(engine))
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        conn.info.setdefault('moai_query_start', []).append(
+            (statement, time.perf_counter()))
+
+    def _handle_error(self, context):
+        # a statement that raises is not followed by after_cursor_execute,
+        # its start time is removed so the connection can be reused
+        conn = context.connection
+        if conn is None:
+            return
+        started = conn.info.get('moai_query_start')
+        if started and started[-1][0] == context.statement:
+            started.pop()
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        elapsed = time.perf_counter() - conn.info['moai_query_start'].pop()[1]
+        if self.threshold is None or elapsed < self.threshold:
+            return
+        plan = None
+        if (self.explain and not executemany and
+            statement.lstrip()[:6].upper() == 'SELECT'):
+            plan = self.query_plan(conn, statement, parameters)
+        if plan is None:
+            log.warning('Slow query (%.3f s): %s parameters: %r',
+                        elapsed, statement, parameters)
+        else:
+            log.warning('Slow query (%.3f s): %s parameters: %r plan:\n%s',
+                        elapsed, statement, parameters, plan)
+
+    def query_plan(self, conn, statement, parameters):
+        """Returns the query plan of a statement as text, or None if
+        the database can not explain it"""
+        prefix = 'EXPLAIN '
+        if conn.dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join([' '.join([str(value) for value in row])
+                              for row in cursor.fetchall()])
+        except Exception as err:
+            log.debug('Could not explain query: %s', err)
+            return None
+        finally:
+            cursor.close()
+
+    def response_hook(self, response, *args, **kwargs):
+        """A requests response hook that logs slow HTTP calls"""
+        if self.threshold is None:
+            return
+        elapsed = response.elapsed.total_seconds()
+        if elapsed >= self.threshold:
+            request = response.request
+            log.warning('Slow request (%.3f s): %s %s status: %s body: %r',
+                        elapsed, request.method, request.url,
+                        response.status_code, request.body)
+
+    def timed_client(self, client):
+        """Returns the client of an HTTP API with its method calls
+        timed, or the client itself when there is no threshold"""
+        if self.threshold is None:
+            return client
+        return TimedClient(client, self)
+
+
+class TimedClient(object):
+    # proxy for an API client, logs the calls of its methods that are
+    # slower than the threshold of the query log
+    def __init__(self, client, query_log):
+        self._client = client
+        self._query_log = query_log
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if not callable(value):
+            return value
+        query_log = self._query_log
+        @functools.wraps(value)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                if elapsed >= query_log.threshold:
+                    log.warning('Slow request (%.3f s): %s args: %r %r',
+                                elapsed, name, args, kwargs)
+        return timed
@@ -0,0 +1,116 @@
+"""
+moai.render
+===========
+
+Concurrent rendering of the records in a ListRecords page.
+
+Rendering the metadata of a record with the EDM, DIDL and MODS writers
+is CPU bound. A :class:`RenderPool` renders the records of a page with
+a pool of threads or processes, the rendered fragments are returned in
+the order of the records, so the document order is preserved.
+
+Threads share the database and writers of the feed, but the writers
+are mostly python code, so they are limited by the GIL. Processes
+render in parallel, every process builds its own OAI server, and opens
+the database by its URI (or has no database if it is in memory).
+
+"""
+import os
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+RENDER_POOLS = ('thread', 'process')
+
+# the OAI server of a render process
+_worker_server = None
+
+def _init_worker(dburi, config):
+    global _worker_server
+    from moai.database import get_database
+    from moai.oai import OAIServerFactory
+    db = None
+    if dburi:
+        db = get_database(dburi, config)
+    _worker_server = OAIServerFactory(db, config)
+
+def _render_in_worker(verb, kw, results):
+    return [_worker_server._render(verb, kw, result) for result in results]
+
+def _render_chunk(render, verb, kw, results):
+    return [render(verb, kw, result) for result in results]
+
+
+class RenderPool(object):
+    """Renders the records of a page concurrently, pages with less
+    than `threshold` records are rendered serially
+    """
+    def __init__(self, kind='thread', workers=None, threshold=20,
+                 db=None, config=None, chunk_size=None):
+        if kind not in RENDER_POOLS:
+            raise ValueError('Unsupported render pool: %s' % kind)
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.threshold = threshold
+        # records are sent to the workers in chunks, this saves
+        # (inter process) communication overhead
+        if chunk_size is None:
+            chunk_size = kind == 'process' and 8 or 1
+        self.chunk_size = chunk_size
+        self._db = db
+        self._config = config
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get_executor(self):
+        # the executor is started on first use, its workers stop when
+        # the pool is garbage collected (when the feed is rebuilt)
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(
+                        self.workers,
+                        initializer=_init_worker,
+                        initargs=(getattr(self._db, '_uri', None),
+                                  self._config))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers)
+            return self._executor
+
+    def render(self, render, verb, kw, results):
+        """Returns an iterator of the rendered results, render is the
+        function that renders a single result in this process"""
+        results = iter(results)
+        head = list(itertools.islice(results, self.threshold))
+        if len(head) < self.threshold:
+            return (render(verb, kw, result) for result in head)
+        return self._render(render, verb, kw,
+                            itertools.chain(head, results))
+
+    def _render(self, render, verb, kw, results):
+        executor = self.get_executor()
+        if self.kind == 'process':
+            submit = lambda chunk: executor.submit(
+                _render_in_worker, verb, kw, chunk)
+        else:
+            submit = lambda chunk: executor.submit(
+                _render_chunk, render, verb, kw, chunk)
+        # only a few chunks per worker are rendered ahead, so the
+        # memory use stays bounded and the first records are sent early
+        pending = deque()
+        try:
+            while True:
+                chunk = list(itertools.islice(results, self.chunk_size))
+                if not chunk:
+                    break
+                pending.append(submit(chunk))
+                if len(pending) >= self.workers * 2:
+                    for fragment in pending.popleft().result():
+                        yield fragment
+            while pending:
+                for fragment in pending.popleft().result():
+                    yield fragment
+        finally:
+            for future in pending:
+                future.cancel()
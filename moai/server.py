@@ -7,11 +7,32 @@ of :ref:`IServer` and :ref:`IFeedConfig`.
 
 """
 import os
+import time
+import calendar
+import datetime
+import hmac
+import hashlib
 import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from wsgiref.handlers import format_date_time
+from urllib.parse import quote
 
 import oaipmh.error
 
 from moai.oai import OAIServerFactory, OAIServer
+from moai.cache import ResponseCache
+from moai.render import RENDER_POOLS
+from moai.export import (FORMATS, encode_cursor, decode_cursor, parse_date,
+                         export_body)
+from moai.passthrough import get_compression
+from moai.compression import ENCODINGS, EncodedBody, negotiate, encode
+from moai.metrics import (REGISTRY, CONTENT_TYPE, MeteredBody, cache_lookup,
+                          observe_request, request_verb)
+
+# headers that let the front end web server send asset files
+OFFLOAD_HEADERS = ('x-accel-redirect', 'x-sendfile')
 
 class Server(object):
     """This is the default implementation of the
@@ -20,10 +41,191 @@ class Server(object):
     Developers might want to subclass this, to provide custom
     asset handling in their implementation.
     """
+    # maximum number of cached asset access checks
+    access_cache_size = 10000
+
     def __init__(self, base_url, db, config):
         self.base_url = base_url
         self._db = db
         self._config = config
+        # (config fingerprint, batching server) pair, swapped atomically
+        self._oai_server = (None, None)
+        self._oai_server_lock = threading.Lock()
+        # (time of check, generation) of the database
+        self._generation = (0, None)
+        # ((generation, config fingerprint), rendered response)
+        self._identify = (None, None)
+        # (generation, last modified, next release date) of the database
+        self._release = (None, None, None)
+        # {(oai id, generation, fingerprint): (expires, visible)}, the
+        # least recently used checks are evicted when it is full
+        self._access = OrderedDict()
+        self._access_lock = threading.Lock()
+        self._cache = None
+        if config.response_cache_size:
+            self._cache = ResponseCache(config.response_cache_size,
+                                        config.response_cache_ttl,
+                                        config.response_cache_dir)
+
+    def get_oai_server(self):
+        """Return the batching OAI server for this feed.
+
+        The server (and its metadata registry and writers) is built once
+        and shared between requests, it is only rebuilt when the
+        fingerprint of the feed config changes.
+        """
+        fingerprint = self._config.fingerprint()
+        key, oai_server = self._oai_server
+        if key == fingerprint:
+            return oai_server
+        with self._oai_server_lock:
+            key, oai_server = self._oai_server
+            if key != fingerprint:
+                oai_server = OAIServerFactory(self._db, self._config)
+                self._oai_server = (fingerprint, oai_server)
+        return oai_server
+
+    def get_generation(self):
+        """Returns the generation of the database, or None when the
+        database does not keep track of generations.
+
+        The database is asked at most once every
+        `generation_interval` seconds.
+        """
+        generation = getattr(self._db, 'generation', None)
+        if generation is None:
+            return None
+        checked, value = self._generation
+        now = time.time()
+        if now - checked >= self._config.generation_interval:
+            value = generation()
+            self._generation = (now, value)
+        return value
+
+    def identify_response(self):
+        """Returns the rendered Identify response as an EncodedBody,
+        it is rendered once and reused until the database generation or
+        the feed config changes"""
+        generation = self.get_generation()
+        if generation is None:
+            return EncodedBody(
+                self.get_oai_server().handleRequest({'verb': 'Identify'}))
+        key = (generation, self._config.fingerprint())
+        cached_key, response = self._identify
+        cache_lookup(self._config.name, 'identify', cached_key == key)
+        if cached_key != key:
+            response = EncodedBody(self.get_oai_server().handleRequest(
+                {'verb': 'Identify'}))
+            self._identify = (key, response)
+        return response
+
+    def get_validators(self, args):
+        """Returns a dictionary with the ETag and Last-Modified headers
+        for an OAI request, or None when the database does not keep
+        track of generations.
+
+        The response to a request only changes when the database
+        generation changes, or when a record with a modification date
+        in the future (an embargo) becomes visible.
+
+        The validators are feed wide: Last-Modified is the time of the
+        last flush (or the latest visible datestamp, if that is later)
+        and not the latest datestamp in the from/until/set window of
+        the request. A flush changes the validators of every request,
+        because removed records, set changes and updates that keep
+        their datestamp change a window without changing its latest
+        datestamp. Every flush gets a later second than the previous
+        one (see SQLDatabase._bump_generation), so If-Modified-Since
+        notices flushes in the same second as an earlier response.
+        """
+        generation = self.get_generation()
+        if generation is None:
+            return None
+        now = datetime.datetime.utcnow()
+        if self._config.delay:
+            now -= datetime.timedelta(seconds=float(self._config.delay))
+        release = self._release
+        if (release[0] != generation or
+            (release[2] is not None and now >= release[2])):
+            last_modified = self._db.last_modified()
+            latest = self._db.oai_latest_datestamp(now)
+            if latest is not None and (last_modified is None or
+                                       latest > last_modified):
+                last_modified = latest
+            release = (generation,
+                       last_modified,
+                       self._db.oai_next_datestamp(now))
+            self._release = release
+        generation, last_modified, next_release = release
+        state = repr((generation,
+                      last_modified,
+                      self._config.fingerprint(),
+                      sorted(args.items())))
+        validators = {
+            'ETag': 'W/"%s"' % hashlib.sha1(state.encode('utf8')).hexdigest()}
+        if last_modified is not None:
+            validators['Last-Modified'] = format_date_time(
+                calendar.timegm(last_modified.utctimetuple()))
+        return validators
+
+    def response_encoding(self, req):
+        """Returns the content encoding of the response to a request,
+        or None if it is not compressed"""
+        if not self._config.compression:
+            return None
+        return negotiate(req.header('Accept-Encoding'),
+                         self._config.compression)
+
+    def encoded_etag(self, etag, encoding):
+        """Returns the ETag of the encoded representation of a response,
+        the encoding is added to the tag"""
+        if encoding is None:
+            return etag
+        return '%s-%s"' % (etag[:-1], encoding)
+
+    def is_not_modified(self, req, validators, encoding=None):
+        """Returns True if the client already has the current version
+        of the response, according to its If-None-Match or
+        If-Modified-Since header. The tag of the encoded response is
+        accepted as well as the tag of the plain response."""
+        if_none_match = req.header('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            etags = set([validators['ETag'][2:],
+                         self.encoded_etag(validators['ETag'],
+                                           encoding)[2:]])
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag in etags:
+                    return True
+            return False
+        if_modified_since = req.header('If-Modified-Since')
+        last_modified = validators.get('Last-Modified')
+        if if_modified_since and last_modified:
+            since = parsedate_tz(if_modified_since)
+            if since is None:
+                return False
+            return mktime_tz(parsedate_tz(last_modified)) <= mktime_tz(since)
+        return False
+
+    def write(self, req, data, mimetype='text/xml', headers=None):
+        """Write a response body (a string, an iterator of strings or an
+        EncodedBody), compressed with the content encoding negotiated
+        with the client"""
+        headers = dict(headers or {})
+        encoding = self.response_encoding(req)
+        if self._config.compression:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+            if 'ETag' in headers:
+                # the encoded response is a different representation
+                headers['ETag'] = self.encoded_etag(headers['ETag'], encoding)
+        data = encode(data, encoding, self._config.compression_level)
+        return req.write(data, mimetype, headers)
 
     def download_asset(self, req, url, config):
         """Download an asset
@@ -32,22 +234,54 @@ class Server(object):
         asset_url = url.split('asset/')[-1]
         id, filename = asset_url.split('/')
 
-        for asset in self._db.get_assets(id):
-            if (asset['filename'] == filename or
-                asset['md5'] == filename):
-                break
+        if hasattr(self._db, 'get_asset'):
+            asset = self._db.get_asset(config.oai_id_prefix + id, filename)
         else:
+            for asset in self._db.get_assets(id):
+                if (asset['filename'] == filename or
+                    asset['md5'] == filename):
+                    break
+            else:
+                asset = None
+        if asset is None:
             return req.send_status(
                 '404 File not Found',
                 'The asset "%s" does not exist' % filename)
             
-        if not os.path.isfile(asset['path']):
+        if not asset['path'] or not os.path.isfile(asset['path']):
             return req.send_status(
                 '404 File not Found',
                 'The asset file "%s" does not exist' % filename)
 
+        mimetype = asset['mimetype'] or 'application/octet-stream'
+        headers = self.offload_headers(asset['path'], config)
+        if headers:
+            # the front end web server sends the file
+            return req.write(b'', mimetype, headers)
+        # the size and modification time were stored with the asset
         return req.send_file(asset['path'],
-                             asset['mimetype'].encode('ascii'))
+                             mimetype,
+                             ranges=config.asset_ranges,
+                             size=asset.get('size'),
+                             mtime=asset.get('mtime'))
+
+    def offload_headers(self, path, config):
+        """Returns the X-Accel-Redirect or X-Sendfile header that lets
+        the front end web server send an asset file, or None if the
+        file should be sent by the server itself. Only files in the
+        base_asset_path are offloaded.
+        """
+        if not config.asset_offload:
+            return None
+        base_path = os.path.realpath(config.base_asset_path)
+        path = os.path.realpath(path)
+        if os.path.commonpath([base_path, path]) != base_path:
+            return None
+        if config.asset_offload == 'x-sendfile':
+            return {'X-Sendfile': path}
+        relative_path = os.path.relpath(path, base_path).replace(os.sep, '/')
+        return {'X-Accel-Redirect': quote('%s/%s' % (
+            config.asset_offload_prefix.rstrip('/'), relative_path))}
 
     def allow_download(self, url, config):
         """Returns a boolean indicating if it is okay to download an
@@ -62,19 +296,50 @@ class Server(object):
         url = url.lstrip('/')
         asset_url = url.split('asset/')[-1]
         id, filename = asset_url.split('/')
-        
-        oai_server = OAIServer(self._db, config)
-        try:
-            header, metadata, description = oai_server.getRecord(
-                'oai_dc', config.oai_id_prefix + id)
-        except oaipmh.error.IdDoesNotExistError:
-            # record is not in the oai feed, don't download
-            return False
-        if header.isDeleted():
-            # record has deleted status, don't download
-            return False
+        return self.is_visible(config.oai_id_prefix + id, config)
 
-        return True
+    def is_visible(self, oai_id, config):
+        """Returns a boolean indicating if a record is visible (and not
+        deleted) in the feed. The answers are cached for
+        `access_cache_ttl` seconds, or until the database changes.
+        """
+        if not hasattr(self._db, 'oai_visible'):
+            oai_server = OAIServer(self._db, config)
+            try:
+                header, metadata, description = oai_server.getRecord(
+                    'oai_dc', oai_id)
+            except oaipmh.error.IdDoesNotExistError:
+                # record is not in the oai feed, don't download
+                return False
+            # records with deleted status can not be downloaded
+            return not header.isDeleted()
+
+        now = time.time()
+        key = (oai_id, self.get_generation(), config.fingerprint())
+        with self._access_lock:
+            cached = self._access.get(key)
+            if cached is not None:
+                self._access.move_to_end(key)
+        hit = cached is not None and cached[0] > now
+        cache_lookup(config.name, 'access', hit)
+        if hit:
+            return cached[1]
+        until = datetime.datetime.utcnow()
+        if config.delay:
+            until -= datetime.timedelta(seconds=float(config.delay))
+        visible = self._db.oai_visible(oai_id,
+                                       needed_sets=config.sets_needed,
+                                       disallowed_sets=config.sets_disallowed,
+                                       allowed_sets=config.sets_allowed,
+                                       deleted_sets=config.sets_deleted,
+                                       until_date=until)
+        if config.access_cache_ttl:
+            with self._access_lock:
+                self._access[key] = (now + config.access_cache_ttl, visible)
+                self._access.move_to_end(key)
+                while len(self._access) > self.access_cache_size:
+                    self._access.popitem(last=False)
+        return visible
 
     def is_asset_url(self, url, config):
         """Returns a boolean indicating if this is a url
@@ -85,6 +350,84 @@ class Server(object):
             return True
         return False
             
+    def is_export_url(self, url, config):
+        """Returns a boolean indicating if this is a url for the
+        bulk export of records"""
+        return config.export_enabled and url.split('?')[0] == 'export'
+
+    def is_metrics_url(self, url, config):
+        """Returns a boolean indicating if this is the url of the
+        metrics page"""
+        return config.metrics_enabled and url.split('?')[0] == 'metrics'
+
+    def send_metrics(self, req):
+        """Send the metrics of all feeds in this process, see
+        :mod:`moai.metrics`"""
+        return req.write(REGISTRY.render(), CONTENT_TYPE,
+                         {'Cache-Control': 'no-cache'})
+
+    def meter(self, req, body, started, size=None):
+        """Returns the body of a response, the request is added to the
+        metrics when the body is sent, or right away if its size is
+        known. started is the time.perf_counter() of the request.
+        """
+        url = req.url()[len(self.base_url):].strip('/')
+        labels = (self._config.name, request_verb(url, req.query_dict()))
+        if size is not None:
+            observe_request(labels, started, size)
+            return body
+        return MeteredBody(body, labels, started)
+
+    def export_records(self, req, config):
+        """Send a page of records as json, see :mod:`moai.export`"""
+        # the export is only for consumers that have the token, without
+        # a token it is not available
+        authorization = req.header('Authorization') or ''
+        if not config.export_token or not hmac.compare_digest(
+            authorization.encode('utf8'),
+            ('Bearer %s' % config.export_token).encode('utf8')):
+            return req.send_status('403 Forbidden',
+                                   'You are not allowed to export records')
+        args = req.query_dict()
+        format = args.get('format', 'ndjson')
+        try:
+            if format not in FORMATS:
+                raise ValueError('Unsupported format: %s' % format)
+            limit = int(args.get('limit', config.export_batch_size))
+            limit = max(1, min(limit, config.export_batch_size))
+            after = None
+            if args.get('cursor'):
+                after = decode_cursor(args['cursor'])
+            from_date = parse_date(args.get('from'))
+            until_date = parse_date(args.get('until'), inclusive=True)
+        except ValueError as err:
+            return req.send_status('400 Bad Request', str(err))
+
+        until = datetime.datetime.utcnow()
+        if config.delay:
+            until -= datetime.timedelta(seconds=float(config.delay))
+        if until_date is None or until_date > until:
+            until_date = until
+        needed_sets = config.sets_needed.copy()
+        if args.get('set'):
+            needed_sets.add(args['set'])
+        # one extra record is fetched to find out if there is a next page
+        records = self._db.oai_export(after=after,
+                                      batch_size=limit + 1,
+                                      needed_sets=needed_sets,
+                                      disallowed_sets=config.sets_disallowed,
+                                      allowed_sets=config.sets_allowed,
+                                      from_date=from_date,
+                                      until_date=until_date)
+        headers = {}
+        if len(records) > limit:
+            records = records[:limit]
+            headers['X-Next-Cursor'] = encode_cursor(records[-1])
+        return self.write(req,
+                          export_body(records, format, config.sets_deleted),
+                          FORMATS[format],
+                          headers)
+
     def handle_request(self, req):
         if not req.url().startswith(self.base_url):
             return req.send_status(
@@ -114,8 +457,40 @@ class Server(object):
                 return req.send_status('403 Forbidden',
                                        'You are not allowed to download this asset')
 
-        oai_server = OAIServerFactory(self._db, self._config)
-        return req.write(oai_server.handleRequest(req.query_dict()), 'text/xml')
+        if self.is_export_url(url, self._config):
+            return self.export_records(req, self._config)
+
+        if self.is_metrics_url(url, self._config):
+            return self.send_metrics(req)
+
+        args = req.query_dict()
+        validators = self.get_validators(args)
+        encoding = self.response_encoding(req)
+        not_modified = (validators is not None and
+                        self.is_not_modified(req, validators, encoding))
+        if validators is not None:
+            cache_lookup(self._config.name, 'conditional', not_modified)
+        if not_modified:
+            headers = dict(validators)
+            headers['ETag'] = self.encoded_etag(headers['ETag'], encoding)
+            if self._config.compression:
+                headers['Vary'] = 'Accept-Encoding'
+            return req.send_status('304 Not Modified', headers=headers)
+
+        if args == {'verb': 'Identify'}:
+            return self.write(req, self.identify_response(), headers=validators)
+
+        oai_server = self.get_oai_server()
+        if validators is None or self._cache is None:
+            return self.write(req, oai_server.handleRequest(args),
+                              headers=validators)
+        # the etag identifies the request and the state of the feed
+        key = validators['ETag']
+        response = self._cache.get(key)
+        cache_lookup(self._config.name, 'response', response is not None)
+        if response is None:
+            response = self._cache.tee(key, oai_server.handleRequest(args))
+        return self.write(req, response, headers=validators)
 
 class FeedConfig(object):
     """The feedconfig object contains all the settings for a specific
@@ -150,4 +525,79 @@ class FeedConfig(object):
         self.base_asset_path = extra_args.get('base_asset_path',
                                               tempfile.gettempdir())
         self.oai_id_prefix = extra_args.get('oai_id_prefix', '')
+        self.generation_interval = float(
+            extra_args.get('generation_interval', 1))
+        compression = extra_args.get('compression', ENCODINGS)
+        if isinstance(compression, str):
+            compression = compression.replace('identity', '').split()
+        for encoding in compression:
+            if encoding not in ENCODINGS:
+                raise ValueError('Unsupported compression: %s' % encoding)
+        self.compression = list(compression)
+        self.compression_level = int(extra_args.get('compression_level', 6))
+        self.response_cache_size = int(
+            extra_args.get('response_cache_size', 16 * 1024 * 1024))
+        self.response_cache_ttl = float(
+            extra_args.get('response_cache_ttl', 300))
+        self.response_cache_dir = extra_args.get('response_cache_dir')
+        self.render_pool = extra_args.get('render_pool') or None
+        if self.render_pool and self.render_pool not in RENDER_POOLS:
+            raise ValueError('Unsupported render pool: %s' % self.render_pool)
+        self.render_workers = int(extra_args.get('render_workers', 0)) or None
+        self.render_threshold = int(extra_args.get('render_threshold', 20))
+        self.access_cache_ttl = float(extra_args.get('access_cache_ttl', 10))
+        self.asset_offload = (extra_args.get('asset_offload') or '').lower()
+        if self.asset_offload not in OFFLOAD_HEADERS + ('',):
+            raise ValueError('Unsupported asset offload: %s' %
+                             self.asset_offload)
+        self.asset_offload_prefix = extra_args.get('asset_offload_prefix',
+                                                   '/assets')
+        self.asset_ranges = str(extra_args.get('asset_ranges', '')).lower() in (
+            'true', 'yes', 'on', '1')
+        self.page_budgets = {}
+        for budget in str(extra_args.get('page_budget', '')).split():
+            prefix, _, size = budget.rpartition(':')
+            self.page_budgets[prefix or None] = int(size)
+        self.export_enabled = str(extra_args.get('export', '')).lower() in (
+            'true', 'yes', 'on', '1')
+        self.export_token = extra_args.get('export_token') or None
+        self.export_batch_size = int(
+            extra_args.get('export_batch_size', 1000))
+        self.metrics_enabled = str(extra_args.get('metrics', '')).lower() in (
+            'true', 'yes', 'on', '1')
+        slow_query_threshold = extra_args.get('slow_query_threshold')
+        self.slow_query_threshold = None
+        if slow_query_threshold not in (None, ''):
+            self.slow_query_threshold = float(slow_query_threshold)
+        self.slow_query_explain = str(
+            extra_args.get('slow_query_explain', '')).lower() in (
+            'true', 'yes', 'on', '1')
+        self.passthrough = sorted(
+            str(extra_args.get('passthrough', '')).split())
+        self.passthrough_compression = get_compression(extra_args)
+
+    def fingerprint(self):
+        """Returns a hashable value that changes whenever one of the
+        settings that influence the output of the feed changes.
+        """
+        return (self.name,
+                self.url,
+                tuple(self.admins),
+                tuple(self.metadata_prefixes),
+                self.batch_size,
+                self.content_type,
+                tuple(sorted(self.sets_needed)),
+                tuple(sorted(self.sets_allowed)),
+                tuple(sorted(self.sets_disallowed)),
+                tuple(sorted(self.sets_deleted)),
+                tuple(sorted(self.filter_sets)),
+                self.delay,
+                self.oai_id_prefix,
+                tuple(self.compression),
+                self.render_pool,
+                self.render_workers,
+                self.render_threshold,
+                tuple(sorted(self.page_budgets.items(),
+                             key=lambda item: item[0] or '')),
+                tuple(self.passthrough))
         
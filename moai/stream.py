@@ -0,0 +1,215 @@
+"""
+moai.stream
+===========
+
+Streaming generation of the ListRecords and ListIdentifiers responses.
+
+pyoai builds the complete response as one lxml tree before it is
+serialized. The :class:`StreamingServer` renders the envelope and every
+record separately, and returns the response as an iterator of byte
+chunks, so only one record is in memory at a time and the first bytes
+can be sent before the last record is rendered.
+
+"""
+import itertools
+from datetime import datetime
+from urllib.parse import parse_qs, unquote
+
+from lxml import etree
+
+import oaipmh.common
+import oaipmh.error
+import oaipmh.server
+from oaipmh.datestamp import datetime_to_datestamp, datestamp_to_datetime
+from oaipmh.server import (NS_OAIPMH, NS_XSI, NSMAP, nsoai,
+                           encodeResumptionToken)
+
+STREAMING_VERBS = ('ListRecords', 'ListIdentifiers')
+
+# marker for the position of the records in the serialized envelope
+_RECORDS_MARKER = '@@records@@'
+# marker for the position of the stored metadata XML in a record
+_PAYLOAD_MARKER = '@@metadata@@'
+_DEFAULT_NS_DECLARATION = (' xmlns="%s"' % NS_OAIPMH).encode('ascii')
+
+
+def decode_resumption_token(token):
+    """Returns the arguments and the cursor of a resumption token made
+    by oaipmh.server.encodeResumptionToken.
+
+    This is oaipmh.server.decodeResumptionToken, which uses the
+    cgi.parse_qs function that no longer exists in python 3.
+    """
+    token = str(unquote(token))
+    try:
+        kw = parse_qs(token, True, True)
+    except ValueError:
+        raise oaipmh.error.BadResumptionTokenError(
+            "Unable to decode resumption token: %s" % token)
+    result = {}
+    for key, value in kw.items():
+        value = value[0]
+        if key == 'from_' or key == 'until':
+            value = datestamp_to_datetime(value)
+        result[key] = value
+    try:
+        cursor = int(result.pop('cursor'))
+    except (KeyError, ValueError):
+        raise oaipmh.error.BadResumptionTokenError(
+            "Unable to decode resumption token (bad cursor): %s" % token)
+    return result, cursor
+
+
+class StreamingServer(oaipmh.server.BatchingServer):
+    """A pyoai batching server that returns the ListRecords and
+    ListIdentifiers responses as an iterator of byte chunks, instead
+    of a single string.
+
+    All other verbs, and all errors that can be detected before the
+    first record is sent, are rendered by pyoai as usual.
+    """
+    def __init__(self, server, base_url, metadata_registry=None, nsmap=None,
+                 resumption_batch_size=10, render_pool=None,
+                 page_budgets=None):
+        super(StreamingServer, self).__init__(
+            server,
+            metadata_registry=metadata_registry,
+            nsmap=nsmap,
+            resumption_batch_size=resumption_batch_size)
+        self._server = server
+        self._base_url = base_url
+        self._batch_size = resumption_batch_size
+        # optional moai.render.RenderPool used for ListRecords
+        self._render_pool = render_pool
+        # maximum number of rendered bytes of a page, per metadataPrefix
+        # (None is the default for all formats)
+        self._page_budgets = page_budgets or {}
+
+    def handleVerb(self, verb, kw):
+        if verb not in STREAMING_VERBS:
+            return super(StreamingServer, self).handleVerb(verb, kw)
+
+        # this mirrors oaipmh.server.BatchingResumption, so the
+        # resumption tokens are the same as the ones pyoai creates
+        request_kw = kw
+        if 'resumptionToken' in kw:
+            kw, cursor = decode_resumption_token(kw['resumptionToken'])
+        else:
+            kw, cursor = kw.copy(), 0
+        kw['cursor'] = cursor
+        kw['batch_size'] = self._batch_size + 1
+        method = oaipmh.common.getMethodForVerb(self._server, verb)
+        results = iter(method(**kw))
+
+        # the first result is fetched before the response is returned,
+        # so errors are still reported as OAI errors by pyoai
+        try:
+            first = [next(results)]
+        except StopIteration:
+            if 'resumptionToken' not in request_kw:
+                raise oaipmh.error.NoRecordsMatchError(
+                    "No records match for request.")
+            first = []
+
+        return self._stream(verb, request_kw, kw, cursor, first, results)
+
+    def _stream(self, verb, request_kw, kw, cursor, first, results):
+        head, tail = self._envelope(verb, request_kw)
+        yield head
+        results = itertools.chain(first, results)
+        # the number of results taken from the query, the render pool
+        # takes results before they are sent
+        taken = [0]
+        def page():
+            for result in itertools.islice(results, self._batch_size):
+                taken[0] += 1
+                yield result
+        if self._render_pool is not None and verb == 'ListRecords':
+            fragments = self._render_pool.render(self._render, verb, kw,
+                                                 page())
+        else:
+            fragments = (self._render(verb, kw, result) for result in page())
+
+        budget = self._page_budgets.get(kw.get('metadataPrefix'),
+                                        self._page_budgets.get(None))
+        count = 0
+        size = 0
+        more = None
+        try:
+            for fragment in fragments:
+                yield fragment
+                count += 1
+                size += len(fragment)
+                if budget and size >= budget and count < self._batch_size:
+                    # the page is full, the next page starts at the
+                    # first record that was not sent
+                    more = taken[0] > count or next(results, None) is not None
+                    break
+        finally:
+            if hasattr(fragments, 'close'):
+                fragments.close()
+        if more is None:
+            more = next(results, None) is not None
+        if more:
+            e_token = etree.Element(nsoai('resumptionToken'), nsmap=NSMAP)
+            e_token.text = encodeResumptionToken(kw, cursor + count)
+            yield self._fragment(e_token)
+        yield tail
+
+    def _envelope(self, verb, request_kw):
+        """Returns the serialized start and end of the response"""
+        e_oaipmh = etree.Element(nsoai('OAI-PMH'), nsmap=NSMAP)
+        e_oaipmh.set('{%s}schemaLocation' % NS_XSI,
+                     ('http://www.openarchives.org/OAI/2.0/ '
+                      'http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd'))
+        e_responseDate = etree.SubElement(e_oaipmh, nsoai('responseDate'))
+        e_responseDate.text = datetime_to_datestamp(
+            datetime.utcnow().replace(microsecond=0))
+        e_request = etree.SubElement(e_oaipmh, nsoai('request'))
+        e_request.set('verb', verb)
+        for key, value in request_kw.items():
+            if key == 'from_':
+                key = 'from'
+            if key == 'from' or key == 'until':
+                value = datetime_to_datestamp(value)
+            e_request.set(key, value)
+        e_request.text = self._base_url
+        e_verb = etree.SubElement(e_oaipmh, nsoai(verb))
+        e_verb.text = _RECORDS_MARKER
+        envelope = etree.tostring(e_oaipmh,
+                                  encoding='UTF-8',
+                                  xml_declaration=True,
+                                  pretty_print=True)
+        head, tail = envelope.split(_RECORDS_MARKER.encode('ascii'))
+        return head + b'\n', tail
+
+    def _render(self, verb, kw, result):
+        """Render a single header or record"""
+        tree_server = self._tree_server
+        parent = etree.Element(nsoai(verb), nsmap=NSMAP)
+        if verb == 'ListIdentifiers':
+            tree_server._outputHeader(parent, result)
+        else:
+            header, metadata, about = result
+            e_record = etree.SubElement(parent, nsoai('record'))
+            tree_server._outputHeader(e_record, header)
+            payload = getattr(metadata, 'payload', None)
+            if not header.isDeleted() and payload is not None:
+                # the stored metadata XML is copied as it is
+                e_metadata = etree.SubElement(e_record, nsoai('metadata'))
+                e_metadata.text = _PAYLOAD_MARKER
+                head, marker, tail = self._fragment(e_record).rpartition(
+                    _PAYLOAD_MARKER.encode('ascii'))
+                return head + payload + tail
+            if not header.isDeleted():
+                tree_server._outputMetadata(e_record,
+                                            kw['metadataPrefix'],
+                                            metadata)
+        return self._fragment(parent[0])
+
+    def _fragment(self, element):
+        # the default namespace is already declared on the envelope
+        return etree.tostring(element,
+                              encoding='UTF-8',
+                              pretty_print=True).replace(
+            _DEFAULT_NS_DECLARATION, b'', 1)
@@ -1,19 +1,50 @@
 # coding=utf8
+import io
 import os
+import time
+import zlib
+import gzip
+import json
+import asyncio
+import logging
+import shutil
+import tempfile
+import calendar
+import pstats
+from wsgiref.handlers import format_date_time
+from wsgiref.util import FileWrapper
 from unittest import TestCase, TestSuite, makeSuite
 import doctest
 import datetime
 import urllib.request, urllib.error, urllib.parse
+from urllib.parse import quote
 
 from lxml import etree
+from webob import Request
+import oaipmh.server
+import oaipmh.common
 import wsgi_intercept
 from wsgi_intercept.urllib2_intercept import install_opener
 
 from moai.utils import XPath
-from moai.database import Database
+from moai.database import Database, get_database
 from moai.server import Server, FeedConfig
-from moai.wsgi import MOAIWSGIApp
+from moai.wsgi import MOAIWSGIApp, WSGIRequest, FileIterable, FileIterator
+from moai.cache import ResponseCache
+from moai.asgi import MOAIASGIApp
+from moai.dump import dump_feed
+from moai.stream import decode_resumption_token
+from moai.middleware import AdmissionControl, Profiler
+from moai import metrics
+from moai.metadata import edm
+from moai.metadata.edm import EDM
+from moai.metadata.oaidc import OAIDC
+from moai.metadata.mods import MODS, NL_MODS
+from moai.metadata.didl import DIDL
+from moai.metadata.dare_didl import DareDIDL
 from moai.provider.file import FileBasedContentProvider
+from moai.provider.edm import EdmBasedContentProvider
+from moai.content.edm import EdmContent
 from moai.example import ExampleContent
 install_opener()
 
@@ -352,6 +383,48 @@ class DatabaseTest(TestCase):
         self.assertEqual([r['id'] for r in self.db.oai_query(
             batch_size=1, offset=2)], ['oai:spamspamspam'])
 
+    def test_generation(self):
+        self.assertEqual(self.db.generation(), 0)
+        self.db.update_record('oai:spam',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {}, {})
+        self.db.flush()
+        self.assertEqual(self.db.generation(), 1)
+        self.db.remove_record('oai:spam')
+        self.assertEqual(self.db.generation(), 2)
+
+    def test_slow_query_log(self):
+        self.assertEqual(self.db._shared.query_log.threshold, None)
+        db = Database(None, {'slow_query_threshold': '0',
+                             'slow_query_explain': 'true'})
+        with self.assertLogs('moai.querylog', 'WARNING') as logged:
+            list(db.oai_query(disallowed_sets=['spam']))
+        message = logged.output[-1]
+        self.assertTrue('Slow query' in message)
+        self.assertTrue('FROM records' in message)
+        # the bind parameters and the query plan are logged
+        self.assertTrue("'spam'" in message)
+        self.assertTrue('plan:' in message)
+        # a failing query does not leave its start time behind
+        conn = db._shared.db.bind.connect()
+        try:
+            self.assertRaises(Exception, conn.execute,
+                              'SELECT spam FROM eggs')
+            self.assertEqual(conn.info['moai_query_start'], [])
+            with self.assertLogs('moai.querylog', 'WARNING') as logged:
+                conn.execute('SELECT 1')
+            self.assertEqual(conn.info['moai_query_start'], [])
+        finally:
+            conn.close()
+        # calls of an http api client are timed as well
+        class Client(object):
+            def get_items(self, collection, limit=10):
+                return []
+        client = db._shared.query_log.timed_client(Client())
+        with self.assertLogs('moai.querylog', 'WARNING') as logged:
+            self.assertEqual(client.get_items('items', limit=1), [])
+        self.assertTrue('get_items' in logged.output[-1])
+
 class ProviderTest(TestCase):
     def setUp(self):
         path = os.path.abspath(os.path.dirname(__file__))
@@ -506,12 +579,1074 @@ class ServerTest(TestCase):
                           ['oai:spamspamspam'])
 
 
+class MetadataFormatTest(TestCase):
+
+    def setUp(self):
+        path = os.path.abspath(os.path.dirname(__file__))
+        with open(os.path.join(path, 'edm-example.json')) as stream:
+            self.edm_record = json.load(stream)
+        # the output of the xmltodict based EDM writer
+        with open(os.path.join(path, 'edm-example.xml'), 'rb') as stream:
+            self.edm_golden = stream.read()
+
+    def write(self, writer, record):
+        return self.write_record(writer, {'metadata': record})
+
+    def write_record(self, writer, record):
+        metadata = oaipmh.common.Metadata(None, {})
+        metadata.record = record
+        parent = etree.Element('metadata')
+        writer(parent, metadata)
+        return etree.tostring(parent[0], encoding='UTF-8', pretty_print=True)
+
+    def test_edm(self):
+        writer = EDM('edm', None, None)
+        self.assertEqual(self.write(writer, self.edm_record), self.edm_golden)
+        # the record is written directly, without xmltodict
+        self.assertEqual(etree.tostring(writer.build(self.edm_record),
+                                        encoding='UTF-8', pretty_print=True),
+                         self.edm_golden)
+        self.assertEqual(etree.tostring(writer.unparse(self.edm_record),
+                                        encoding='UTF-8', pretty_print=True),
+                         self.edm_golden)
+        # the stored metadata is not changed
+        self.assertFalse('@xmlns:dc' in self.edm_record['rdf:RDF'])
+
+    def test_writer_reuse(self):
+        # the writers build their tags and schema locations once, the
+        # records of different writes do not share elements
+        config = FeedConfig('Test Server', 'http://test')
+        record = {'id': 'oai:spam',
+                  'modified': datetime.datetime(2009, 10, 13, 12, 30),
+                  'metadata': {'title': ['Spam!'], 'date': ['2009'],
+                               'url': ['http://spam'],
+                               'asset': [{'url': 'spam.pdf',
+                                          'mimetype': 'application/pdf',
+                                          'access': 'open',
+                                          'absolute_uri': 'file:///spam'}]}}
+        other = dict(record, id='oai:ham',
+                     metadata={'title': ['Ham!'], 'date': ['2010']})
+        for prefix, writer in [('oai_dc', OAIDC), ('mods', MODS),
+                               ('nl_mods', NL_MODS), ('didl', DIDL),
+                               ('nl_didl', DareDIDL)]:
+            writer = writer(prefix, config, None)
+            first = self.write_record(writer, record)
+            self.assertTrue(b'Spam!' in first)
+            second = self.write_record(writer, other)
+            self.assertTrue(b'Ham!' in second and b'Spam!' not in second)
+            self.assertEqual(self.write_record(writer, record), first)
+            if prefix in ('nl_mods', 'didl', 'nl_didl'):
+                self.assertTrue(b'encoding="iso8601"' in first)
+            elif prefix == 'mods':
+                self.assertTrue(b'encoding="w3cdtf"' in first)
+
+    def test_edm_fallback(self):
+        writer = EDM('edm', None, None)
+        # dct is declared after dcterms for the same namespace, lxml
+        # would use the dcterms prefix, so xmltodict writes the record
+        record = {'rdf:RDF': {'edm:ProvidedCHO': {'dct:created': '1910'}}}
+        self.assertRaises(edm._Unsupported, writer.build, record)
+        self.assertTrue(b'<dct:created>1910</dct:created>' in
+                        self.write(writer, record))
+
+
+class FeedServerTest(TestCase):
+    # tests for the request handling machinery around the oai server,
+    # requests are made directly with webob
+    def setUp(self):
+        self.db = Database()
+        self.db.update_record('oai:spam',
+                              datetime.datetime(2009, 10, 13, 12, 30, 00),
+                              False, {'spam': dict(name=b'spamset')},
+                              {'title': ['Spam!'], 'author': ['Spammer']})
+        self.db.update_record('oai:ham',
+                              datetime.datetime(2010, 10, 13, 12, 30, 00),
+                              False, {'ham': dict(name=b'hamset')},
+                              {'title': ['Ham!']})
+        self.db.flush()
+        self.config = FeedConfig('Test Server',
+                                 'http://test',
+                                 admin_emails=['testuser@localhost'],
+                                 metadata_prefixes=['oai_dc', 'mods'])
+        self.server = Server('http://test', self.db, self.config)
+        self.app = MOAIWSGIApp(self.server)
+
+    def request(self, query, **kwargs):
+        return Request.blank('http://test?%s' % query,
+                             **kwargs).get_response(self.app)
+
+    def strings(self, response, xpath):
+        doc = etree.fromstring(response.body)
+        return [el.text for el in doc.xpath(
+            xpath, namespaces={'oai': 'http://www.openarchives.org/OAI/2.0/',
+                               'dc': 'http://purl.org/dc/elements/1.1/',
+                               'mods': 'http://www.loc.gov/mods/v3'})]
+
+    def test_oai_server_reuse(self):
+        oai_server = self.server.get_oai_server()
+        self.assertTrue(self.server.get_oai_server() is oai_server)
+        response = self.request('verb=ListIdentifiers&metadataPrefix=oai_dc')
+        self.assertEqual(self.strings(response, '//oai:identifier'),
+                         ['oai:ham', 'oai:spam'])
+        self.assertTrue(self.server.get_oai_server() is oai_server)
+        # a config change rebuilds the server
+        self.config.metadata_prefixes.append('didl')
+        self.assertFalse(self.server.get_oai_server() is oai_server)
+        response = self.request('verb=ListMetadataFormats')
+        self.assertEqual(self.strings(response, '//oai:metadataPrefix'),
+                         ['oai_dc', 'mods', 'didl'])
+
+    def test_identify_cache(self):
+        self.config.generation_interval = 0
+        calls = []
+        earliest_datestamp = self.db.oai_earliest_datestamp
+        def counting_earliest_datestamp():
+            calls.append(1)
+            return earliest_datestamp()
+        self.db.oai_earliest_datestamp = counting_earliest_datestamp
+        body = self.request('verb=Identify').body
+        rendered = len(calls)
+        self.assertEqual(self.request('verb=Identify').body, body)
+        self.assertEqual(len(calls), rendered)
+        self.assertEqual(self.strings(self.request('verb=Identify'),
+                                      '//oai:earliestDatestamp'),
+                         ['2009-10-13T12:30:00Z'])
+        # a flush invalidates the cached response
+        self.db.update_record('oai:eggs',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              False, {}, {'title': ['Eggs!']})
+        self.db.flush()
+        self.assertEqual(self.strings(self.request('verb=Identify'),
+                                      '//oai:earliestDatestamp'),
+                         ['2008-10-13T12:30:00Z'])
+        self.assertTrue(len(calls) > rendered)
+
+    def canonical(self, xml):
+        # parsed, canonical xml without the response date and whitespace
+        doc = etree.fromstring(xml, etree.XMLParser(remove_blank_text=True))
+        doc.remove(doc[0])
+        return etree.tostring(doc, method='c14n')
+
+    def test_streaming_list_records(self):
+        oai_server = self.server.get_oai_server()
+        for query in [{'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'},
+                      {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc',
+                       'set': 'spam'}]:
+            response = oai_server.handleRequest(query)
+            self.assertFalse(isinstance(response, bytes))
+            # the output is the same as the pyoai tree server output
+            tree_server = oaipmh.server.BatchingServer(
+                oai_server._server,
+                metadata_registry=oai_server._tree_server._metadata_registry,
+                resumption_batch_size=self.config.batch_size)
+            self.assertEqual(self.canonical(b''.join(response)),
+                             self.canonical(tree_server.handleRequest(query)))
+        # errors are rendered before streaming starts
+        response = self.request('verb=ListRecords&metadataPrefix=oai_dc'
+                                '&from=2030-01-01')
+        self.assertEqual(
+            etree.fromstring(response.body).xpath(
+                '//oai:error/@code',
+                namespaces={'oai': 'http://www.openarchives.org/OAI/2.0/'}),
+            ['noRecordsMatch'])
+
+    def test_compression(self):
+        plain = self.request('verb=ListRecords&metadataPrefix=oai_dc')
+        self.assertEqual(plain.headers.get('Content-Encoding'), None)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        response = self.request('verb=ListRecords&metadataPrefix=oai_dc',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            self.canonical(zlib.decompress(response.body, 16 + zlib.MAX_WBITS)),
+            self.canonical(plain.body))
+        response = self.request(
+            'verb=ListRecords&metadataPrefix=oai_dc',
+            headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(self.canonical(zlib.decompress(response.body)),
+                         self.canonical(plain.body))
+        # cached responses are compressed only once
+        self.assertEqual(self.strings(self.request('verb=Identify'),
+                                      '//oai:compression'),
+                         ['gzip', 'deflate'])
+        body = self.request('verb=Identify',
+                            headers={'Accept-Encoding': 'gzip'}).body
+        self.assertTrue(self.server.identify_response().encode('gzip') is
+                        self.server.identify_response().encode('gzip'))
+        self.assertEqual(self.request('verb=Identify',
+                                      headers={'Accept-Encoding': 'gzip'}).body,
+                         body)
+        # compression can be switched off
+        self.config.compression = []
+        response = self.request('verb=Identify',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(self.strings(response, '//oai:compression'), [])
+
+    def test_conditional_requests(self):
+        query = 'verb=ListRecords&metadataPrefix=mods'
+        response = self.request(query)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(response.headers['Last-Modified'],
+                         format_date_time(calendar.timegm(
+                             self.db.last_modified().utctimetuple())))
+        # the mods ids are stable, so the body is the same every time
+        self.assertEqual(self.canonical(self.request(query).body),
+                         self.canonical(response.body))
+        response = self.request(query, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.request(query, headers={
+            'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_int, 304)
+        # other arguments and other encodings have another etag
+        self.assertNotEqual(
+            self.request('verb=ListRecords&metadataPrefix=oai_dc'
+                         ).headers['ETag'], etag)
+        self.assertNotEqual(
+            self.request(query, headers={'Accept-Encoding': 'gzip'}
+                         ).headers['ETag'], etag)
+        self.assertEqual(
+            self.request(query, headers={'If-None-Match': '"spam", *'}
+                         ).status_int, 200)
+        # a change of the database changes the validators
+        self.db.remove_record('oai:ham')
+        self.db.flush()
+        self.server._generation = (0, None)
+        response = self.request(query, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_conditional_compressed_requests(self):
+        query = 'verb=ListRecords&metadataPrefix=mods'
+        gzip = {'Accept-Encoding': 'gzip'}
+        response = self.request(query, headers=gzip)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        # the client sends back the tag of the compressed response
+        response = self.request(query, headers=dict(gzip, **{
+            'If-None-Match': etag}))
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        # the tag of the plain response is accepted as well
+        plain = self.request(query).headers['ETag']
+        response = self.request(query, headers=dict(gzip, **{
+            'If-None-Match': plain}))
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        # but a client without compression does not have the response
+        response = self.request(query, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['ETag'], plain)
+
+    def test_last_modified_resolution(self):
+        # flushes in the same second get different Last-Modified headers
+        query = 'verb=ListRecords&metadataPrefix=mods'
+        last_modified = self.request(query).headers['Last-Modified']
+        self.db.remove_record('oai:ham')
+        self.db.flush()
+        self.server._generation = (0, None)
+        response = self.request(query, headers={
+            'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['Last-Modified'], last_modified)
+
+    def test_response_cache(self):
+        query = 'verb=ListRecords&metadataPrefix=oai_dc'
+        body = self.request(query).body
+        self.assertEqual(self.strings(self.request(query), '//dc:title'),
+                         ['Ham!', 'Spam!'])
+        # the second response comes from the cache, including its date
+        self.assertEqual(self.request(query).body, body)
+        self.assertEqual(len(self.server._cache._entries), 1)
+        # a flush of the database invalidates the cached responses
+        self.db.remove_record('oai:ham')
+        self.db.flush()
+        self.server._generation = (0, None)
+        self.assertEqual(self.strings(self.request(query), '//dc:title'),
+                         ['Spam!'])
+        # responses are shared with other processes through a directory
+        directory = tempfile.mkdtemp()
+        try:
+            self.config.response_cache_dir = directory
+            server = Server('http://test', self.db, self.config)
+            body = server.handle_request(WSGIRequest(
+                Request.blank('http://test?%s' % query))).body
+            self.assertEqual(len(os.listdir(directory)), 1)
+            other = Server('http://test', self.db, self.config)
+            self.assertEqual(other.handle_request(WSGIRequest(
+                Request.blank('http://test?%s' % query))).body, body)
+        finally:
+            shutil.rmtree(directory)
+        # the cache is bounded by size
+        cache = ResponseCache(1000)
+        for num in range(10):
+            cache.set(str(num), b'x' * 200)
+        self.assertEqual(cache.size, 1000)
+        self.assertEqual(cache.get('0'), None)
+        self.assertEqual(cache.get('9').data, b'x' * 200)
+        self.assertEqual(cache.set('big', b'x' * 251).data, b'x' * 251)
+        self.assertEqual(cache.get('big'), None)
+        # the compressed versions of the responses are counted
+        cache = ResponseCache(1000)
+        for num in range(5):
+            cache.set(str(num), b'x' * 200)
+        body = cache.get('4')
+        gzipped = body.encode('gzip')
+        self.assertEqual(body.encode('gzip'), gzipped)
+        body.encode('deflate', 9)
+        self.assertEqual(sum([entry[2] for entry in cache._entries.values()]),
+                         cache.size)
+        self.assertEqual(cache._entries['4'][2], body.size())
+        self.assertTrue(cache.size <= cache.max_size)
+        self.assertEqual(cache.get('0'), None)
+        # a removed body does not change the size of the cache
+        cache.clear()
+        body.encode('gzip', 1)
+        self.assertEqual(cache.size, 0)
+
+    def test_render_pool(self):
+        self.config.response_cache_size = 0
+        query = 'verb=ListRecords&metadataPrefix=mods'
+        self.server = Server('http://test', self.db, self.config)
+        self.app = MOAIWSGIApp(self.server)
+        body = self.canonical(self.request(query).body)
+        for kind in ['thread', 'process']:
+            self.config.render_pool = kind
+            self.config.render_workers = 2
+            self.config.render_threshold = 1
+            self.assertEqual(self.canonical(self.request(query).body), body)
+            # small pages are rendered serially
+            self.config.render_threshold = 3
+            self.assertEqual(self.canonical(self.request(query).body), body)
+        self.config.batch_size = 1
+        response = self.request(query)
+        self.assertEqual(self.strings(response, '//oai:identifier'),
+                         ['oai:ham'])
+        self.assertEqual(len(self.strings(response, '//oai:resumptionToken')),
+                         1)
+
+    def test_page_budget(self):
+        self.config.response_cache_size = 0
+        self.db.update_record('oai:eggs',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              False, {}, {'title': ['Eggs!']})
+        self.db.flush()
+        query = 'verb=ListRecords&metadataPrefix=%s'
+        # a page ends after the record that exceeds the budget
+        self.config.page_budgets = {'mods': 1, None: 10000}
+        response = self.request(query % 'oai_dc')
+        self.assertEqual(self.strings(response, '//oai:identifier'),
+                         ['oai:ham', 'oai:spam', 'oai:eggs'])
+        self.assertEqual(self.strings(response, '//oai:resumptionToken'), [])
+        identifiers = []
+        response = self.request(query % 'mods')
+        while True:
+            identifiers.extend(self.strings(response, '//oai:identifier'))
+            tokens = self.strings(response, '//oai:resumptionToken')
+            if not tokens:
+                break
+            response = self.request('verb=ListRecords&resumptionToken=%s' %
+                                    quote(tokens[0]))
+        self.assertEqual(identifiers, ['oai:ham', 'oai:spam', 'oai:eggs'])
+        for kind in ['thread', None]:
+            self.config.render_pool = kind
+            self.config.render_threshold = 1
+            self.config.page_budgets = {None: 600}
+            response = self.request(query % 'oai_dc')
+            self.assertEqual(self.strings(response, '//oai:identifier'),
+                             ['oai:ham', 'oai:spam'])
+            token = self.strings(response, '//oai:resumptionToken')[0]
+            self.assertEqual(decode_resumption_token(token)[1], 2)
+
+    def test_send_file(self):
+        fd, path = tempfile.mkstemp()
+        data = bytes(range(256)) * 1000
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+        try:
+            def send(ranges=False, **kwargs):
+                request = Request.blank('http://test/asset', **kwargs)
+                response = WSGIRequest(request).send_file(
+                    path, 'application/pdf', ranges=ranges)
+                return request.get_response(response)
+            response = send()
+            self.assertTrue(isinstance(response.app_iter, FileIterable))
+            self.assertEqual(response.body, data)
+            self.assertEqual(response.content_length, len(data))
+            self.assertEqual(response.headers['Accept-Ranges'], 'none')
+            # ranges are ignored unless they are enabled
+            response = send(headers={'Range': 'bytes=10-19'})
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, data)
+            response = send(ranges=True, headers={'Range': 'bytes=10-19'})
+            self.assertEqual(response.status_int, 206)
+            self.assertEqual(response.body, data[10:20])
+            self.assertEqual(response.headers['Content-Range'],
+                             'bytes 10-19/%s' % len(data))
+            response = send(ranges=True, headers={'Range': 'bytes=-70000'})
+            self.assertEqual(response.body, data[-70000:])
+            response = send(headers={'If-None-Match': response.etag})
+            self.assertEqual(response.status_int, 304)
+            # the server sends the file if it can
+            wrapped = []
+            def file_wrapper(fileobj, block_size):
+                wrapped.append(block_size)
+                return iter(lambda: fileobj.read(block_size), b'')
+            response = send(environ={'wsgi.file_wrapper': file_wrapper})
+            self.assertEqual(response.body, data)
+            self.assertEqual(wrapped, [FileIterator.chunk_size])
+        finally:
+            os.remove(path)
+
+    def test_asset_access(self):
+        self.db.update_record('oai:eggs',
+                              datetime.datetime(2008, 10, 13, 12, 30, 00),
+                              True, {}, {'title': ['Eggs!']})
+        self.db.flush()
+        self.assertTrue(self.server.allow_download('asset/oai:spam/spam.pdf',
+                                                   self.config))
+        self.assertFalse(self.server.is_visible('oai:eggs', self.config))
+        self.assertFalse(self.server.is_visible('oai:bacon', self.config))
+        self.config.sets_deleted.add('spam')
+        self.assertFalse(self.server.is_visible('oai:spam', self.config))
+        self.config.sets_deleted.clear()
+        self.config.sets_needed.add('ham')
+        self.assertFalse(self.server.is_visible('oai:spam', self.config))
+        self.assertTrue(self.server.is_visible('oai:ham', self.config))
+        # the answers are cached until the database changes
+        calls = []
+        oai_visible = self.db.oai_visible
+        def counting_oai_visible(*args, **kwargs):
+            calls.append(args)
+            return oai_visible(*args, **kwargs)
+        self.db.oai_visible = counting_oai_visible
+        self.assertTrue(self.server.is_visible('oai:ham', self.config))
+        self.assertEqual(calls, [])
+        self.db.remove_record('oai:ham')
+        self.db.flush()
+        self.server._generation = (0, None)
+        self.assertFalse(self.server.is_visible('oai:ham', self.config))
+        self.assertEqual(calls, [('oai:ham',)])
+        # a full cache evicts the least recently used answers
+        self.server.access_cache_size = 2
+        del calls[:]
+        self.server.is_visible('oai:spam', self.config)
+        self.server.is_visible('oai:ham', self.config)
+        self.server.is_visible('oai:eggs', self.config)
+        self.assertEqual(len(self.server._access), 2)
+        self.server.is_visible('oai:ham', self.config)
+        self.server.is_visible('oai:eggs', self.config)
+        self.assertEqual(calls, [('oai:spam',), ('oai:eggs',)])
+        self.server.is_visible('oai:spam', self.config)
+        self.assertEqual(calls[-1], ('oai:spam',))
+        self.assertEqual([key[0] for key in self.server._access],
+                         ['oai:eggs', 'oai:spam'])
+
+    def test_assets(self):
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(b'%PDF spam')
+        try:
+            filename = os.path.basename(path)
+            self.db.update_record(
+                'oai:spam',
+                datetime.datetime(2009, 10, 13, 12, 30, 00),
+                False, {'spam': dict(name=b'spamset')},
+                {'title': ['Spam!'],
+                 'asset': [{'absolute_uri': 'file://%s' % path,
+                            'url': 'http://test/asset/oai:spam/%s' % filename,
+                            'md5': 'abcdef',
+                            'mimetype': 'application/pdf'}]})
+            self.db.flush()
+            asset = self.db.get_asset('oai:spam', filename)
+            self.assertEqual((asset['path'], asset['size'], asset['mimetype']),
+                             (path, 9, 'application/pdf'))
+            self.assertEqual(self.db.get_asset('oai:spam', 'abcdef'), asset)
+            self.assertEqual(self.db.get_assets('oai:spam'), [asset])
+            self.assertEqual(self.db.get_asset('oai:ham', filename), None)
+            response = Request.blank('http://test/asset/oai:spam/abcdef'
+                                     ).get_response(self.app)
+            self.assertEqual(response.body, b'%PDF spam')
+            self.assertEqual(response.content_type, 'application/pdf')
+            # the headers are made from the stored size and mtime
+            self.assertEqual(response.etag, '%x-%x' % (
+                calendar.timegm(asset['mtime'].utctimetuple()), 9))
+            self.assertEqual(response.content_length, 9)
+            response = Request.blank('http://test/asset/oai:spam/eggs.pdf'
+                                     ).get_response(self.app)
+            self.assertEqual(response.status_int, 404)
+            # updating the record replaces the assets
+            self.db.update_record('oai:spam',
+                                  datetime.datetime(2009, 10, 13, 12, 30, 00),
+                                  False, {}, {'title': ['Spam!']},
+                                  assets=[{'filename': 'spam.txt',
+                                           'path': path}])
+            self.db.flush()
+            self.assertEqual([asset['filename'] for asset in
+                              self.db.get_assets('oai:spam')], ['spam.txt'])
+            # invalid assets are skipped or their invalid values ignored,
+            # the record is still stored
+            with self.assertLogs('moai.database', 'WARNING') as logs:
+                self.db.update_record(
+                    'oai:spam', datetime.datetime(2009, 10, 13, 12, 30, 00),
+                    False, {}, {'title': ['Spam!'],
+                                'asset': ['spam.pdf', {'md5': 'abcdef'},
+                                          {'filename': 'spam.pdf',
+                                           'path': path,
+                                           'size': 'large',
+                                           'mtime': 'yesterday'}]})
+                self.db.flush()
+            self.assertEqual(len(logs.output), 3)
+            self.assertEqual(self.db.get_record('oai:spam')['metadata'][
+                'title'], ['Spam!'])
+            asset = self.db.get_asset('oai:spam', 'spam.pdf')
+            self.assertEqual(asset['size'], 9)
+            self.assertEqual(asset['mtime'], datetime.datetime.utcfromtimestamp(
+                os.stat(path).st_mtime))
+            self.db.remove_record('oai:spam')
+            self.assertEqual(self.db.get_assets('oai:spam'), [])
+        finally:
+            os.remove(path)
+
+    def test_asset_offload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'spam eggs.pdf')
+            with open(path, 'wb') as stream:
+                stream.write(b'%PDF spam')
+            self.db.update_record(
+                'oai:spam', datetime.datetime(2009, 10, 13, 12, 30, 00),
+                False, {}, {'title': ['Spam!']},
+                assets=[{'filename': 'spam.pdf', 'path': path}])
+            self.db.flush()
+            self.config.base_asset_path = directory
+            self.config.asset_offload = 'x-accel-redirect'
+            self.config.asset_offload_prefix = '/protected/'
+            url = 'http://test/asset/oai:spam/spam.pdf'
+            response = Request.blank(url).get_response(self.app)
+            self.assertEqual(response.headers['X-Accel-Redirect'],
+                             '/protected/spam%20eggs.pdf')
+            self.assertEqual(response.body, b'')
+            self.config.asset_offload = 'x-sendfile'
+            response = Request.blank(url).get_response(self.app)
+            self.assertEqual(response.headers['X-Sendfile'],
+                             os.path.realpath(path))
+            # files outside the asset path are sent by moai
+            self.config.base_asset_path = os.path.join(directory, 'other')
+            response = Request.blank(url).get_response(self.app)
+            self.assertFalse('X-Sendfile' in response.headers)
+            self.assertEqual(response.body, b'%PDF spam')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_export(self):
+        # the export is disabled by default
+        self.assertEqual(Request.blank('http://test/export').get_response(
+            self.app).content_type, 'text/xml')
+        self.config.export_enabled = True
+        auth = {'Authorization': 'Bearer secret'}
+        # without a token nobody can export
+        self.assertEqual(Request.blank('http://test/export').get_response(
+            self.app).status_int, 403)
+        self.config.export_token = 'secret'
+        self.assertEqual(Request.blank('http://test/export').get_response(
+            self.app).status_int, 403)
+        self.assertEqual(Request.blank(
+            'http://test/export',
+            headers={'Authorization': 'Bearer secreT'}).get_response(
+                self.app).status_int, 403)
+        response = Request.blank('http://test/export?limit=1',
+                                 headers=auth).get_response(self.app)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual(lines, [{'id': 'oai:spam',
+                                  'modified': '2009-10-13T12:30:00Z',
+                                  'deleted': False,
+                                  'sets': ['spam'],
+                                  'metadata': {'title': ['Spam!'],
+                                               'author': ['Spammer']}}])
+        response = Request.blank(
+            'http://test/export?limit=1&cursor=%s' % (
+                response.headers['X-Next-Cursor']),
+            headers=auth).get_response(self.app)
+        self.assertEqual([json.loads(line)['id'] for line in
+                          response.body.splitlines()], ['oai:ham'])
+        self.assertFalse('X-Next-Cursor' in response.headers)
+        response = Request.blank(
+            'http://test/export?format=json&set=ham&from=2010-01-01',
+            headers=auth).get_response(self.app)
+        self.assertEqual([record['id'] for record in json.loads(response.body)],
+                         ['oai:ham'])
+        # until includes the whole day, as in OAI-PMH
+        for until, ids in [('2010-10-13', ['oai:spam', 'oai:ham']),
+                           ('2010-10-12', ['oai:spam']),
+                           ('2010-10-13T12:29:59Z', ['oai:spam'])]:
+            response = Request.blank(
+                'http://test/export?format=json&until=%s' % until,
+                headers=auth).get_response(self.app)
+            self.assertEqual([record['id'] for record in
+                              json.loads(response.body)], ids)
+        self.config.sets_deleted.add('ham')
+        response = Request.blank('http://test/export?format=json&until=2011',
+                                 headers=auth).get_response(self.app)
+        self.assertEqual(response.status_int, 400)
+        response = Request.blank('http://test/export?format=json',
+                                 headers=auth).get_response(self.app)
+        self.assertEqual([(record['id'], record['deleted'], record['metadata'])
+                          for record in json.loads(response.body)],
+                         [('oai:spam', False, {'title': ['Spam!'],
+                                               'author': ['Spammer']}),
+                          ('oai:ham', True, None)])
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            manifest = dump_feed(self.db, self.config, 'oai_dc', directory,
+                                 records_per_file=1, jobs=1)
+            self.assertEqual(manifest['records'], 2)
+            dump_id = manifest['dump']
+            self.assertEqual([entry['name'] for entry in manifest['files']],
+                             ['oai_dc-%s-00001.xml.gz' % dump_id,
+                              'oai_dc-%s-00002.xml.gz' % dump_id])
+            with open(os.path.join(directory,
+                                   'manifest-oai_dc.json')) as stream:
+                self.assertEqual(json.load(stream), manifest)
+            titles = []
+            for entry in manifest['files']:
+                with gzip.open(os.path.join(directory, entry['name'])) as stream:
+                    doc = etree.fromstring(stream.read())
+                titles.extend(doc.xpath(
+                    '//dc:title/text()',
+                    namespaces={'dc': 'http://purl.org/dc/elements/1.1/'}))
+            # the records are in the order of their modification date
+            self.assertEqual(titles, ['Spam!', 'Ham!'])
+            self.assertRaises(ValueError, dump_feed, self.db, self.config,
+                              'didl', directory)
+            # a new dump does not overwrite the files of the earlier dump,
+            # these are removed by the dump after it
+            first = manifest
+            second = dump_feed(self.db, self.config, 'oai_dc', directory,
+                               records_per_file=2, jobs=1)
+            self.assertNotEqual(second['dump'], first['dump'])
+            names = [entry['name'] for entry in second['files']]
+            self.assertEqual(sorted(os.listdir(directory)), sorted(
+                [entry['name'] for entry in first['files']] + names +
+                ['manifest-oai_dc.json']))
+            third = dump_feed(self.db, self.config, 'oai_dc', directory,
+                              records_per_file=2, jobs=1)
+            self.assertEqual(sorted(os.listdir(directory)), sorted(
+                names + [entry['name'] for entry in third['files']] +
+                ['manifest-oai_dc.json']))
+            # another format has its own manifest in the same directory
+            mods = dump_feed(self.db, self.config, 'mods', directory,
+                             records_per_file=2, jobs=1)
+            with open(os.path.join(directory,
+                                   'manifest-oai_dc.json')) as stream:
+                self.assertEqual(json.load(stream), third)
+            with open(os.path.join(directory, 'manifest-mods.json')) as stream:
+                self.assertEqual(json.load(stream), mods)
+            self.assertEqual(sorted(os.listdir(directory)), sorted(
+                names + [entry['name'] for entry in third['files']] +
+                [entry['name'] for entry in mods['files']] +
+                ['manifest-oai_dc.json', 'manifest-mods.json']))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_passthrough(self):
+        harvested = b'''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"
+  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+  xmlns:dc="http://purl.org/dc/elements/1.1/"
+  xmlns:dcterms="http://purl.org/dc/terms/"
+  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<ListRecords><record>
+<header><identifier>oai:edm</identifier>
+<datestamp>2011-10-13T12:30:00Z</datestamp></header>
+<metadata><rdf:RDF xmlns:edm="http://www.europeana.eu/schemas/edm/">
+<edm:ProvidedCHO rdf:about="#edm"><dc:title>Eggs &amp; Spam</dc:title>
+<dcterms:created xsi:type="dcterms:W3CDTF">1910</dcterms:created>
+</edm:ProvidedCHO></rdf:RDF></metadata>
+</record></ListRecords></OAI-PMH>'''
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'edm.xml'), 'wb') as stream:
+                stream.write(harvested)
+            provider = EdmBasedContentProvider('edm://%s' % directory)
+            provider.set_logger(logging.getLogger('moai.test'))
+            provider.set_set('edm')
+            provider.set_passthrough(True)
+            content = EdmContent(provider)
+            content.update(list(provider.update())[0])
+        finally:
+            shutil.rmtree(directory)
+        payload = content.payloads['edm']
+        # the namespaces of the OAI-PMH document are declared on rdf:RDF
+        self.assertEqual(etree.fromstring(payload).nsmap,
+                         {'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+                          'dc': 'http://purl.org/dc/elements/1.1/',
+                          'dcterms': 'http://purl.org/dc/terms/',
+                          'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+                          'edm': 'http://www.europeana.eu/schemas/edm/'})
+        self.db.payload_compression = 'zlib'
+        self.db.update_record(content.id, content.modified, content.deleted,
+                              {'edm': dict(name=b'edm')}, content.metadata,
+                              payloads=content.payloads)
+        self.db.flush()
+        row = self.db._payloads.select().execute().fetchone()
+        self.assertEqual(zlib.decompress(row.data), payload)
+        self.assertEqual(self.db.get_payloads(['oai:edm', 'oai:spam'], 'edm'),
+                         {'oai:edm': payload})
+
+        self.config.metadata_prefixes.append('edm')
+        self.config.passthrough = ['edm']
+        # the stored XML is copied into the response as it is
+        body = self.request('verb=ListRecords&metadataPrefix=edm&set=edm').body
+        self.assertTrue(b'<metadata>' + payload + b'</metadata>' in body)
+        doc = etree.fromstring(body)
+        self.assertEqual(doc.xpath(
+            '//dc:title/text()',
+            namespaces={'dc': 'http://purl.org/dc/elements/1.1/'}),
+                         ['Eggs & Spam'])
+        body = self.request(
+            'verb=GetRecord&metadataPrefix=edm&identifier=oai:edm').body
+        rdf = etree.fromstring(body).xpath(
+            '//rdf:RDF',
+            namespaces={'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'})
+        elements = lambda e: [(el.tag, el.text, dict(el.attrib))
+                              for el in e.iter()]
+        self.assertEqual(elements(rdf[0]),
+                         elements(etree.fromstring(payload)))
+
+    def test_related_prefetch(self):
+        # the related contributors are fetched with one query per chunk
+        for id, surname in [('person:1', 'Spammer'), ('person:2', 'Hammer')]:
+            self.db.update_record(id, datetime.datetime(2008, 1, 1),
+                                  False, {'persons': dict(name=b'persons')},
+                                  {'name': [surname], 'surname': [surname]})
+        self.db.update_record('oai:eggs', datetime.datetime(2011, 1, 1),
+                              False, {'eggs': dict(name=b'eggset')},
+                              {'title': ['Eggs!'],
+                               'author_rel': ['person:1', 'person:2'],
+                               'editor_rel': ['person:2', 'person:3']})
+        self.db.update_record('oai:bacon', datetime.datetime(2012, 1, 1),
+                              False, {'eggs': dict(name=b'eggset')},
+                              {'title': ['Bacon!'],
+                               'advisor_rel': ['person:1']})
+        self.db.flush()
+        calls = []
+        get_metadata_many = self.db.get_metadata_many
+        def counting_get_metadata_many(ids):
+            calls.append(sorted(ids))
+            return get_metadata_many(ids)
+        self.db.get_metadata_many = counting_get_metadata_many
+        self.db.get_metadata = None
+        response = self.request(
+            'verb=ListRecords&metadataPrefix=mods&set=eggs')
+        # the records are prepared in chunks of 1, 2, 4 ... records while
+        # the page is streamed, one query per chunk
+        self.assertEqual(calls, [['person:1']])
+        response.body
+        self.assertEqual(calls, [['person:1'],
+                                 ['person:1', 'person:2', 'person:3']])
+        self.assertEqual(self.strings(
+            response, '//mods:mods/mods:name/mods:displayForm'),
+                         ['Spammer', 'Spammer', 'Hammer', 'Hammer'])
+        self.assertEqual(self.strings(
+            response, '//mods:roleTerm[@type="code"]'),
+                         ['ths', 'aut', 'aut', 'edt'])
+        del calls[:]
+        response = self.request(
+            'verb=GetRecord&metadataPrefix=mods&identifier=oai:bacon')
+        self.assertEqual(calls, [['person:1']])
+        self.assertEqual(self.strings(
+            response, '//mods:mods/mods:name/mods:displayForm'),
+                         ['Spammer'])
+        # records without related contributors do not query at all
+        del calls[:]
+        response = self.request('verb=ListRecords&metadataPrefix=mods&set=ham')
+        self.assertEqual(self.strings(response, '//mods:titleInfo/mods:title'),
+                         ['Ham!'])
+        self.assertEqual(calls, [])
+
+    def test_metrics(self):
+        labels = ('Test Server', 'ListRecords')
+        requests = metrics.REQUESTS.get(labels)
+        sent = metrics.RESPONSE_BYTES.get(labels)
+        hits = metrics.CACHE_REQUESTS.get(('Test Server', 'identify', 'hit'))
+        writes = metrics.WRITER_SECONDS.count(('oai_dc',))
+        # the metrics page is not enabled by default
+        self.assertFalse(b'moai_requests_total' in self.request('metrics').body)
+        self.config.metrics_enabled = True
+        # streamed responses are counted when they are completely sent
+        body = self.request('verb=ListRecords&metadataPrefix=oai_dc').body
+        self.assertEqual(metrics.REQUESTS.get(labels), requests + 1)
+        self.assertEqual(metrics.RESPONSE_BYTES.get(labels),
+                         sent + len(body))
+        self.assertEqual(metrics.WRITER_SECONDS.count(('oai_dc',)), writes + 2)
+        self.request('verb=Identify')
+        self.request('verb=Identify')
+        self.assertTrue(metrics.CACHE_REQUESTS.get(
+            ('Test Server', 'identify', 'hit')) > hits)
+        response = Request.blank('http://test/metrics').get_response(self.app)
+        self.assertEqual(response.content_type, 'text/plain')
+        body = response.body.decode('utf8')
+        self.assertTrue('# TYPE moai_request_seconds histogram' in body)
+        self.assertTrue('moai_requests_total{feed="Test Server",'
+                        'verb="ListRecords"} %s' % (requests + 1) in body)
+        self.assertTrue('moai_request_seconds_bucket{feed="Test Server",'
+                        'verb="ListRecords",le="+Inf"} %s' % (
+            metrics.REQUEST_SECONDS.count(labels)) in body)
+        self.assertTrue('moai_query_rows_total{query="oai_query"}' in body)
+
+    def test_shared_database(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'moai.db')
+            db = Database('sqlite:///%s' % path)
+            # all feeds of a database share its engine and set catalogue
+            other = Database('sqlite:///%s' % os.path.relpath(path))
+            self.assertTrue(other._db is db._db)
+            self.assertFalse(Database()._db is self.db._db)
+            db.update_record('oai:spam',
+                             datetime.datetime(2009, 10, 13, 12, 30, 00),
+                             False, {'spam': dict(name=b'spamset')},
+                             {'title': ['Spam!']})
+            db.flush()
+            spam_config = FeedConfig('Spam Feed', 'http://test/spam',
+                                     sets_allowed=['spam'])
+            ham_config = FeedConfig('Ham Feed', 'http://test/ham',
+                                    sets_allowed=['ham'])
+            spam_app = MOAIWSGIApp(Server('http://test/spam', db, spam_config))
+            ham_app = MOAIWSGIApp(Server('http://test/ham', other, ham_config))
+            query = '?verb=ListIdentifiers&metadataPrefix=oai_dc'
+            response = Request.blank(
+                'http://test/spam' + query).get_response(spam_app)
+            self.assertEqual(self.strings(response, '//oai:identifier'),
+                             ['oai:spam'])
+            response = Request.blank(
+                'http://test/ham' + query).get_response(ham_app)
+            self.assertTrue(b'noRecordsMatch' in response.body)
+            self.assertEqual([s['id'] for s in other.oai_sets()], ['spam'])
+            # a change by one of the feeds reloads the shared catalogue
+            db.update_record('oai:ham',
+                             datetime.datetime(2010, 10, 13, 12, 30, 00),
+                             False, {'ham': dict(name=b'hamset')},
+                             {'title': ['Ham!']})
+            db.flush()
+            self.assertEqual([s['id'] for s in other.oai_sets()],
+                             ['spam', 'ham'])
+            self.assertEqual(other.get_set('ham')['id'], 'ham')
+            self.assertEqual(other.get_setrefs('oai:ham'), ['ham'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_asgi(self):
+        app = MOAIASGIApp(self.server, workers=2)
+        def request(query, headers=()):
+            messages = [{'type': 'http.request', 'body': b''}]
+            sent = []
+            async def receive():
+                return messages.pop(0)
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'scheme': 'http',
+                     'path': '/', 'query_string': query.encode('ascii'),
+                     'headers': [(b'host', b'test')] + list(headers),
+                     'server': ('test', 80)}
+            asyncio.run(app(scope, receive, send))
+            body = b''.join([message.get('body', b'') for message in sent[1:]])
+            return sent[0], body
+        query = 'verb=ListRecords&metadataPrefix=oai_dc'
+        start, body = request(query)
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(self.canonical(body),
+                         self.canonical(self.request(query).body))
+        self.assertTrue(sent_header(start, b'etag'))
+        start, body = request(query, [(b'if-none-match',
+                                       sent_header(start, b'etag'))])
+        self.assertEqual(start['status'], 304)
+        app.shutdown()
+        # a file database can only be used in the thread that opened the
+        # cursor of a streamed response
+        directory = tempfile.mkdtemp()
+        try:
+            db = get_database('sqlite:///%s' % os.path.join(directory,
+                                                           'moai.db'))
+            for num in range(30):
+                db.update_record('oai:%s' % num,
+                                 datetime.datetime(2009, 1, 1, num % 24),
+                                 False, {'spam': dict(name=b'spamset')},
+                                 {'title': ['Spam %s' % num]})
+            db.flush()
+            self.config.batch_size = 20
+            app = MOAIASGIApp(Server('http://test', db, self.config),
+                              workers=4)
+            start, body = request('verb=ListRecords&metadataPrefix=oai_dc')
+            self.assertEqual(start['status'], 200)
+            self.assertEqual(body.count(b'<record>'), 20)
+            self.assertTrue(b'resumptionToken' in body)
+            app.shutdown()
+        finally:
+            shutil.rmtree(directory)
+
+
+class AdmissionControlTest(TestCase):
+
+    def setUp(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter([b'spam', b'ham'])
+        self.app = AdmissionControl(app,
+                                    max_active=2,
+                                    max_queue=1,
+                                    max_per_client=2,
+                                    queue_timeout=0.1,
+                                    stats_path='/stats')
+
+    def request(self, client, path='/'):
+        response = Request.blank(path, remote_addr=client).call_application(
+            self.app)
+        return response
+
+    def test_limits(self):
+        status, headers, first = self.request('10.0.0.1')
+        self.assertEqual(status, '200 OK')
+        status, headers, second = self.request('10.0.0.1')
+        self.assertEqual(status, '200 OK')
+        # the client has two responses that are not completely sent
+        status, headers, body = self.request('10.0.0.1')
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(dict(headers)['Retry-After'], '30')
+        # other clients wait in the queue for a free slot
+        status, headers, body = self.request('10.0.0.2')
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(self.app.stats()['rejected'], 2)
+        self.assertTrue(self.app.stats()['wait_time_max'] < 0.1)
+        self.assertEqual(list(first), [b'spam', b'ham'])
+        first.close()
+        status, headers, third = self.request('10.0.0.2')
+        self.assertEqual(status, '200 OK')
+        status, headers, body = self.request('10.0.0.2', '/stats')
+        self.assertTrue(b'active 2\n' in b''.join(body))
+        self.assertTrue(b'admitted 3\n' in b''.join(body))
+        second.close()
+        third.close()
+        self.assertEqual(self.app.stats()['active'], 0)
+        self.assertEqual(self.app._clients, {})
+
+    def test_file_wrapper(self):
+        # the wsgi.file_wrapper of the server is returned as it is, so
+        # the server can still send the file itself
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return environ['wsgi.file_wrapper'](io.BytesIO(b'spam'), 8192)
+        self.app.app = app
+        environ = Request.blank('/', remote_addr='10.0.0.1').environ
+        environ['wsgi.file_wrapper'] = FileWrapper
+        result = self.app(environ, lambda status, headers: None)
+        self.assertTrue(isinstance(result, FileWrapper))
+        self.assertEqual(self.app.stats()['active'], 1)
+        self.assertEqual(list(result), [b'spam'])
+        result.close()
+        result.close()
+        self.assertTrue(result.filelike.closed)
+        self.assertEqual(self.app.stats()['active'], 0)
+        self.assertEqual(self.app._clients, {})
+
+
+class ProfilerTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            if 'slow' in environ['QUERY_STRING']:
+                time.sleep(0.2)
+            return iter([b'spam', b'ham'])
+        self.app = app
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def request(self, app, query):
+        return Request.blank('/oai?%s' % query).get_response(app).body
+
+    def test_sampling(self):
+        app = Profiler(self.app, self.directory, sample_rate=2,
+                       name='Test Server')
+        self.assertEqual(self.request(
+            app, 'verb=ListRecords&metadataPrefix=oai_dc'), b'spamham')
+        self.assertEqual(os.listdir(self.directory), [])
+        # every second request is profiled
+        self.assertEqual(self.request(
+            app, 'verb=ListRecords&metadataPrefix=oai_dc'), b'spamham')
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        self.assertTrue('-Test_Server-ListRecords-oai_dc-' in names[0])
+        self.assertTrue(names[0].endswith('.prof'))
+        stats = pstats.Stats(os.path.join(self.directory, names[0]))
+        self.assertTrue(stats.total_calls > 0)
+
+    def test_slow_requests(self):
+        app = Profiler(self.app, self.directory, sample_rate=0,
+                       slow_threshold=0.05, sample_interval=0.005,
+                       max_files=1)
+        self.request(app, 'verb=Identify')
+        self.assertEqual(os.listdir(self.directory), [])
+        self.request(app, 'verb=ListSets&slow=1')
+        self.request(app, 'verb=GetRecord&metadataPrefix=mods&slow=1')
+        # only the newest profile is kept
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        self.assertTrue('-GetRecord-mods-' in names[0])
+        self.assertTrue(names[0].endswith('.folded'))
+        with open(os.path.join(self.directory, names[0])) as stream:
+            # the stacks end in the sleeping application
+            self.assertTrue(':app ' in stream.read())
+
+    def test_file_wrapper(self):
+        # a profiled asset download still returns the wsgi.file_wrapper
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return environ['wsgi.file_wrapper'](io.BytesIO(b'spam'), 8192)
+        app = Profiler(app, self.directory, sample_rate=1)
+        environ = Request.blank('/oai/asset/spam/spam.pdf').environ
+        environ['wsgi.file_wrapper'] = FileWrapper
+        result = app(environ, lambda status, headers: None)
+        self.assertTrue(isinstance(result, FileWrapper))
+        self.assertEqual(list(result), [b'spam'])
+        self.assertEqual(os.listdir(self.directory), [])
+        result.close()
+        result.close()
+        self.assertTrue(result.filelike.closed)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        # the next request can be profiled again
+        app(environ, lambda status, headers: None).close()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+def sent_header(start, name):
+    for key, value in start['headers']:
+        if key == name:
+            return value
+
+
 def suite():    
     test_suite = TestSuite()
     test_suite.addTest(makeSuite(XPathUtilTest))
     test_suite.addTest(makeSuite(DatabaseTest))
     test_suite.addTest(makeSuite(ProviderTest))
     test_suite.addTest(makeSuite(ServerTest))
+    test_suite.addTest(makeSuite(MetadataFormatTest))
+    test_suite.addTest(makeSuite(FeedServerTest))
+    test_suite.addTest(makeSuite(AdmissionControlTest))
+    test_suite.addTest(makeSuite(ProfilerTest))
     # note that tests of the oai protocol itself are done in the
     # pyoai codebase
     return test_suite
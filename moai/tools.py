@@ -3,9 +3,6 @@ import sys
 import os
 import time
 import datetime
-import pkg_resources
-from moai.directus import Directus
-from pkg_resources import iter_entry_points
 import configparser
 
 from optparse import OptionParser
@@ -14,38 +11,15 @@ from moai.utils import (get_duration,
                         get_moai_log,
                         ProgressBar)
 from moai.database import SQLDatabase
+from moai.plugins import get_plugin, get_version
+from moai.passthrough import get_formats
 
-VERSION = pkg_resources.working_set.by_key['moai'].version
+VERSION = get_version('moai')
                  
-def update_moai():
-    usage = "usage: %prog [options] profilename"
-    version = "%%prog %s" % VERSION
-
-    parser = OptionParser(usage, version=version)
-
-    parser.add_option("-v", "--verbose", dest="verbose",
-                      help="print logging at info level",
-                      action="store_true")
-    parser.add_option('-d', '--debug', dest='debug',
-                      help="print traceback and quit on error",
-                      action='store_true')
-    parser.add_option("-q", "--quiet", dest="quiet",
-                      help="be quiet, do not output and info",
-                      action="store_true")
-    parser.add_option("", "--config", dest="config",
-                      help="specify settings file",
-                      action="store")
-    parser.add_option("", "--date", dest="from_date",
-                      help="Only update database from a specific date",
-                      action="store")
-    parser.add_option("", "--set", dest="set",
-                      help="Override dataset of the records",
-                      action="store")
-    parser.add_option("", "--directus", dest="directus",
-                      help="specify credentials for Directus API in form of dict.__repr__()",
-                      action="store")
-
-    options, args = parser.parse_args()
+def get_profile_config(options, args):
+    """Returns the configuration of the profile (a feed section of the
+    settings file) named in the command line arguments, or exits with an
+    error message"""
     if not len(args):
         profile_name = 'default'
     else:
@@ -82,6 +56,38 @@ def update_moai():
             sys.stderr.write('unknown profile: %s\n' % profile_name)
         sys.stderr.write('(known profiles are: %s)\n' % ', '.join(profiles))
         sys.exit(1)
+    return config
+
+def update_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      help="print logging at info level",
+                      action="store_true")
+    parser.add_option('-d', '--debug', dest='debug',
+                      help="print traceback and quit on error",
+                      action='store_true')
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      help="be quiet, do not output and info",
+                      action="store_true")
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--date", dest="from_date",
+                      help="Only update database from a specific date",
+                      action="store")
+    parser.add_option("", "--set", dest="set",
+                      help="Override dataset of the records",
+                      action="store")
+    parser.add_option("", "--directus", dest="directus",
+                      help="specify credentials for Directus API in form of dict.__repr__()",
+                      action="store")
+
+    options, args = parser.parse_args()
+    config = get_profile_config(options, args)
 
     if options.from_date:
         if 'T' in options.from_date:
@@ -94,6 +100,7 @@ def update_moai():
         from_date = None
 
     if config['database'].startswith('directus://'):
+        from moai.directus import Directus
         conf: dict = json.loads(options.directus)
         database = Directus(config['database'],
                             config,
@@ -101,26 +108,19 @@ def update_moai():
                             pwd=conf.get('auth_pwd', ''),
                             user_id=conf.get('user_id', None))
     else:
-        database = SQLDatabase(config['database'])
-
-    ContentClass = None
-    for content_point in iter_entry_points(group='moai.content',
-                                           name=config['content']):
-        ContentClass = content_point.load()
+        database = SQLDatabase(config['database'], config)
 
+    ContentClass = get_plugin('moai.content', config['content'])
     if ContentClass is None:
         sys.stderr.write('Unknown content class: %s\n' % (config['content'],))
         sys.exit(1)
 
     provider_name = config['provider'].split(':', 1)[0]
-    provider = None
-    for provider_point in iter_entry_points(group='moai.provider',
-                                           name=provider_name):
-        provider = provider_point.load()(config['provider'])
-
-    if provider is None:
+    ProviderClass = get_plugin('moai.provider', provider_name)
+    if ProviderClass is None:
         sys.stderr.write('Unknown provider: %s\n' % (provider_name,))
         sys.exit(1)
+    provider = ProviderClass(config['provider'])
 
     if options.set:
         provider.set_set(options.set)
@@ -128,6 +128,15 @@ def update_moai():
     log = get_moai_log()
     provider.set_logger(log)
 
+    # the original metadata XML is stored for the passthrough formats
+    passthrough_formats = get_formats(config)
+    if passthrough_formats and not hasattr(database, 'get_payloads'):
+        log.warning('The database does not store metadata XML, '
+                    'passthrough is disabled')
+        passthrough_formats = set()
+    if passthrough_formats and hasattr(provider, 'set_passthrough'):
+        provider.set_passthrough(True)
+
     progress = ProgressBar()
     starttime = time.time()
 
@@ -182,12 +191,19 @@ def update_moai():
             progress.tick(count, total)
             continue
         
+        kwargs = {}
+        if passthrough_formats:
+            kwargs['payloads'] = dict(
+                (prefix, data)
+                for prefix, data in getattr(content, 'payloads', {}).items()
+                if prefix in passthrough_formats)
         try:
             database.update_record(content.id,
                                    content.modified,
                                    content.deleted,
                                    content.sets,
-                                   content.metadata)
+                                   content.metadata,
+                                   **kwargs)
         except Exception as err:
             if options.debug:
                 raise
@@ -219,3 +235,53 @@ def update_moai():
         if not options.verbose and not options.quiet:
             print(msg, file=sys.stderr)
 
+
+
+def dump_moai():
+    usage = "usage: %prog [options] profilename"
+    version = "%%prog %s" % VERSION
+
+    parser = OptionParser(usage, version=version)
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      help="be quiet, do not output and info",
+                      action="store_true")
+    parser.add_option("", "--config", dest="config",
+                      help="specify settings file",
+                      action="store")
+    parser.add_option("", "--format", dest="prefix",
+                      help="metadataPrefix of the dump (default: oai_dc)",
+                      action="store", default="oai_dc")
+    parser.add_option("-o", "--output", dest="output",
+                      help="directory for the dump files (default: dump)",
+                      action="store", default="dump")
+    parser.add_option("", "--records-per-file", dest="records_per_file",
+                      help="number of records in a file (default: 10000)",
+                      action="store", type="int", default=10000)
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      help="number of render processes (default: cpus)",
+                      action="store", type="int")
+
+    options, args = parser.parse_args()
+    config = get_profile_config(options, args)
+    config.pop('use', None)
+
+    from moai.wsgi import server_factory
+    from moai.dump import dump_feed
+    server = server_factory({}, **config)
+    starttime = time.time()
+    try:
+        manifest = dump_feed(server._db,
+                             server._config,
+                             options.prefix,
+                             options.output,
+                             records_per_file=options.records_per_file,
+                             jobs=options.jobs)
+    except ValueError as err:
+        sys.stderr.write('%s\n' % err)
+        sys.exit(1)
+    if not options.quiet:
+        print('Dumped %s records in %s files to %s in %s' % (
+            manifest['records'],
+            len(manifest['files']),
+            options.output,
+            get_duration(starttime)), file=sys.stderr)
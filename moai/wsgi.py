@@ -1,4 +1,6 @@
 import os
+import time
+import calendar
 
 from webob import Request, Response
 
@@ -14,6 +16,11 @@ class WSGIRequest(object):
 
     def url(self):
         return self._req.url
+
+    def header(self, name, default=None):
+        """Return the value of a request header
+        """
+        return self._req.headers.get(name, default)
     
     def redirect(self, url):
         """Redirect to this url
@@ -23,19 +30,39 @@ class WSGIRequest(object):
         response.location = url
         return response
 
-    def send_file(self, path, mimetype):
-        """Send the file located at 'path' back to the user
+    def send_file(self, path, mimetype, ranges=False, size=None, mtime=None):
+        """Send the file located at 'path' back to the user, the file
+        is streamed in chunks (or sent by the server with
+        wsgi.file_wrapper). Byte range requests are only answered when
+        ranges is True. The size and (utc) modification time of the
+        file are used for the headers when they are known, otherwise
+        the file is checked.
         """
+        environ = self._req.environ
+        if size is None or mtime is None:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        else:
+            mtime = calendar.timegm(mtime.utctimetuple())
         response = Response(content_type=mimetype,
                             conditional_response=True)
-        response.last_modified = os.path.getmtime(path)
-        response.app_iter = FileIterable(path)
-        with open(path) as f:
-            response.body = f.read()
-        response.content_length = os.path.getsize(path)
-        # do not accept ranges, since this does not work reliable
-        # with acrobat IE plugin
-        response.headers['Accept-Ranges'] = 'none'
+        response.last_modified = mtime
+        response.etag = '%x-%x' % (int(mtime), size)
+        if ranges:
+            response.headers['Accept-Ranges'] = 'bytes'
+        else:
+            # ranges are not accepted by default, since this does not
+            # work reliable with acrobat IE plugin
+            environ.pop('HTTP_RANGE', None)
+            response.headers['Accept-Ranges'] = 'none'
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and 'HTTP_RANGE' not in environ:
+            # the server can send the file itself (with sendfile)
+            response.app_iter = file_wrapper(open(path, 'rb'),
+                                             FileIterator.chunk_size)
+        else:
+            response.app_iter = FileIterable(path)
+        response.content_length = size
         return response
     
     def query_dict(self):
@@ -46,19 +73,27 @@ class WSGIRequest(object):
         args.update(dict(self._req.POST))
         return args
 
-    def write(self, data, mimetype):
-        """Write data back to the client
+    def write(self, data, mimetype, headers=None):
+        """Write data back to the client, data is either a string
+        or an iterator of strings that is streamed to the client
         """
         response = Response()
         response.content_type = mimetype
-        response.body = data
+        for name, value in (headers or {}).items():
+            response.headers[name] = value
+        if isinstance(data, bytes):
+            response.body = data
+        else:
+            response.app_iter = data
         return response
 
-    def send_status(self, code, msg='', mimetype='text/plain'):
+    def send_status(self, code, msg='', mimetype='text/plain', headers=None):
         response = Response()
         response.content_type = mimetype
         response.status = int(code.split()[0])
         response.text = msg
+        for name, value in (headers or {}).items():
+            response.headers[name] = value
         return response
 
 
@@ -68,18 +103,24 @@ class MOAIWSGIApp(object):
         self.server = server
         
     def __call__(self, environ, start_response):
-        request = Request(environ)
-        response = self.server.handle_request(WSGIRequest(request))
-        return response(environ, start_response)
+        started = time.perf_counter()
+        request = WSGIRequest(Request(environ))
+        response = self.server.handle_request(request)
+        # bodies of a known size (and files sent with wsgi.file_wrapper)
+        # are returned as they are
+        return self.server.meter(request,
+                                 response(environ, start_response),
+                                 started,
+                                 response.content_length)
 
-def app_factory(global_config,
-                name,
-                url,
-                admin_email,
-                database,
-                formats,
-                **kwargs):
-    # WSGI APP Factory
+def server_factory(global_config,
+                   name,
+                   url,
+                   admin_email,
+                   database,
+                   formats,
+                   **kwargs):
+    # Creates the Server from the paste configuration of a feed
     formats = formats.split()
     admin_email = admin_email.split()
     sets_deleted = kwargs.get('deleted_sets') or []
@@ -104,9 +145,11 @@ def app_factory(global_config,
                             sets_allowed=sets_allowed,
                             sets_needed=sets_needed,
                             extra_args=kwargs)
-    server = Server(url, database, feedconfig)
-    
-    return MOAIWSGIApp(server)
+    return Server(url, database, feedconfig)
+
+def app_factory(global_config, **kwargs):
+    # WSGI APP Factory
+    return MOAIWSGIApp(server_factory(global_config, **kwargs))
 
 class FileIterable(object):
     # Helper objects to stream asset files
@@ -114,16 +157,23 @@ class FileIterable(object):
         self.filename = filename
         self.start = start
         self.stop = stop
+        self._iterators = []
     def __iter__(self):
-        return FileIterator(self.filename, self.start, self.stop)
+        iterator = FileIterator(self.filename, self.start, self.stop)
+        self._iterators.append(iterator)
+        return iterator
     def app_iter_range(self, start, stop):
         return self.__class__(self.filename, start, stop)
+    def close(self):
+        for iterator in self._iterators:
+            iterator.close()
 
 class FileIterator(object):
-    chunk_size = 4096
+    chunk_size = 65536
     def __init__(self, filename, start, stop):
         self.filename = filename
         self.fileobj = open(self.filename, 'rb')
+        start = start or 0
         if start:
             self.fileobj.seek(start)
         if stop is not None:
@@ -133,14 +183,17 @@ class FileIterator(object):
     def __iter__(self):
         return self
     def __next__(self):
-        if self.length is not None and self.length <= 0:
-            raise StopIteration
-        chunk = self.fileobj.read(self.chunk_size)
+        size = self.chunk_size
+        if self.length is not None:
+            size = min(size, self.length)
+        chunk = b''
+        if size > 0:
+            chunk = self.fileobj.read(size)
         if not chunk:
+            self.close()
             raise StopIteration
         if self.length is not None:
             self.length -= len(chunk)
-            if self.length < 0:
-                # Chop off the extra:
-                chunk = chunk[:self.length]
         return chunk
+    def close(self):
+        self.fileobj.close()
@@ -25,10 +25,15 @@ setup(
     entry_points= {
     'console_scripts': [
         'update_moai = moai.tools:update_moai',
+        'dump_moai = moai.tools:dump_moai',
       ],
     'paste.app_factory':[
         'main=moai.wsgi:app_factory'
      ],
+    'paste.filter_app_factory':[
+        'admission=moai.middleware:filter_app_factory',
+        'profiler=moai.middleware:profiler_filter_app_factory'
+     ],
     'moai.content':[
         'moai_example=moai.content.example:ExampleContent',
         'edm=moai.content.edm:EdmContent'